@@ -87,7 +87,8 @@
 #import string, sys, os, time, datetime, exceptions, socket, commands, argparse, ConfigParser
 import string, sys, os, time, datetime, socket, argparse, configparser
 import random, math, signal, platform, glob, stat, imp
-import smtplib, subprocess
+import smtplib, subprocess, re, select, struct, ctypes, ctypes.util, json, csv, bisect, itertools, threading, tempfile
+import gzip, zlib, multiprocessing, collections, hashlib, queue, sqlite3, heapq
 from subprocess import *
 from decimal import *
 from optparse import OptionParser
@@ -100,7 +101,7 @@ from email.mime.multipart import MIMEMultipart
 #from email.MIMEText import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-# psycopg2 and psutil imported directly in function where needed since we test for it using imp to avoid exception 
+# psycopg2 imported directly in function where needed since we test for it using imp to avoid exception 
 
 OK  = 0
 ERR = 1
@@ -144,6 +145,1991 @@ def which(program):
                 return exe_file
     return ''
 
+# sqlstatebypass() decision for sqlstates that no SQLSTATE/SQLCLASS filters out
+SQLSTATEEVALUATE = ('evaluate', '')
+MAXSQLSTATEDECISIONS = 10000
+
+# fixed phrases evaluatelog() and alertvalidated() look for in a record, scanned for together with the configured ones
+MSGPHRASES = (('sharelock',     'acquired ShareLock on transaction'),
+              ('exclusivelock', 'acquired ExclusiveLock on '),
+              ('stillwaiting',  'still waiting for '),
+              ('deadlock',      'detected deadlock while waiting for'),
+              ('canceluser',    'ERROR:  canceling statement due to user request'),
+              ('canceltimeout', 'ERROR:  canceling statement due to statement timeout'))
+
+
+class patternmatcher:
+    # GREPFILTER, GREPEXCLUDE, LOCKFILTER, IGNOREAPPS and MSGPHRASES compiled into one alternation regex at config load.
+    # scan() returns the id of every phrase set that hits the text.  The regex runs over the lowercased text, which is
+    # several times faster in python than re.IGNORECASE, and stops only where some phrase starts; the phrases starting
+    # with that character are then checked directly, with their own case rule.  Searching again from the next
+    # character means overlapping phrases are all found.
+    def __init__(self):
+        self.phrases = {}
+        self.ids     = set()
+        self.regex   = None
+        self.byfirst = {}
+        self.every   = []
+
+    def add(self, patternid, phrase, ignorecase=False):
+        if phrase is None or phrase == '':
+            return
+        self.phrases.setdefault((phrase, ignorecase), set()).add(patternid)
+        self.ids.add(patternid)
+
+    def addgrep(self, patternid, pattern, ignorecase=False):
+        # grep basic regexes made of literal phrases separated by \|
+        if pattern is None or pattern.strip() == '':
+            return
+        for aphrase in pattern.split('\\|'):
+            self.add(patternid, aphrase, ignorecase)
+
+    def has(self, patternid):
+        return patternid in self.ids
+
+    def compile(self):
+        folded       = set()
+        self.byfirst = {}
+        self.every   = []
+        for (phrase, ignorecase), ids in self.phrases.items():
+            lowered = phrase.lower()
+            entry   = (phrase, lowered, ignorecase, frozenset(ids))
+            folded.add(lowered)
+            self.every.append(entry)
+            self.byfirst.setdefault(lowered[0], []).append(entry)
+        self.regex = None
+        if len(folded) > 0:
+            self.regex = re.compile(self.trie(folded))
+        return self
+
+    def trie(self, phrases):
+        # phrases sharing a prefix share one branch of the regex, so each position costs one character test per level
+        # instead of one test per phrase
+        root = {}
+        for aphrase in phrases:
+            node = root
+            for achar in aphrase:
+                node = node.setdefault(achar, {})
+            node[''] = None
+        return self.trienode(root)
+
+    def trienode(self, node):
+        branches = [re.escape(achar) + self.trienode(node[achar]) for achar in sorted(node.keys()) if achar != '']
+        if len(branches) == 0:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(branches)
+        if '' in node:
+            pattern = '(?:%s)?' % pattern
+        return pattern
+
+    def scan(self, text):
+        hits = set()
+        if self.regex is None:
+            return hits
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # a few unicode characters change length when lowercased, so positions would not line up
+            for phrase, folded, ignorecase, ids in self.every:
+                if (ignorecase and folded in lowered) or (not ignorecase and phrase in text):
+                    hits |= ids
+            return hits
+        search = self.regex.search
+        amatch = search(lowered)
+        while amatch is not None:
+            pos = amatch.start()
+            for phrase, folded, ignorecase, ids in self.byfirst.get(lowered[pos], ()):
+                if ids <= hits:
+                    continue
+                if lowered.startswith(folded, pos) and (ignorecase or text.startswith(phrase, pos)):
+                    hits |= ids
+            amatch = search(lowered, pos + 1)
+        return hits
+
+    def scanlines(self, lines):
+        # scan() for a whole batch of lines at once: the regex runs over the joined batch so lines without any
+        # phrase cost no python work at all.  Returns one set of ids per line (the same empty set for misses).
+        none    = frozenset()
+        results = [none] * len(lines)
+        if self.regex is None or len(lines) == 0:
+            return results
+        blob    = '\n'.join(lines)
+        lowered = blob.lower()
+        if len(lowered) != len(blob):
+            return [self.scan(line) for line in lines]
+        starts = [0]
+        for size in itertools.accumulate([len(line) + 1 for line in lines]):
+            starts.append(size)
+        search = self.regex.search
+        amatch = search(lowered)
+        while amatch is not None:
+            pos   = amatch.start()
+            index = bisect.bisect_right(starts, pos) - 1
+            hits  = results[index]
+            if hits is none:
+                hits = set()
+                results[index] = hits
+            for phrase, folded, ignorecase, ids in self.byfirst.get(lowered[pos], ()):
+                if ids <= hits:
+                    continue
+                if lowered.startswith(folded, pos) and (ignorecase or blob.startswith(phrase, pos)):
+                    hits |= ids
+            amatch = search(lowered, pos + 1)
+        return results
+
+
+class alertrule:
+    # One evaluatelog() rule, compiled once per config load.  It applies to a record when all of its phrase hits are
+    # there, its sqlstate or class matches and its field predicates hold.  Then it either decides right away (ACTION)
+    # or extracts a number from the message and alerts at or above THRESHOLD, bypassing below it.
+    def __init__(self, name, hits=(), sqlstates=(), fields=None, extract='', scale=1.0, threshold=None, action='alert', label=''):
+        self.name       = name
+        self.hits       = tuple(hits)
+        self.sqlstates  = frozenset([code for code in sqlstates if len(code) != 2])
+        self.sqlclasses = frozenset([code for code in sqlstates if len(code) == 2])
+        self.fields     = fields or {}
+        self.extract    = re.compile(extract) if extract != '' else None
+        self.measured   = self.extract is not None
+        self.scale      = scale
+        self.threshold  = threshold
+        self.action     = action
+        self.label      = label or "rule %s" % name
+        # MATCH phrase of a configured rule, added to the shared patternmatcher under the hit id 'rule:<name>'
+        self.phrase     = ''
+        self.ignorecase = False
+        self.order      = 0
+
+    def keys(self):
+        # where ruleset files this rule: under its first phrase hit, else under its sqlstates/classes, else everywhere
+        if len(self.hits) > 0:
+            return [('hit', self.hits[0])]
+        keys = [('sqlstate', code) for code in self.sqlstates] + [('sqlclass', code) for code in self.sqlclasses]
+        if len(keys) == 0:
+            return [None]
+        return keys
+
+    def applies(self, rec, sqlstate):
+        for hit in self.hits:
+            if hit not in rec.hits:
+                return False
+        if (self.sqlstates or self.sqlclasses) and sqlstate not in self.sqlstates and sqlstate[0:2] not in self.sqlclasses:
+            return False
+        for name, value in self.fields.items():
+            if (rec.fields.get(name) or '').strip() != value:
+                return False
+        return True
+
+    def measure(self, rec):
+        amatch = self.extract.search(rec.msg)
+        if amatch is None:
+            return None
+        try:
+            return float(amatch.group(1)) * self.scale
+        except (ValueError, IndexError):
+            return None
+
+
+class ruleset:
+    # alertrules in evaluation order, filed by phrase hit and sqlstate so a record only looks at the rules that can
+    # apply to it: the per-record cost depends on the record's hits, not on how many rules are configured.
+    def __init__(self, rules):
+        self.rules  = rules
+        self.always = []
+        self.bykey  = {}
+        for order, rule in enumerate(rules):
+            rule.order = order
+            for key in rule.keys():
+                if key is None:
+                    self.always.append(rule)
+                else:
+                    self.bykey.setdefault(key, []).append(rule)
+
+    def candidates(self, rec, sqlstate):
+        found = list(self.always)
+        for hit in rec.hits:
+            found.extend(self.bykey.get(('hit', hit), ()))
+        if sqlstate != '':
+            found.extend(self.bykey.get(('sqlstate', sqlstate), ()))
+            found.extend(self.bykey.get(('sqlclass', sqlstate[0:2]), ()))
+        if len(found) > 1:
+            found = sorted(set(found), key=lambda rule: rule.order)
+        return found
+
+
+# process 11 acquired ShareLock on transaction 3219951272 after 1569.367 ms
+# process 13 still waiting for ExclusiveLock on tuple (0,1) of relation 16385 of database 13442 after 1000.104 ms
+# process 10513 detected deadlock while waiting for ShareLock on transaction 3245985292 after 1000.098 ms
+#   DETAIL:  Processes holding the lock: 10511, 10512. Wait queue: 10513.
+LOCKWAITREGEX    = re.compile(r'process (?P<pid>\d+) (?P<event>acquired|still waiting for|detected deadlock while waiting for) '
+                              r'(?P<locktype>[A-Za-z]+) on (?P<object>.+?) after (?P<ms>\d+(?:\.\d*)?) ms')
+LOCKHOLDERSREGEX = re.compile(r'Process(?:es)? holding the lock: (?P<holders>\d+(?:, \d+)*)')
+LOCKHITS         = frozenset(['sharelock', 'exclusivelock', 'stillwaiting', 'deadlock'])
+
+
+class lockwait:
+    # one lock wait log message, parsed by parselockwait()
+    def __init__(self, event, locktype, pid, holders, ms):
+        self.event    = event
+        self.locktype = locktype
+        self.pid      = pid
+        self.holders  = holders
+        self.ms       = ms
+
+
+def parselockwait(msg):
+    amatch = LOCKWAITREGEX.search(msg)
+    if amatch is None:
+        return None
+    holders = []
+    hmatch  = LOCKHOLDERSREGEX.search(msg, amatch.end())
+    if hmatch is not None:
+        holders = [int(pid) for pid in hmatch.group('holders').split(', ')]
+    event = amatch.group('event').split(' ')[0]
+    return lockwait(event, amatch.group('locktype'), int(amatch.group('pid')), holders, float(amatch.group('ms')))
+
+
+class lockhistogram:
+    # Lock wait times per lock type: log2 millisecond buckets since startup for the summary, and the waits of the
+    # last WINDOW seconds (by log time) for percentiles.  Those are kept in arrival order, to expire them, and in
+    # sorted order, so a percentile is a lookup instead of a sort of up to MAXSAMPLES waits per lock wait record.
+    BOUNDS     = [2 ** power for power in range(0, 23)]
+    MAXSAMPLES = 10000
+
+    def __init__(self):
+        self.window  = 900
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.maxms   = {}
+        self.recent  = {}
+        self.ordered = {}
+
+    def add(self, locktype, ms, when):
+        buckets = self.buckets.get(locktype)
+        if buckets is None:
+            buckets = [0] * (len(self.BOUNDS) + 1)
+            self.buckets[locktype] = buckets
+            self.maxms[locktype]   = 0.0
+        buckets[bisect.bisect_left(self.BOUNDS, ms)] += 1
+        self.maxms[locktype] = max(self.maxms[locktype], ms)
+        recent  = self.recent.setdefault(locktype, collections.deque())
+        ordered = self.ordered.setdefault(locktype, [])
+        if len(recent) >= self.MAXSAMPLES:
+            self.expire(recent, ordered)
+        recent.append((when, ms))
+        bisect.insort(ordered, ms)
+
+    def expire(self, recent, ordered):
+        # the oldest wait leaves both orders
+        when, ms = recent.popleft()
+        del ordered[bisect.bisect_left(ordered, ms)]
+
+    def percentile(self, locktype, pct, now):
+        # nearest-rank percentile of the waits within the window, None if there are none
+        recent = self.recent.get(locktype)
+        if not recent:
+            return None
+        ordered = self.ordered[locktype]
+        while recent and recent[0][0] < now - self.window:
+            self.expire(recent, ordered)
+        if len(ordered) == 0:
+            return None
+        rank = max(int(math.ceil(pct / 100.0 * len(ordered))), 1)
+        return ordered[rank - 1]
+
+    def state(self):
+        return {'buckets': self.buckets, 'maxms': self.maxms}
+
+    def merge(self, state):
+        for locktype, buckets in state['buckets'].items():
+            mine = self.buckets.setdefault(locktype, [0] * (len(self.BOUNDS) + 1))
+            for index, count in enumerate(buckets):
+                mine[index] += count
+            self.maxms[locktype] = max(self.maxms.get(locktype, 0.0), state['maxms'][locktype])
+
+    def bucketpercentile(self, buckets, pct):
+        # upper bound of the bucket holding the percentile
+        total = sum(buckets)
+        rank  = max(int(math.ceil(pct / 100.0 * total)), 1)
+        seen  = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else float('inf')
+        return float('inf')
+
+    def summary(self):
+        if len(self.buckets) == 0:
+            return "none"
+        parts = []
+        for locktype in sorted(self.buckets.keys()):
+            buckets = self.buckets[locktype]
+            parts.append("%s n=%d p50<=%gms p95<=%gms p99<=%gms max=%.1fms" % (locktype, sum(buckets), self.bucketpercentile(buckets, 50),
+                         self.bucketpercentile(buckets, 95), self.bucketpercentile(buckets, 99), self.maxms[locktype]))
+        return '; '.join(parts)
+
+
+class lockwaitrule(alertrule):
+    # built-in LOCKWAIT rule: the wait of this message, or with LOCKWAIT_PERCENTILE the percentile of this lock type's
+    # waits over LOCKWAIT_WINDOW, in seconds against the LOCKWAIT threshold
+    def __init__(self, name, hits, threshold, histogram, percentile=None):
+        alertrule.__init__(self, name, hits=hits, threshold=threshold, label='lock wait seconds')
+        self.measured   = True
+        self.histogram  = histogram
+        self.percentile = percentile
+        if percentile is not None:
+            self.label = 'p%g lock wait seconds' % percentile
+
+    def measure(self, rec):
+        wait = getattr(rec, 'lockwait', None)
+        if wait is None:
+            return None
+        if self.percentile is None:
+            return wait.ms / 1000.0
+        value = self.histogram.percentile(wait.locktype, self.percentile, rec.when)
+        if value is None:
+            return None
+        return value / 1000.0
+
+
+# what makes two alerts "the same error": the message text after the severity, without its variable parts
+FINGERPRINTSEVERITY = re.compile(r'\b(?:PANIC|FATAL|ERROR|WARNING|LOG|NOTICE|INFO|DEBUG[1-5]?):  ')
+FINGERPRINTSTRIP    = (
+    (re.compile(r"'(?:[^']|'')*'"),                                        "'?'"),
+    (re.compile(r'\b\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:\.\d+)?(?: ?[A-Z]{2,5}|[+-]\d\d(?::?\d\d)?)?'), '?'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'),                                   '?'),
+    (re.compile(r'\b[0-9a-f]{8}\.[0-9a-f]+\b'),                          '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'),                                 '?'),
+    (re.compile(r'\s+'),                                                   ' '),
+)
+
+
+class fingerprints:
+    # Alerts aggregated by fingerprint over WINDOW seconds: the same error (numbers, literals, pids, xids and times
+    # stripped) is reported once per window with its count, first and last log time and a sample of the full message.
+    # A window of 0 passes every alert through as before.
+    def __init__(self, window=0):
+        self.window  = window
+        self.entries = collections.OrderedDict()
+        self.started = None
+        self.total   = 0
+
+    def pending(self):
+        return len(self.entries) > 0
+
+    def count(self):
+        return self.total
+
+    def normalize(self, msg):
+        line  = msg.split('\n', 1)[0]
+        match = FINGERPRINTSEVERITY.search(line)
+        if match is not None:
+            # the log_line_prefix in front of the severity (timestamp, pid, user, ...) is not part of the error
+            line = line[match.start():]
+        for regex, replacement in FINGERPRINTSTRIP:
+            line = regex.sub(replacement, line)
+        return line.strip()
+
+    def fingerprint(self, msg):
+        return hashlib.md5(self.normalize(msg).encode('utf-8', 'replace')).hexdigest()[0:12]
+
+    def add(self, msg, key=None):
+        if self.started is None:
+            self.started = time.time()
+        self.total = self.total + 1
+        if self.window == 0:
+            self.entries[self.total] = [1, '', '', msg]
+            return
+        if key is None:
+            key = self.fingerprint(msg)
+        when  = msg[0:19] if msg[0:4].isdigit() else ''
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [1, when, when, msg]
+        else:
+            entry[0] = entry[0] + 1
+            entry[2] = when
+
+    def due(self):
+        return self.pending() and time.time() - self.started >= self.window
+
+    def drain(self, extra=()):
+        # one line (the sample) for an error seen once, a summary line plus the sample for repeated ones
+        lines = []
+        for key, (count, first, last, sample) in self.entries.items():
+            if count == 1:
+                lines.append(sample)
+            else:
+                lines.append("[%d occurrences from %s to %s, fingerprint %s] %s" % (count, first, last, key, sample))
+        lines.extend(extra)
+        self.entries = collections.OrderedDict()
+        self.started = None
+        self.total   = 0
+        return '\n'.join(lines) + '\n'
+
+
+class ratelimiter:
+    # Token bucket per key (fingerprint, sqlstate, database or user of the alert): BURST alerts right away, then RATE
+    # per minute.  Alerts over the limit are only counted, so one noisy error cannot drown out or pause the others.
+    MAXKEYS = 10000
+
+    def __init__(self, keyfield='fingerprint', rate=20, burst=20):
+        self.keyfield   = keyfield
+        self.rate       = rate / 60.0
+        self.burst      = float(burst)
+        self.buckets    = {}
+        self.suppressed = {}
+
+    def allow(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.MAXKEYS:
+                self.evict(now)
+            bucket = [self.burst, now]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] = bucket[0] - 1.0
+            return True
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        return False
+
+    def evict(self, now):
+        # buckets that have refilled completely are the same as no bucket at all
+        for key in list(self.buckets.keys()):
+            tokens, last = self.buckets[key]
+            if tokens + (now - last) * self.rate >= self.burst and key not in self.suppressed:
+                del self.buckets[key]
+        if len(self.buckets) >= self.MAXKEYS:
+            self.buckets = {}
+
+    def pending(self):
+        return len(self.suppressed) > 0
+
+    def drain(self):
+        # one line per key that had alerts suppressed since the last drain
+        lines = ["[rate limit] %d alerts suppressed for %s %s" % (count, self.keyfield, key) for key, count in sorted(self.suppressed.items(), key=lambda item: -item[1])]
+        self.suppressed = {}
+        return lines
+
+
+def compressfile(path):
+    # gzip path to path.gz, keeping its mtime, and remove path.  Written to a temp name first, so path is only removed
+    # once its .gz is complete.  Returns '' or the error.
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.utime(path + '.gz.tmp', (mtime, mtime))
+        os.replace(path + '.gz.tmp', path + '.gz')
+        os.remove(path)
+    except (IOError, OSError) as e:
+        return str(e)
+    return ''
+
+
+class historywriter:
+    # The alerts history file, kept open.  write() only puts the text on a bounded queue; a background thread writes
+    # everything queued so far with one write() call.  It flushes at most flushsecs after a line was written (0: after
+    # every batch) and with fsync also forces it to disk.  A full queue makes the caller wait instead of losing lines.
+    # A write error is kept in error for the caller to act on.
+    # The file name is template with the date, so a run that crosses midnight moves on to the next day's file; with
+    # maxbytes the file is also cut into numbered segments.  Closed files are gzipped by a thread of their own.
+    # structured writes one JSON object per line (messages become {"event": "message", ...}) instead of plain text.
+    MAXQUEUE = 10000
+    DATEFMT  = "%Y-%m%d"
+    # the files being written to right now by any writer in this process (real paths), see retentionservice
+    INUSE    = set()
+
+    def __init__(self, template, mode='a', flushsecs=1.0, fsync=False, structured=False, maxbytes=0):
+        self.template   = template
+        self.flushsecs  = flushsecs
+        self.fsync      = fsync
+        self.structured = structured
+        self.maxbytes   = maxbytes
+        self.error      = ''
+        self.date       = datetime.datetime.now().strftime(self.DATEFMT)
+        self.path       = template % self.date
+        self.compressing = []
+        self.queue      = queue.Queue(self.MAXQUEUE)
+        self.afile      = open(self.path, mode)
+        historywriter.INUSE.add(os.path.realpath(self.path))
+        self.thread     = threading.Thread(target=self.run, name='history')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, text):
+        self.queue.put(text)
+
+    def message(self, message):
+        if self.structured:
+            self.event({'event': 'message', 'message': message})
+        else:
+            self.queue.put(message + "\n")
+
+    def event(self, event):
+        # only structured history has events; plain text history already has the message that goes with them
+        if not self.structured:
+            return
+        if 'timestamp' not in event:
+            event = dict(event, timestamp=datetime.datetime.now().isoformat(timespec='milliseconds'))
+        self.queue.put(json.dumps(event, default=str) + "\n")
+
+    def rotate(self):
+        # called by the writer thread before every write
+        date = datetime.datetime.now().strftime(self.DATEFMT)
+        if date == self.date and (self.maxbytes <= 0 or self.afile.tell() < self.maxbytes):
+            return
+        self.afile.close()
+        closed = self.path
+        if date == self.date:
+            # size: the full file becomes the next numbered segment of the day and we start over
+            stem, ext = os.path.splitext(self.path)
+            segment = 1
+            while os.path.exists('%s.%d%s' % (stem, segment, ext)) or os.path.exists('%s.%d%s.gz' % (stem, segment, ext)):
+                segment = segment + 1
+            closed = '%s.%d%s' % (stem, segment, ext)
+            os.rename(self.path, closed)
+        historywriter.INUSE.discard(os.path.realpath(self.path))
+        self.date  = date
+        self.path  = self.template % date
+        self.afile = open(self.path, 'a')
+        historywriter.INUSE.add(os.path.realpath(self.path))
+        self.compressing = [thread for thread in self.compressing if thread.is_alive()]
+        thread = threading.Thread(target=self.compress, args=(closed,), name='history-gzip')
+        thread.daemon = True
+        thread.start()
+        self.compressing.append(thread)
+
+    def compress(self, path):
+        # on error it is left uncompressed, retentionservice tries again later
+        compressfile(path)
+
+    def run(self):
+        unflushed = False
+        lastflush = time.time()
+        while True:
+            try:
+                batch = [self.queue.get(timeout=(max(self.flushsecs - (time.time() - lastflush), 0.01) if unflushed else None))]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.MAXQUEUE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            try:
+                text = ''.join([item for item in batch if item is not None])
+                if text != '':
+                    self.rotate()
+                    self.afile.write(text)
+                    unflushed = True
+                if unflushed and (stopping or time.time() - lastflush >= self.flushsecs):
+                    self.afile.flush()
+                    if self.fsync:
+                        os.fsync(self.afile.fileno())
+                    unflushed = False
+                    lastflush = time.time()
+            except (IOError, OSError, ValueError) as e:
+                self.error = str(e)
+            if stopping:
+                break
+
+    def close(self):
+        # writes and flushes everything queued, and waits for closed files being gzipped, before returning
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.afile.close()
+        historywriter.INUSE.discard(os.path.realpath(self.path))
+        for thread in self.compressing:
+            thread.join()
+
+
+# the alerts and alerts history files of a standalone pg_alert, by name: alerts[-history]-YYYY-MMDD[.N].log|.jsonl[.gz]
+RETENTIONFILES = r'^alerts-(?:history-)?\d{4}-\d{4}(?:\.\d+)?\.(?:log|jsonl)(?:\.gz)?$'
+# and of one fleet cluster, alerts-history-CLUSTERID-YYYY-MMDD..., with %s the escaped file id
+RETENTIONFLEETFILES = r'^alerts-history-%s-\d{4}-\d{4}(?:\.\d+)?\.(?:log|jsonl)(?:\.gz)?$'
+
+
+class retentionservice:
+    # KEEPLOGDAYS, KEEPLOGMB and COMPRESSLOGDAYS for our alerts files in directory (names matching pattern, so fleet
+    # clusters sharing the directory leave each other's files alone), applied by a thread of its own every INTERVAL
+    # seconds and on wake(), so the log evaluation loop never waits on the directory.  Files older than compressdays
+    # are gzipped, files older than keepdays are removed, and while all of them together take more than maxbytes the
+    # oldest go first.  Files in historywriter.INUSE (compared by real path) or being gzipped are never touched.
+    # -1 (0 for maxbytes) switches a limit off.  What was done is passed to report(), one message at a time.
+    INTERVAL = 3600
+
+    def __init__(self, directory, keepdays=-1, compressdays=1, maxbytes=0, report=None, pattern=RETENTIONFILES):
+        self.directory    = directory
+        self.pattern      = re.compile(pattern)
+        self.keepdays     = keepdays
+        self.compressdays = compressdays
+        self.maxbytes     = maxbytes
+        self.report       = report
+        self.scans        = 0
+        self.stopping     = False
+        self.wakeup       = threading.Event()
+        self.thread       = threading.Thread(target=self.run, name='retention')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def candidates(self):
+        # [mtime, path, size] of every file of ours we may compress or remove, and the bytes of the ones in use
+        files = []
+        inuse = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if self.pattern.match(entry.name) is None:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    info = entry.stat()
+                except OSError:
+                    # removed while we looked
+                    continue
+                if os.path.realpath(entry.path) in historywriter.INUSE or os.path.exists(entry.path + '.gz.tmp'):
+                    inuse = inuse + info.st_size
+                    continue
+                files.append([info.st_mtime, entry.path, info.st_size])
+        return files, inuse
+
+    def scan(self):
+        messages = []
+        now = time.time()
+        files, total = self.candidates()
+        kept = []
+        for mtime, path, size in files:
+            dayage = int(round((now - mtime) / 60 / 60 / 24))
+            if self.keepdays > -1 and dayage > self.keepdays:
+                try:
+                    os.remove(path)
+                    messages.append("deleting file older than %d days: %s" % (dayage, path))
+                except OSError as e:
+                    messages.append("unable to delete %s. %s" % (path, e))
+                continue
+            if self.compressdays > -1 and dayage >= self.compressdays and not path.endswith('.gz'):
+                error = compressfile(path)
+                if error == '':
+                    path = path + '.gz'
+                    size = os.path.getsize(path)
+                    messages.append("compressed file older than %d days: %s" % (dayage, path))
+                else:
+                    messages.append("unable to compress %s. %s" % (path, error))
+            kept.append((mtime, path, size))
+            total = total + size
+
+        if self.maxbytes > 0 and total > self.maxbytes:
+            for mtime, path, size in sorted(kept):
+                if total <= self.maxbytes:
+                    break
+                try:
+                    os.remove(path)
+                    total = total - size
+                    messages.append("deleting file over the %d MB budget: %s" % (self.maxbytes // (1024 * 1024), path))
+                except OSError as e:
+                    messages.append("unable to delete %s. %s" % (path, e))
+        return messages
+
+    def run(self):
+        while not self.stopping:
+            try:
+                messages = self.scan()
+            except OSError as e:
+                messages = ["unable to scan %s. %s" % (self.directory, e)]
+            self.scans = self.scans + 1
+            if self.report is not None:
+                for message in messages:
+                    self.report(message)
+            self.wakeup.wait(self.INTERVAL)
+            self.wakeup.clear()
+
+    def close(self):
+        # waits for a scan in progress, unless called from a report() on the thread itself
+        self.stopping = True
+        self.wakeup.set()
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+
+# what `pg_alert.py query` can count by and filter on: event store columns, plus the day and hour of the log time
+QUERYFIELDS = {'logtime': 'logtime', 'day': 'substr(logtime, 1, 10)', 'hour': 'substr(logtime, 1, 13)', 'cluster': 'cluster',
+               'source': 'source', 'pid': 'pid', 'user': 'user', 'database': 'database', 'application': 'application',
+               'remote': 'remote', 'sqlstate': 'sqlstate', 'severity': 'severity', 'fingerprint': 'fingerprint',
+               'decision': 'decision', 'rule': 'rule', 'reason': 'reason', 'alertid': 'alertid'}
+
+
+class eventstore:
+    # Every evaluated log record as a row of an SQLite database in ALERTLOG_DIRECTORY, for `pg_alert.py query`.
+    # add() only puts a batch of rows on a bounded queue; a thread of its own inserts everything queued so far with one
+    # executemany() in one transaction, at most flushsecs after it was added.  The database is in WAL mode so queries
+    # run while we write.  A full queue drops the batch (counted in dropped) unless the caller asks to wait, so the
+    # store never holds up live evaluation.  alerted() gives the live alert rows evaluated since the previous alert
+    # the id of the alert that went out; backfilled rows were never mailed and stay without one.  Rows stored more than keepdays ago are removed once an hour, so backfilled old logs are kept as well.  Errors are kept in error.
+    MAXQUEUE = 1000
+    COLUMNS  = ('evaluated', 'logtime', 'cluster', 'source', 'pid', 'user', 'database', 'application', 'remote', 'sqlstate',
+                'severity', 'fingerprint', 'decision', 'rule', 'reason', 'latency_us', 'message', 'fields')
+    SCHEMA   = [
+        "CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY, sent REAL, cluster TEXT, number INTEGER, message TEXT)",
+        "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, evaluated REAL, logtime TEXT, cluster TEXT, source TEXT, "
+        "pid INTEGER, user TEXT, database TEXT, application TEXT, remote TEXT, sqlstate TEXT, severity TEXT, fingerprint TEXT, "
+        "decision TEXT, rule TEXT, reason TEXT, latency_us INTEGER, alertid INTEGER REFERENCES alerts(id), message TEXT, fields TEXT)",
+        "CREATE INDEX IF NOT EXISTS events_evaluated ON events (evaluated)",
+        "CREATE INDEX IF NOT EXISTS events_logtime ON events (logtime)",
+        "CREATE INDEX IF NOT EXISTS events_sqlstate ON events (sqlstate, logtime)",
+        "CREATE INDEX IF NOT EXISTS events_database ON events (database, logtime)",
+        "CREATE INDEX IF NOT EXISTS events_fingerprint ON events (fingerprint, logtime)",
+        "CREATE INDEX IF NOT EXISTS events_unsent ON events (cluster) WHERE decision = 'alert' AND alertid IS NULL",
+    ]
+
+    def __init__(self, path, flushsecs=1.0, keepdays=30, maxqueue=MAXQUEUE):
+        self.path      = path
+        self.flushsecs = flushsecs
+        self.keepdays  = keepdays
+        self.error     = ''
+        self.dropped   = 0
+        self.rows      = 0
+        self.pruned    = 0
+        # opened here so a bad path fails right away, used only by the thread from then on
+        self.conn      = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        self.conn.commit()
+        self.insert    = "INSERT INTO events (%s) VALUES (%s)" % (', '.join(self.COLUMNS), ', '.join(['?'] * len(self.COLUMNS)))
+        self.queue     = queue.Queue(maxqueue)
+        self.thread    = threading.Thread(target=self.run, name='eventstore')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, rows, wait=False):
+        # rows: tuples in COLUMNS order
+        try:
+            self.queue.put(('insert', rows), wait)
+        except queue.Full:
+            self.dropped = self.dropped + len(rows)
+
+    def alerted(self, cluster, number, message, since):
+        # since: when the previous alert went out, the rows of this one were evaluated after it
+        self.queue.put(('alerted', (cluster, number, message, since, time.time())))
+
+    def prune(self):
+        if self.keepdays <= 0:
+            return
+        cutoff = time.time() - self.keepdays * 86400
+        self.pruned = self.pruned + self.conn.execute("DELETE FROM events WHERE evaluated < ?", (cutoff,)).rowcount
+        self.conn.execute("DELETE FROM alerts WHERE id NOT IN (SELECT alertid FROM events WHERE alertid IS NOT NULL)")
+
+    def run(self):
+        lastprune = 0
+        while True:
+            batch = [self.queue.get()]
+            # give the batch flushsecs to fill up, one transaction for all of it
+            deadline = time.time() + self.flushsecs
+            while batch[-1] is not None and len(batch) < self.MAXQUEUE:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)) if self.flushsecs > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self.conn:
+                    for item in batch:
+                        if item is None:
+                            continue
+                        op, args = item
+                        if op == 'insert':
+                            self.conn.executemany(self.insert, args)
+                            self.rows = self.rows + len(args)
+                        else:
+                            cluster, number, message, since, sent = args
+                            alertid = self.conn.execute("INSERT INTO alerts (sent, cluster, number, message) VALUES (?, ?, ?, ?)",
+                                                        (sent, cluster, number, message)).lastrowid
+                            self.conn.execute("UPDATE events SET alertid = ? WHERE cluster = ? AND decision = 'alert' AND alertid IS NULL "
+                                              "AND source = 'live' AND evaluated BETWEEN ? AND ?", (alertid, cluster, since, sent))
+                    if time.time() - lastprune >= 3600:
+                        self.prune()
+                        lastprune = time.time()
+            except sqlite3.Error as e:
+                self.error = str(e)
+            if batch[-1] is None:
+                break
+
+    def close(self):
+        # inserts everything queued before returning
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.conn.close()
+
+
+PERFINTERVAL = 3600
+
+class stagetimers:
+    # Calls, total and max nanoseconds (time.perf_counter_ns, monotonic) per stage of the record path and per periodic
+    # check, plus how often each reason bypassed a record.  Stages nest, e.g. printit() inside evaluatelog, so totals
+    # are inclusive.  One dict lookup and a few integer adds per measurement.
+    def __init__(self):
+        self.stages  = {}
+        self.reasons = collections.Counter()
+        self.started = time.time()
+
+    def add(self, name, started):
+        elapsed = time.perf_counter_ns() - started
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = [0, 0, 0]
+            self.stages[name] = stage
+        stage[0] = stage[0] + 1
+        stage[1] = stage[1] + elapsed
+        if elapsed > stage[2]:
+            stage[2] = elapsed
+
+    def bypassed(self, reason):
+        self.reasons[reason] += 1
+
+    def summary(self):
+        # one line per stage, most total time first
+        lines = []
+        for name, (calls, total, longest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append("%-28s calls=%-9d total=%10.1fms avg=%9.1fus max=%9.1fms" % (name, calls, total / 1e6, total / 1e3 / calls, longest / 1e6))
+        if self.reasons:
+            lines.append("bypassed: %s" % ', '.join(["%s=%d" % (reason, count) for reason, count in self.reasons.most_common()]))
+        return lines
+
+
+RATEFIELDS = ('sqlstate', 'database', 'user', 'application')
+
+class ratebaseline:
+    # What is a normal rate for every key: ('sqlstate', '55P03'), ('database', 'sales'), ..., ('log', 'lines') and
+    # ('log', 'bytes').  Events are only counted during a minute; when the minute is over every key's count is compared
+    # to its baseline and then folded into it.  The baseline is an EWMA and variance of the per-minute count, both
+    # for the last minutes and per hour of the week, so Monday 9:00 is compared to earlier Mondays at 9:00 once
+    # that slot has seen WARMUP minutes.  A count of at least minimum that is zscore deviations above it is an anomaly.
+    # Minutes are wall clock minutes, so the caller only counts lines it reads as they are logged and calls pause()
+    # while it is catching up on a backlog.  A minute we did not see from its start is dropped, not folded in.
+    # Constant work per event, fixed memory per key; only the hour of week slots are saved across runs.
+    ALPHA     = 0.1
+    WEEKALPHA = 0.05
+    WARMUP    = 30
+    COOLDOWN  = 900
+    MAXKEYS   = 2000
+    MAXIDLE   = 60
+    SLOTS     = 168
+
+    def __init__(self, zscore=4.0, minimum=50):
+        self.zscore  = zscore
+        self.minimum = minimum
+        self.counts  = collections.Counter()
+        # key -> [mean, variance, samples, last alert, hour of week slots or None]
+        self.stats   = {}
+        self.minute  = None
+        self.partial = False
+        self.saved   = time.time()
+
+    def add(self, key, amount=1):
+        self.counts[key] += amount
+
+    def addrecord(self, rec):
+        for field in RATEFIELDS:
+            value = rec.fields.get(field)
+            if value:
+                self.counts[(field, value)] += 1
+
+    def tick(self, now):
+        # returns the anomalies of the minutes that ended since the last tick: (key, count, mean, zscore, baseline)
+        minute = int(now // 60)
+        if self.minute is None:
+            self.minute  = minute
+            self.partial = True
+        if minute == self.minute:
+            return []
+        if self.partial:
+            # counted from somewhere in the middle of the minute
+            self.partial = False
+            self.counts  = collections.Counter()
+            self.minute  = minute
+            return []
+        anomalies = self.roll(self.counts, self.minute * 60)
+        # minutes without any events count as 0, a long idle stretch only up to MAXIDLE of them
+        for idle in range(self.minute + 1, min(minute, self.minute + 1 + self.MAXIDLE)):
+            anomalies = anomalies + self.roll({}, idle * 60)
+        self.counts = collections.Counter()
+        self.minute = minute
+        return anomalies
+
+    def pause(self):
+        # nothing counted so far is a rate; counting starts over with the next full minute
+        self.counts = collections.Counter()
+        self.minute = None
+
+    def slot(self, when):
+        moment = datetime.datetime.fromtimestamp(when)
+        return moment.weekday() * 24 + moment.hour
+
+    def roll(self, counts, when):
+        anomalies = []
+        slot = self.slot(when)
+        for key in list(self.stats.keys()) + [key for key in counts if key not in self.stats]:
+            count = counts.get(key, 0)
+            stat  = self.stats.get(key)
+            if stat is None:
+                if len(self.stats) >= self.MAXKEYS:
+                    continue
+                stat = [0.0, 0.0, 0, 0.0, None]
+                self.stats[key] = stat
+            if stat[4] is None:
+                stat[4] = [0.0, 0.0, 0] * self.SLOTS
+            week = stat[4]
+            index = slot * 3
+            if week[index + 2] >= self.WARMUP:
+                mean, variance, baseline = week[index], week[index + 1], 'hour of week'
+            elif stat[2] >= self.WARMUP:
+                mean, variance, baseline = stat[0], stat[1], 'recent'
+            else:
+                baseline = None
+            if baseline is not None and self.zscore > 0 and count >= self.minimum:
+                # a Poisson floor on the variance, so a very steady rate does not make every wobble an anomaly
+                zscore = (count - mean) / math.sqrt(max(variance, mean, 1.0))
+                if zscore >= self.zscore and when - stat[3] >= self.COOLDOWN:
+                    stat[3] = when
+                    anomalies.append((key, count, mean, zscore, baseline))
+            self.fold(stat, 0, count, self.ALPHA)
+            self.fold(week, index, count, self.WEEKALPHA)
+        return anomalies
+
+    def fold(self, state, index, count, alpha):
+        # EWMA and exponentially weighted variance, starting at the first sample instead of at 0
+        if state[index + 2] == 0:
+            state[index], state[index + 1] = float(count), 0.0
+        else:
+            diff = count - state[index]
+            state[index]     = state[index] + alpha * diff
+            state[index + 1] = (1 - alpha) * (state[index + 1] + alpha * diff * diff)
+        state[index + 2] = state[index + 2] + 1
+
+    def save(self, path):
+        # hour of week slots per key, written to a temp file and renamed like the checkpoints
+        baselines = {}
+        for key, stat in self.stats.items():
+            if stat[4] is not None:
+                baselines['%s\t%s' % key] = [round(value, 3) for value in stat[4]]
+        tmpfile = path + '.tmp'
+        try:
+            with open(tmpfile, 'w') as afile:
+                json.dump(baselines, afile)
+            os.replace(tmpfile, path)
+        except (IOError, OSError):
+            return ERR
+        self.saved = time.time()
+        return OK
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return NOTFOUND
+        try:
+            with open(path, 'r') as afile:
+                baselines = json.load(afile)
+        except (IOError, OSError, ValueError):
+            return ERR
+        for name, week in baselines.items():
+            field, sep, value = name.partition('\t')
+            if sep == '' or len(week) != self.SLOTS * 3 or len(self.stats) >= self.MAXKEYS:
+                continue
+            self.stats[(field, value)] = [0.0, 0.0, 0, 0.0, [float(item) for item in week]]
+        return OK
+
+    def describe(self, anomaly):
+        key, count, mean, zscore, baseline = anomaly
+        return "Rate anomaly: %s %s at %d/min, normal (%s) is %.1f/min (%.1f deviations above)." % (key[0], key[1], count, baseline, mean, zscore)
+
+
+# log_line_prefix escapes: (record field name or None, regex for the value).
+# Fields are captured once per line; everything else is just skipped over.
+PREFIXESCAPES = {
+    'a': ('application', r'.*?'),
+    'u': ('user',      r'.*?'),
+    'd': ('database',  r'.*?'),
+    'r': ('remote',    r'.*?'),
+    'h': ('remote',    r'.*?'),
+    'b': (None,        r'.*?'),
+    'p': ('pid',       r'\d+'),
+    'P': (None,        r'\d*'),
+    't': ('timestamp', r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?: [^ ]+)?'),
+    'm': ('timestamp', r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d+(?: [^ ]+)?'),
+    'n': ('timestamp', r'\d+\.\d+'),
+    'i': (None,        r'.*?'),
+    'e': ('sqlstate',  r'[0-9A-Z]{5}'),
+    'c': (None,        r'[0-9a-f]+\.[0-9a-f]+'),
+    'l': ('line',      r'\d+'),
+    's': (None,        r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?: [^ ]+)?'),
+    'v': (None,        r'[^ ]*?'),
+    'x': ('xid',       r'\d*'),
+    'Q': (None,        r'-?\d*'),
+}
+SEVERITIES = r'(?P<severity>DEBUG[1-5]?|LOG|INFO|NOTICE|WARNING|ERROR|FATAL|PANIC|DETAIL|HINT|CONTEXT|STATEMENT|QUERY|LOCATION):  (?P<message>.*)'
+COMPANIONS = ('DETAIL', 'HINT', 'CONTEXT', 'STATEMENT', 'QUERY', 'LOCATION')
+
+########################
+def compileprefix(log_line_prefix):
+    # compile log_line_prefix into one regex that splits a stderr log line into its prefix fields, severity and message.
+    # Returns None if there is no prefix to compile.  Without %p lines are still parsed but cannot be grouped into records.
+    if log_line_prefix is None or log_line_prefix.strip() == '':
+        return None
+    parts  = ['^']
+    groups = set()
+    optional = 0
+    i = 0
+    while i < len(log_line_prefix):
+        achar = log_line_prefix[i]
+        if achar != '%' or i + 1 >= len(log_line_prefix):
+            parts.append(re.escape(achar))
+            i = i + 1
+            continue
+        # optional padding like %-10u or %5p
+        j = i + 1
+        while j < len(log_line_prefix) and (log_line_prefix[j] == '-' or log_line_prefix[j].isdigit()):
+            j = j + 1
+        if j >= len(log_line_prefix):
+            break
+        escape = log_line_prefix[j]
+        padded = j > i + 1
+        i = j + 1
+        if escape == '%':
+            parts.append('%')
+        elif escape == 'q':
+            # everything after %q is only written by session processes
+            parts.append('(?:')
+            optional = optional + 1
+        elif escape in PREFIXESCAPES:
+            name, pattern = PREFIXESCAPES[escape]
+            if name is not None and name not in groups:
+                groups.add(name)
+                pattern = '(?P<%s>%s)' % (name, pattern)
+            else:
+                pattern = '(?:%s)' % pattern
+            if padded:
+                pattern = ' *%s *' % pattern
+            parts.append(pattern)
+        else:
+            # unknown escapes are written out as nothing
+            pass
+    parts.append(')?' * optional)
+    parts.append(SEVERITIES)
+    try:
+        return re.compile(''.join(parts))
+    except re.error:
+        return None
+
+
+class logrecord:
+    # one logical PG log message: the primary line plus its DETAIL/HINT/CONTEXT/STATEMENT/... and continuation lines
+    def __init__(self, line, match=None):
+        self.lines     = [line]
+        self.msg       = line
+        self.pid       = None
+        self.lastline  = None
+        self.severity  = ''
+        self.excluded  = False
+        self.touched   = time.time()
+        self.fields    = {}
+        self.hits      = set()
+        self.lockwait  = None
+        self.when      = None
+        self.position  = None
+        # what decided about the record: the rule that alerted or bypassed it, and why it was bypassed
+        self.rule      = ''
+        self.reason    = ''
+        self.sqlstate  = ''
+        self.fingerprint = None
+        if match is not None:
+            # parsed once here, every downstream check reuses these instead of searching the message again
+            self.fields   = match.groupdict()
+            self.pid      = self.fields.get('pid')
+            self.severity = self.fields.get('severity')
+            if self.fields.get('line') is not None:
+                self.lastline = int(self.fields['line'])
+
+    def add(self, line, lineno=None):
+        if len(self.lines) < recordassembler.MAXLINES:
+            self.lines.append(line)
+        if lineno is not None:
+            self.lastline = lineno
+        self.touched = time.time()
+
+    def finish(self):
+        self.msg = '\n'.join(self.lines)
+        return self
+
+    def timestamp(self):
+        # yyyy-mm-dd hh:mm:ss of the message from %m/%t/%n, or the start of the line if the prefix has no timestamp
+        value = self.fields.get('timestamp')
+        if value is None:
+            return self.msg.strip()[0:19]
+        if value.find('-') < 0:
+            # %n is a unix epoch with milliseconds
+            try:
+                return datetime.datetime.fromtimestamp(float(value)).strftime("%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                pass
+        return value[0:19]
+
+
+class recordassembler:
+    # Groups the physical lines of one PG message into a single logrecord keyed by backend pid and session line number (%l).
+    # Companion lines must carry the next %l of the same pid; tab-indented continuation lines belong to whatever record
+    # took the previous line.  Records are handed out when their pid starts a new message, when they have been idle for
+    # WINDOW seconds, or when more than MAXOPEN are waiting.  GREPFILTER selects primary lines, GREPEXCLUDE drops lines.
+    WINDOW   = 2
+    MAXOPEN  = 1000
+    MAXLINES = 500
+    COMPANIONHINT = re.compile(r'(?:DETAIL|HINT|CONTEXT|STATEMENT|QUERY|LOCATION):  ')
+
+    def __init__(self, follower):
+        self.follower = follower
+        self.parser   = None
+        self.window   = self.WINDOW
+        self.records  = {}
+        self.last     = None
+
+    def pending(self):
+        return len(self.records) > 0
+
+    def openpositions(self):
+        # where the records we still hold start
+        return [record.position for record in self.records.values()]
+
+    def provides(self, field):
+        return self.parser is not None and field in self.parser.groupindex
+
+    def feed(self, lines):
+        results  = []
+        matcher  = self.follower.matcher
+        nofilter = not matcher.has('filter')
+        grouping = self.parser is not None and 'pid' in self.parser.groupindex
+        # one scan of the batch tells us about GREPFILTER and GREPEXCLUDE both
+        for index, (line, hits) in enumerate(zip(lines, matcher.scanlines(lines))):
+            if not grouping:
+                # no %p in log_line_prefix: every matching line is a record of its own, like before
+                if self.follower.matches(line, hits):
+                    record = logrecord(line, None if self.parser is None else self.parser.match(line))
+                    record.position = self.follower.position(index)
+                    results.append(record)
+                continue
+
+            if line[0:1] == '\t' or line[0:1] == ' ':
+                # continuation of the previous physical line
+                if self.last is not None and 'exclude' not in hits:
+                    self.last.add(line)
+                continue
+
+            filterhit  = nofilter or 'filter' in hits
+            if not filterhit and (len(self.records) == 0 or self.COMPANIONHINT.search(line) is None):
+                # neither interesting on its own nor possibly part of a record we are assembling
+                self.last = None
+                continue
+
+            match = self.parser.match(line)
+            if match is None:
+                self.last = None
+                if self.follower.matches(line, hits):
+                    record = logrecord(line)
+                    record.position = self.follower.position(index)
+                    results.append(record)
+                continue
+
+            excluded = 'exclude' in hits
+            pid      = match.group('pid')
+            lineno   = None
+            if 'line' in self.parser.groupindex and match.group('line') is not None:
+                lineno = int(match.group('line'))
+            record   = self.records.get(pid)
+
+            if match.group('severity') in COMPANIONS:
+                if record is not None and (lineno is None or record.lastline is None or lineno == record.lastline + 1):
+                    if excluded:
+                        record.lastline = lineno
+                        self.last = None
+                    else:
+                        record.add(line, lineno)
+                        self.last = record
+                    continue
+                # companion of something we did not keep: evaluate on its own if it matches, like before
+                self.last = None
+                if filterhit and not excluded:
+                    record = logrecord(line, match)
+                    record.position = self.follower.position(index)
+                    results.append(record)
+                continue
+
+            # a new primary line means whatever this pid had open is complete
+            if record is not None:
+                del self.records[pid]
+                if not record.excluded:
+                    results.append(record.finish())
+            self.last = None
+            if filterhit:
+                record = logrecord(line, match)
+                record.position = self.follower.position(index)
+                # an excluded primary still swallows its companion lines
+                record.excluded = excluded
+                self.records[pid] = record
+                if not excluded:
+                    self.last = record
+                if len(self.records) > self.MAXOPEN:
+                    oldest = next(iter(self.records))
+                    record = self.records.pop(oldest)
+                    if not record.excluded:
+                        results.append(record.finish())
+        return results
+
+    def flush(self, force=False):
+        # hand out records that have not seen a new line for WINDOW seconds (or all of them when forced)
+        results = []
+        if len(self.records) == 0:
+            return results
+        cutoff = time.time() - self.window
+        for pid in list(self.records.keys()):
+            record = self.records[pid]
+            if force or record.touched <= cutoff:
+                del self.records[pid]
+                if record is self.last:
+                    self.last = None
+                if not record.excluded:
+                    results.append(record.finish())
+        return results
+
+
+# csvlog columns (PG 13+ adds backend_type, 14+ leader_pid and query_id at the end; we only need the first 23)
+CSVCOLUMNS = ('timestamp', 'user', 'database', 'pid', 'remote', 'session', 'line', 'command', 'sessionstart', 'vxid', 'xid',
+              'severity', 'sqlstate', 'message', 'detail', 'hint', 'internalquery', 'internalpos', 'context', 'statement',
+              'querypos', 'location', 'application')
+# jsonlog keys mapped to the same field names
+JSONKEYS = {'timestamp': 'timestamp', 'user': 'user', 'dbname': 'database', 'pid': 'pid', 'remote_host': 'remote',
+            'session_id': 'session', 'line_num': 'line', 'ps': 'command', 'vxid': 'vxid', 'txid': 'xid',
+            'error_severity': 'severity', 'state_code': 'sqlstate', 'message': 'message', 'detail': 'detail', 'hint': 'hint',
+            'internal_query': 'internalquery', 'context': 'context', 'statement': 'statement', 'application_name': 'application'}
+# companion fields of a structured record, written back out the way stderr would have them
+STRUCTUREDCOMPANIONS = (('detail', 'DETAIL'), ('hint', 'HINT'), ('internalquery', 'QUERY'), ('context', 'CONTEXT'), ('statement', 'STATEMENT'))
+
+
+def greplines(matcher, lines):
+    # the lines of a record that is evaluated if any of its lines would have been grepped, with the GREPEXCLUDE lines
+    # left out.  None if no line was grepped or the primary (first) line is excluded.
+    kept    = []
+    grepped = not matcher.has('filter')
+    for index, aline in enumerate(lines):
+        hits = matcher.scan(aline)
+        if 'exclude' in hits:
+            if index == 0:
+                return None
+            continue
+        if 'filter' in hits:
+            grepped = True
+        kept.append(aline)
+    if not grepped:
+        return None
+    return kept
+
+
+class structuredassembler:
+    # Base for csvlog/jsonlog.  Every PG message is already one record with explicit fields, so there is nothing to group by pid.
+    # The record text is rebuilt in stderr form (primary line plus DETAIL/HINT/... lines) so GREPFILTER, GREPEXCLUDE and the
+    # message checks see the same thing they would see in a stderr log; sqlstate, application, etc. come from the fields.
+    WINDOW = 2
+
+    def __init__(self, follower):
+        self.follower = follower
+        self.parser   = None
+        self.window   = self.WINDOW
+        self.invalid  = 0
+
+    def provides(self, field):
+        return True
+
+    def openpositions(self):
+        return []
+
+    def torecord(self, fields):
+        fields['pid']  = str(fields.get('pid') or '')
+        fields['line'] = str(fields.get('line') or '')
+        primary = "%s [%s] %s@%s [%s] %s %s:  %s" % (fields.get('timestamp') or '', fields['pid'], fields.get('user') or '', fields.get('database') or '',
+                  fields.get('application') or '', fields.get('sqlstate') or '', fields.get('severity') or '', fields.get('message') or '')
+        lines = [primary]
+        for name, label in STRUCTUREDCOMPANIONS:
+            value = fields.get(name)
+            if value:
+                lines.append("%s:  %s" % (label, value))
+
+        lines = greplines(self.follower.matcher, lines)
+        if lines is None:
+            return None
+
+        record = logrecord(primary)
+        record.fields   = fields
+        record.pid      = fields['pid']
+        record.severity = fields.get('severity') or ''
+        record.lines    = lines
+        return record.finish()
+
+
+class csvassembler(structuredassembler):
+    # log_destination=csvlog.  A record ends at a newline outside of quotes, so quoted multi-line messages and queries are
+    # buffered line by line until the quote count is balanced and only then handed to the csv module.
+    def __init__(self, follower):
+        structuredassembler.__init__(self, follower)
+        self.buffer  = []
+        self.odd     = False
+        self.touched = time.time()
+        self.bufferposition = None
+
+    def pending(self):
+        return len(self.buffer) > 0
+
+    def openpositions(self):
+        return [self.bufferposition] if self.buffer else []
+
+    def parse(self, text):
+        try:
+            row = next(csv.reader([text]))
+        except (csv.Error, StopIteration):
+            row = []
+        if len(row) < len(CSVCOLUMNS):
+            self.invalid = self.invalid + 1
+            # not a csvlog record: evaluate it as plain text, like before
+            if self.follower.matches(text):
+                return logrecord(text)
+            return None
+        return self.torecord(dict(zip(CSVCOLUMNS, row)))
+
+    def feed(self, lines):
+        results = []
+        for index, line in enumerate(lines):
+            if line.count('"') % 2 == 1:
+                self.odd = not self.odd
+            if len(self.buffer) == 0:
+                self.bufferposition = self.follower.position(index)
+            self.buffer.append(line)
+            if self.odd:
+                continue
+            text = self.buffer[0] if len(self.buffer) == 1 else '\n'.join(self.buffer)
+            self.buffer = []
+            record = self.parse(text)
+            if record is not None:
+                record.position = self.bufferposition
+                results.append(record)
+        if self.buffer:
+            self.touched = time.time()
+        return results
+
+    def flush(self, force=False):
+        # a record that stays unbalanced for WINDOW seconds is broken; hand it out for what it is worth
+        if not self.buffer or (not force and self.touched > time.time() - self.window):
+            return []
+        text = '\n'.join(self.buffer)
+        self.buffer = []
+        self.odd    = False
+        record = self.parse(text + '"')
+        if record is None:
+            return []
+        record.position = self.bufferposition
+        return [record]
+
+
+class jsonassembler(structuredassembler):
+    # log_destination=jsonlog (PG 15+).  One json object per line, newlines inside values are escaped.
+    def pending(self):
+        return False
+
+    def feed(self, lines):
+        results = []
+        for index, line in enumerate(lines):
+            if line == '':
+                continue
+            try:
+                values = json.loads(line)
+            except ValueError:
+                values = None
+            if not isinstance(values, dict):
+                self.invalid = self.invalid + 1
+                if self.follower.matches(line):
+                    record = logrecord(line)
+                    record.position = self.follower.position(index)
+                    results.append(record)
+                continue
+            # jsonlog leaves out empty values
+            fields = dict.fromkeys(JSONKEYS.values(), '')
+            for key, name in JSONKEYS.items():
+                if key in values:
+                    fields[name] = values[key]
+            if 'remote_port' in values:
+                fields['remote'] = "%s(%s)" % (fields['remote'], values['remote_port'])
+            for name in ('line', 'xid'):
+                if name in fields:
+                    fields[name] = str(fields[name])
+            record = self.torecord(fields)
+            if record is not None:
+                record.position = self.follower.position(index)
+                results.append(record)
+        return results
+
+    def flush(self, force=False):
+        return []
+
+
+class replayfilter:
+    # Rejects log records that were evaluated before, by where they come from instead of by timestamp.  Per source
+    # (log file identity and generation) there is a floor: release() moves it up to the lowest offset a record not
+    # handed out yet can start at (the oldest record the assembler still holds, or the first unread byte).  Records
+    # from the assembler may come out of order above the floor, so the offsets seen there are kept until the floor
+    # passes them.  An offset seen before, or below the floor, is a replay.  O(log n) per record.
+    MAXSOURCES = 50
+
+    def __init__(self):
+        self.sources  = collections.OrderedDict()
+        self.replayed = 0
+
+    def state(self, source):
+        state = self.sources.get(source)
+        if state is None:
+            # floor, offsets seen at or above it, the same offsets as a heap
+            state = [0, set(), []]
+            self.sources[source] = state
+            if len(self.sources) > self.MAXSOURCES:
+                self.sources.popitem(last=False)
+        return state
+
+    def accept(self, position):
+        if position is None:
+            return True
+        source, offset = position
+        state = self.state(source)
+        if offset < state[0] or offset in state[1]:
+            self.replayed = self.replayed + 1
+            return False
+        state[1].add(offset)
+        heapq.heappush(state[2], offset)
+        return True
+
+    def release(self, source, offset):
+        # every record of source starting below offset has been handed out and evaluated
+        state = self.state(source)
+        if offset <= state[0]:
+            return
+        state[0] = offset
+        while state[2] and state[2][0] < offset:
+            state[1].discard(heapq.heappop(state[2]))
+
+
+class inotifier:
+    # minimal ctypes wrapper around linux inotify so we do not need any extra python packages.
+    IN_MODIFY      = 0x00000002
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_NONBLOCK    = 0x00000800
+    EVENTHDR       = struct.calcsize('iIII')
+
+    def __init__(self):
+        self.fd      = -1
+        self.watches = {}
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.fd   = self.libc.inotify_init1(self.IN_NONBLOCK)
+        except (OSError, AttributeError):
+            self.fd   = -1
+
+    def available(self):
+        return self.fd > -1
+
+    def addwatch(self, path, mask):
+        if self.fd < 0:
+            return NOTFOUND
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            return NOTFOUND
+        self.watches[wd] = path
+        return wd
+
+    def removewatch(self, wd):
+        if self.fd < 0 or wd not in self.watches:
+            return OK
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.watches[wd]
+        return OK
+
+    def wait(self, seconds):
+        # returns a list of (watched path, mask, name) events, empty if we timed out
+        events = []
+        if self.fd < 0:
+            return events
+        try:
+            ready, _, _ = select.select([self.fd], [], [], seconds)
+        except (OSError, ValueError):
+            return events
+        if not ready:
+            return events
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError:
+            return events
+        pos = 0
+        while pos + self.EVENTHDR <= len(buf):
+            wd, mask, cookie, namelen = struct.unpack_from('iIII', buf, pos)
+            name = buf[pos + self.EVENTHDR:pos + self.EVENTHDR + namelen].rstrip(b'\0').decode('utf-8', 'replace')
+            events.append((self.watches.get(wd, ''), mask, name))
+            pos = pos + self.EVENTHDR + namelen
+        return events
+
+    def close(self):
+        if self.fd > -1:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def linetime(aline):
+    # the "YYYY-MM-DD HH:MM:SS" a raw stderr/csvlog or jsonlog line starts with, "" for continuation lines
+    if aline[0:4].isdigit() and aline[4:5] == b'-':
+        return aline[0:19].decode('utf-8', 'replace')
+    if aline[0:14] == b'{"timestamp":"':
+        return aline[14:33].decode('utf-8', 'replace')
+    return ""
+
+
+class logfollower:
+    # Follows the PG log file directly, replacing the old "cat/tail -f | grep | grep -v >> alerts file" pipeline.
+    # Lines are read in byte chunks, filtered in-process with the compiled GREPFILTER/GREPEXCLUDE matchers
+    # and handed back in batches.  New data is waited for with inotify, falling back to polling the file size.
+    # The position of the last evaluated line is checkpointed as (device, inode, byte offset, last timestamp)
+    # per log file, so restarts and refreshes resume exactly where we stopped instead of rescanning the log.
+    # Rotation (a new log file, the same name pointing to a new inode, or truncation) is handled here too:
+    # the old file is always drained to EOF before we switch to the new one at offset 0.
+    CHUNKSIZE = 8 * 1024 * 1024
+    MAXCHECKPOINTS = 50
+
+    def __init__(self):
+        self.logfile  = ""
+        self.afile    = None
+        self.offset   = 0
+        self.partial  = b''
+        self.matcher  = patternmatcher()
+        self.notifier = inotifier()
+        self.wd       = NOTFOUND
+        self.linesread = 0
+        self.bytesread = 0
+        self.lasttime = ""
+        # RDS log files are downloaded again on every refresh, so they are identified by name, not inode.
+        self.byname   = False
+        self.checkpointfile = ""
+        self.checkpoints    = {}
+        self.checkpointed   = 0
+        # log file to switch to once the current one is drained, e.g., pg_current_logfile() changed
+        self.pendingfile    = ""
+        # set when a file is created in the log directory, so the caller can check pg_current_logfile() right away
+        self.newfileseen    = False
+        self.rotations      = 0
+        self.log            = None
+        # where the lines of the last readlines() batch came from, so records can carry their (source, offset) position.
+        # The source is the file identity plus a generation that goes up when the same local file is read again from an
+        # earlier offset (truncated), so those lines are new, not a replay.
+        self.ident          = None
+        self.generation     = 0
+        # pg_alert.conf is watched with the same inotify instance, so a config change wakes up wait() like new log lines
+        self.configfile     = ""
+        self.configwd       = NOTFOUND
+        self.configchanged  = False
+        self.chunkstart     = 0
+        self.chunklines     = None
+        self.linestarts     = None
+
+    def setmatcher(self, matcher):
+        self.matcher = matcher
+
+    def loadcheckpoints(self, checkpointfile):
+        self.checkpointfile = checkpointfile
+        self.checkpoints    = {}
+        if not os.path.exists(checkpointfile):
+            return OK
+        try:
+            with open(checkpointfile, 'r') as afile:
+                self.checkpoints = json.load(afile)
+        except (IOError, ValueError):
+            # a corrupt checkpoint file just means we start over
+            self.checkpoints = {}
+            return ERR
+        return OK
+
+    def savecheckpoint(self, force=False):
+        # at most once a second unless forced, written to a temp file and renamed so it is never half written
+        if self.checkpointfile == '' or self.afile is None:
+            return OK
+        if not force and time.time() - self.checkpointed < 1:
+            return OK
+        st = os.fstat(self.afile.fileno())
+        self.checkpoints[self.logfile] = {'dev': st.st_dev, 'ino': st.st_ino, 'offset': self.offset, 'lasttime': self.lasttime, 'saved': time.time()}
+        if len(self.checkpoints) > self.MAXCHECKPOINTS:
+            oldest = sorted(self.checkpoints, key=lambda k: self.checkpoints[k].get('saved', 0))
+            for key in oldest[0:len(self.checkpoints) - self.MAXCHECKPOINTS]:
+                del self.checkpoints[key]
+        tmpfile = self.checkpointfile + '.tmp'
+        try:
+            with open(tmpfile, 'w') as afile:
+                json.dump(self.checkpoints, afile)
+            os.replace(tmpfile, self.checkpointfile)
+        except (IOError, OSError):
+            return ERR
+        self.checkpointed = time.time()
+        return OK
+
+    def resumeoffset(self, logfile, st):
+        # where to start reading logfile: our current position if we are already on it, otherwise the saved checkpoint.
+        if logfile == self.logfile and self.afile is not None:
+            cst = os.fstat(self.afile.fileno())
+            if (self.byname or (cst.st_dev, cst.st_ino) == (st.st_dev, st.st_ino)) and st.st_size >= self.offset \
+               and self.unchanged(logfile, self.offset, self.lasttime):
+                return self.offset, self.lasttime
+        entry = self.checkpoints.get(logfile)
+        if entry is None:
+            return 0, ""
+        if not self.byname and (entry['dev'], entry['ino']) != (st.st_dev, st.st_ino):
+            # same name but a different file, i.e., log_filename wrapped around (postgresql-%a.log)
+            return 0, ""
+        if st.st_size < entry['offset']:
+            # truncated since we last saw it
+            return 0, ""
+        if not self.unchanged(logfile, entry['offset'], entry.get('lasttime', '')):
+            # truncated in place (log_truncate_on_rotation) and grown past the old offset again
+            return 0, ""
+        return entry['offset'], entry.get('lasttime', '')
+
+    def unchanged(self, logfile, offset, lasttime):
+        # same file and big enough is not proof we are still on the lines we read: postgresql-%a.log with
+        # log_truncate_on_rotation keeps its inode and may have grown past our offset again by the time we look.
+        # The offset still holds if it ends a line and neither the first line nor the line before it is newer than lasttime.
+        if offset == 0 or lasttime == "":
+            return True
+        start = max(0, offset - 4096)
+        try:
+            with open(logfile, 'rb') as afile:
+                first = afile.readline(4096)
+                afile.seek(start)
+                before = afile.read(offset - start)
+        except (IOError, OSError):
+            return True
+        if not before.endswith(b'\n'):
+            return False
+        for aline in (first, before[:-1].rsplit(b'\n', 1)[-1]):
+            if linetime(aline) > lasttime:
+                return False
+        return True
+
+    def open(self, logfile, offset=None):
+        # offset=None means resume from our current position or checkpoint, if any
+        st = os.stat(logfile)
+        lasttime = ""
+        if offset is None:
+            offset, lasttime = self.resumeoffset(logfile, st)
+        # a downloaded RDS log file read again from the start is the same log again, a truncated local file is not
+        ident = logfile if self.byname else (st.st_dev, st.st_ino)
+        if ident == self.ident and offset < self.offset and not self.byname:
+            self.generation = self.generation + 1
+        self.ident = ident
+        self.close()
+        self.afile   = open(logfile, 'rb')
+        self.logfile = logfile
+        self.afile.seek(offset)
+        self.offset  = offset
+        self.lasttime = lasttime
+        self.partial = b''
+        if self.pendingfile == logfile:
+            self.pendingfile = ""
+        if self.notifier.available():
+            # watch the log directory, not just the file, so we also hear about new log files
+            self.wd = self.notifier.addwatch(os.path.dirname(os.path.abspath(logfile)), inotifier.IN_MODIFY | inotifier.IN_CREATE | inotifier.IN_MOVED_TO)
+        return OK
+
+    def switchto(self, logfile):
+        # switch to a new log file, but only after the current one has been read to EOF
+        if logfile == self.logfile or logfile == self.pendingfile:
+            return OK
+        self.pendingfile = logfile
+        return OK
+
+    def rotationpending(self):
+        # True if we have to move off the current file once it is drained: a pending switch, the log file name
+        # now points to another inode (renamed away and recreated) or the file was truncated under us.
+        if self.pendingfile != '':
+            return True
+        if self.byname or self.afile is None:
+            # RDS log files are replaced by every download, the refresh logic handles them.
+            return False
+        try:
+            st  = os.stat(self.logfile)
+            fst = os.fstat(self.afile.fileno())
+        except OSError:
+            return False
+        if (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino):
+            return True
+        if st.st_size < self.offset:
+            return True
+        return False
+
+    def rotate(self):
+        # called when the current file is at EOF.  Returns whatever was left of the old file.
+        if not self.rotationpending():
+            return []
+        lines = []
+        if self.partial != b'':
+            # the last line of the old file never got its newline
+            lines.append(self.partial.decode('utf-8', 'replace'))
+            self.partial = b''
+        if self.pendingfile != '':
+            target = self.pendingfile
+            reason = "new log file"
+        else:
+            target = self.logfile
+            st = os.stat(self.logfile)
+            if st.st_ino == os.fstat(self.afile.fileno()).st_ino:
+                reason = "log file truncated"
+            else:
+                reason = "log file replaced"
+        oldfile = self.logfile
+        try:
+            self.open(target, 0)
+        except (IOError, OSError) as e:
+            if self.log is not None:
+                self.log("Unable to switch to log file, %s. %s" % (target, e))
+            return lines
+        self.rotations = self.rotations + 1
+        if self.log is not None:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.log("%s: Log rotation (%s): drained %s, now following %s from offset 0." % (now, reason, oldfile, target))
+        return lines
+
+    def watchconfig(self, configfile):
+        # Its directory is watched, not the file, because editors and config tools usually replace the file.
+        # Returns NOTFOUND without inotify; the caller then has to stat() the file itself.
+        self.configfile = os.path.abspath(configfile)
+        if self.notifier.available():
+            self.configwd = self.notifier.addwatch(os.path.dirname(self.configfile), inotifier.IN_MODIFY | inotifier.IN_CREATE | inotifier.IN_MOVED_TO)
+        return self.configwd
+
+    def close(self):
+        if self.wd != NOTFOUND:
+            # the config file may live in the log directory, then both share one watch
+            if self.wd != self.configwd:
+                self.notifier.removewatch(self.wd)
+            self.wd = NOTFOUND
+        if self.afile is not None:
+            self.afile.close()
+            self.afile = None
+
+    def matches(self, line, hits=None):
+        # GREPFILTER hit (or no GREPFILTER at all) and no GREPEXCLUDE hit
+        if hits is None:
+            hits = self.matcher.scan(line)
+        if 'exclude' in hits:
+            return False
+        return 'filter' in hits or not self.matcher.has('filter')
+
+    def readlines(self):
+        # return every complete line available right now.  A trailing partial line is kept for the next call.
+        # Filtering is up to the record assembler, which needs to see companion lines that do not match GREPFILTER.
+        if self.afile is None:
+            return []
+        data = self.afile.read(self.CHUNKSIZE)
+        if not data:
+            self.chunklines = None
+            return self.rotate()
+        self.chunkstart = self.offset
+        self.bytesread = self.bytesread + len(data)
+        data  = self.partial + data
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        self.chunklines = lines
+        self.linestarts = None
+        self.offset  = self.afile.tell() - len(self.partial)
+        self.linesread = self.linesread + len(lines)
+        if lines and linetime(lines[-1]) != "":
+            self.lasttime = linetime(lines[-1])
+        return [aline.decode('utf-8', 'replace') for aline in lines]
+
+    def position(self, index):
+        # (source, byte offset) of line index of the last readlines() batch, None if unknown
+        if self.chunklines is None or index >= len(self.chunklines):
+            return None
+        if self.linestarts is None:
+            # only worked out for batches that produce a record
+            self.linestarts = [0]
+            self.linestarts.extend(itertools.accumulate([len(aline) + 1 for aline in self.chunklines]))
+        return ((self.ident, self.generation), self.chunkstart + self.linestarts[index])
+
+    def atEOF(self):
+        # a pending rotation means there is more to do, so that is not EOF
+        if self.afile is None:
+            return True
+        try:
+            if os.fstat(self.afile.fileno()).st_size > self.afile.tell():
+                return False
+        except OSError:
+            return True
+        return not self.rotationpending()
+
+    def wait(self, seconds):
+        # block only while we are really at EOF: return as soon as the log grows, rotates, a new log file shows up
+        # in the log directory, pg_alert.conf changes, or after seconds elapsed.
+        if not self.atEOF():
+            return True
+        deadline = time.time() + seconds
+        logdir = os.path.dirname(os.path.abspath(self.logfile))
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self.wd != NOTFOUND:
+                for path, mask, name in self.notifier.wait(remaining):
+                    if self.configfile != '' and os.path.join(path, name) == self.configfile:
+                        self.configchanged = True
+                    elif mask & (inotifier.IN_CREATE | inotifier.IN_MOVED_TO) and path == logdir and not self.byname:
+                        self.newfileseen = True
+                if self.newfileseen or self.configchanged:
+                    return True
+            else:
+                time.sleep(min(remaining, 0.2))
+            if not self.atEOF():
+                return True
+
+
+CONFIGDEFAULTS = {'sqlstate':'', 'sqlclass':'', 'lockwait':'', 'checkinterval':'', \
+                 'loadthreshold':'', 'dirthreshold':'', 'idletransthreshold':'', 'querytransthreshold':'', 'pgsql_tmp_threshold':'', 'lockfilter':'', \
+                 'pglog_directory':'', 'alert_directory':'', 'ignore_autovacdaemon':'True', 'ignore_uservac':'True', 'tempbytesthreshold':'', 'slaves':'', \
+                 'monitorlag':'False', 'alert_stmt_timeout':'False', 'ignoreapps':'', 'ignoreusers':'','ignorequeries':'', 'suspended':'False', \
+                 'mail_method':'', 'smtp_server':'', 'smtp_account':'', 'smtp_port':'', 'smtp_password':'', 'sms':'', 'grepfilter':'', 'grepexclude':'', 'log_format':'stderr', \
+                 'lockwait_percentile':'', 'lockwait_window':'', 'fingerprint_window':'', \
+                 'ratelimit_key':'', 'ratelimit_burst':'', 'ratelimit_per_minute':'', 'anomaly_zscore':'', 'anomaly_minimum':'', 'history_flush':'', 'history_fsync':'False', 'history_format':'text', 'history_maxsize':'', 'stage_timers':'False',
+                 'keeplogmb':'', 'compresslogdays':'', 'eventstore':'False', 'eventstore_days':''}
+
+# what a reload rebuilds for which changed options (see pgmon.reloadconfig).  Other dynamic options are plain values
+# that are simply set again; RELOADRESTART options are only read at startup.  [rule:NAME] sections rebuild the matcher.
+RELOADMATCHER  = frozenset(['grepfilter', 'grepexclude', 'lockfilter', 'ignoreapps'])
+RELOADRULES    = frozenset(['lockwait', 'lockwait_percentile', 'alert_stmt_timeout'])
+RELOADSQLSTATE = frozenset(['sqlstate', 'sqlclass'])
+RELOADMAIL     = frozenset(['to', 'from', 'emailalerts', 'mail_method', 'mailx_format', 'smtp_server', 'smtp_port', 'smtp_account', 'smtp_password', 'sms'])
+RELOADRESTART  = frozenset(['clusterid', 'alertlog_directory', 'minutes', 'refresh', 'rds', 'dbid', 'dbname', 'dbuser', 'dbhost', 'dbport',
+                            'cpus', 'pglog_directory', 'keeplogdays', 'log_format', 'history_format', 'eventstore'])
+
+
+class configsnapshot:
+    # one parse of pg_alert.conf.  Read only: get, getboolean, sections and has_section like configparser, nothing
+    # to set, so whoever holds a snapshot sees the same values for as long as they keep it.
+    __slots__ = ('parser', 'key')
+
+    def __init__(self, parser, key):
+        object.__setattr__(self, 'parser', parser)
+        object.__setattr__(self, 'key', key)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("config snapshots are read only")
+
+    def get(self, section, option, **kwargs):
+        return self.parser.get(section, option, **kwargs)
+
+    def getboolean(self, section, option, **kwargs):
+        return self.parser.getboolean(section, option, **kwargs)
+
+    def sections(self):
+        return self.parser.sections()
+
+    def has_section(self, section):
+        return self.parser.has_section(section)
+
+    def values(self):
+        # {section: {option: raw value}}, the defaults show up in every section
+        return dict([(section, dict(self.parser.items(section, raw=True))) for section in self.parser.sections()])
+
+    def diff(self, other):
+        # names of the options whose values differ between two snapshots.  A [rule:NAME] section that was added,
+        # removed or edited is reported as a whole by its section name.
+        mine   = self.values()
+        theirs = other.values()
+        changed = set()
+        for section in set(mine) | set(theirs):
+            old = mine.get(section, {})
+            new = theirs.get(section, {})
+            if section.startswith('rule:'):
+                if old != new:
+                    changed.add(section)
+                continue
+            for option in set(old) | set(new):
+                if old.get(option) != new.get(option):
+                    changed.add(option)
+        return changed
+
+
+class configcache:
+    # Parses pg_alert.conf again only when the file changed: its inode (replaced by an editor or a config tool),
+    # mtime or size differs from the snapshot we have.  That costs one stat() per call instead of an open and a
+    # parse.  If the file cannot be stat()ed for a moment (being replaced) the last snapshot is kept, and so it is
+    # if the changed file cannot be parsed; error says why until the file changes again.
+    def __init__(self, configfile, defaults=CONFIGDEFAULTS):
+        self.configfile = configfile
+        self.defaults   = defaults
+        self.current    = None
+        self.reloads    = 0
+        self.error      = ''
+        self.failedkey  = None
+
+    def stat(self):
+        try:
+            st = os.stat(self.configfile)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        key = self.stat()
+        return self.current is None or (key is not None and key != self.current.key and key != self.failedkey)
+
+    def invalidate(self):
+        # next snapshot() parses the file whatever stat() says, e.g. after a signal
+        self.failedkey = None
+        if self.current is not None:
+            self.current = configsnapshot(self.current.parser, None)
+
+    def snapshot(self):
+        if not self.changed():
+            return self.current
+        key = self.stat()
+        parser = configparser.SafeConfigParser(self.defaults)
+        try:
+            parser.read(self.configfile)
+        except configparser.Error as e:
+            if self.current is None:
+                raise
+            self.error     = str(e)
+            self.failedkey = key
+            return self.current
+        self.error     = ''
+        self.failedkey = None
+        self.current   = configsnapshot(parser, key)
+        self.reloads = self.reloads + 1
+        return self.current
+
 
 class pgmon:
     def __init__(self):
@@ -166,8 +2152,30 @@ class pgmon:
         self.sms           = ""
 
         self.configfile    = ""
-        self.logalert      = ""
+        self.configs       = None
+        # the snapshot the running values were read from, and SIGHUP asking for a reload
+        self.runningconfig   = None
+        self.reloadrequested = False
         self.loghistory    = ""
+        # v3.2: historywriter for loghistory, with HISTORY_FLUSH seconds and HISTORY_FSYNC
+        self.history       = None
+        self.historyflush  = 1.0
+        self.historyfsync  = False
+        # v3.2: HISTORY_FORMAT=json writes one JSON object per event, HISTORY_MAXSIZE cuts the file into segments
+        self.historyformat = 'text'
+        self.historymaxsize = 100
+        # v3.2: retentionservice for ALERTLOG_DIRECTORY: KEEPLOGDAYS, KEEPLOGMB and COMPRESSLOGDAYS
+        self.retention     = None
+        self.keeplogmb     = 0
+        self.compresslogdays = 1
+        # v3.2: EVENTSTORE=yes keeps every evaluated record in an eventstore, rows of the current batch wait in storerows
+        self.store         = None
+        self.storerows     = None
+        self.storedays     = 30
+        # when the last alert went out (or the store was opened), see eventstore.alerted()
+        self.storesent     = 0
+        # backfill: the event store every worker opens for itself
+        self.storepath     = ''
         self.pidfile       = ""
         self.sendemail     = False
         self.ignore_autovacdaemon = True
@@ -184,7 +2192,10 @@ class pgmon:
         self.end           = self.endd.strftime("%Y-%m-%d %H:%M:%S")    
         self.time_start    = time.time()
         self.refreshed     = time.time()
-        self.alert         = None
+        # in-process follower of the PG log file (replaces the tail/grep pipeline)
+        self.follower      = logfollower()
+        # groups the physical lines of one PG message into a single record
+        self.assembler     = recordassembler(self.follower)
         self.processname   = "pg_alert"
         self.to            = ""
         self.subject       = 'pg_alert'
@@ -203,6 +2214,12 @@ class pgmon:
         self.sqlclass      = ""
         self.sqlstates     = []
         self.sqlclasses    = []
+        # built from sqlstates/sqlclasses by buildsqlstatefilter(): decision per sqlstate seen and bypass counts per reason
+        self.sqlstateset       = frozenset()
+        self.sqlclassset       = frozenset()
+        self.sqlclasslengths   = ()
+        self.sqlstatedecisions = {}
+        self.bypassreasons     = {}
         self.sqlstateprefix  = ""
         self.sqlstatepostfix = ""
         self.check_sqlstate  = False
@@ -211,12 +2228,32 @@ class pgmon:
         self.alert_directory = ""
         self.pg_tmp          = ""
         self.log_line_prefix = ""
+        self.prefixsource    = None
+        self.logformat       = "stderr"
         self.max_alerts      = 100
         self.verbose         = False
         self.debug           = False
         self.monitorlag      = False
         self.alert_stmt_timeout = False
         self.lockwait        = 1
+        # v3.2: every lock wait message feeds lockwaits; LOCKWAIT_PERCENTILE compares that percentile over the window to LOCKWAIT
+        self.lockwaits       = lockhistogram()
+        self.lockwait_percentile = None
+        # v3.2: alerts are aggregated per fingerprint over FINGERPRINT_WINDOW seconds before they are mailed
+        self.fingerprints    = fingerprints(60)
+        # v3.2: replaces the "too many alerts, sleep 10 minutes" backoff
+        self.limiter         = ratelimiter()
+        # v3.2: per-minute rates per sqlstate, database, user, application and of the whole log against their baselines
+        self.baseline        = ratebaseline()
+        self.baselinefile    = ""
+        # lines are only rates once we read them as they are logged: not before the follower first reached EOF
+        self.ratecounting    = False
+        # v3.2: where the time goes per stage and check; summarized every PERFINTERVAL seconds and on SIGUSR1.
+        # The stages of the record path are only timed with STAGE_TIMERS=yes, the checks always.
+        self.timers          = stagetimers()
+        self.timing          = False
+        self.perfrequested   = False
+        self.perfsummarized  = time.time()
         self.tempbytesthreshold = 999999999999
         self.pgversion       = Decimal('0.0')
         # logfile=/home/centos/tools/postgresql.log.2021-05-28-1900   
@@ -228,6 +2265,11 @@ class pgmon:
         self.slaves          = ''
         self.ignoreusers     = ''
         self.ignoreapps      = ''
+        self.ignoreappset    = set()
+        self.matcher         = patternmatcher()
+        self.lockchecks      = set()
+        self.configrules     = []
+        self.rules           = ruleset([])
         self.ignorequeries   = ''
         
         self.lockfilter      = ''
@@ -261,10 +2303,26 @@ class pgmon:
         self.bypass               = False
         self.connected            = False
 
-        self.stdout               = open('/tmp/stdout', "w+")        
-        self.stderr               = open('/tmp/stderr', "w+")        
+        # v3.2: private temp files instead of /tmp/stdout and /tmp/stderr so several pgmons can run side by side
+        self.stdout               = tempfile.TemporaryFile(mode="w+")
+        self.stderr               = tempfile.TemporaryFile(mode="w+")
+
+        # v3.2 fleet mode: set by pgfleet, stopping asks run() to finish up, exitcode is what the cluster ended with
+        self.fleet                = False
+        self.stopping             = False
+        self.exitcode             = None
+
+        # v3.2 backfill: rules are applied to old log files, nothing is emailed.  Workers collect their history lines in backfilllog
+        # and write them to backfillsegment, a file of their own the parent copies into the history.
+        self.backfill             = False
+        self.backfilllog          = None
+        self.backfillsegment      = None
+        self.backfillprefix       = '.pg_alert-backfill-'
+        self.since                = ""
+        self.until                = ""
         
-        self.lastalert            = ""
+        # v3.2: replaces lastalert, the timestamp of the newest alert, which dropped interleaved lines
+        self.replays              = replayfilter()
         
         # db stats ordered array: datname,numbackends,conflicts,temp_bytes,deadlocks
         self.dbstats = []
@@ -370,7 +2428,8 @@ class pgmon:
     ########################
     def get_pidlock(self):
         pid = str(os.getpid())
-        self.pidfile = "/tmp/%s.pid" % self.processname
+        # v3.2: one pidfile per cluster, so pg_alert can watch several clusters on one host without tripping over itself
+        self.pidfile = "/tmp/%s-%s.pid" % (self.processname, self.fileid())
 
         if os.path.isfile(self.pidfile):
             self.printit('Pid file exists (%s).  Program is already running. Exiting...' % (self.pidfile))            
@@ -384,16 +2443,31 @@ class pgmon:
             return NOPROGLOCK
         return OK
 
+    ##########################
+    def fileid(self):
+        # clusterid made safe for use in file names
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', self.clusterid)
+
     ##########################
     def setupOptionParser(self):
         parser = OptionParser(self.description)
         parser.add_option("-c","--configfile",dest="configfile", help="pg_alert config file", default="",metavar="CONFIGFILE")
+        parser.add_option("-f","--fleetdir",dest="fleetdir", help="fleet mode: monitor every cluster config (*.conf) in this directory", default="",metavar="FLEETDIR")
         parser.add_option("-m","--minutes",dest="minutes", help="duration of tailing in minutes", default=0,metavar="MINUTES")
         parser.add_option("-d","--dbname",dest="dbname", help="database name", default="",metavar="DBNAME")
         parser.add_option("-u","--dbuser",dest="dbuser", help="database user", default="",metavar="DBUSER")
         parser.add_option("-s","--dbhost",dest="dbhost", help="database host", default="",metavar="DBHOST")
         parser.add_option("-v","--verbose",dest="verbose",help="optional parameter indicating whether verbose messaging is turned on. Default is false",metavar="verbose", default=False, action="store_true")
         parser.add_option("-b","--debug",dest="debug",help="optional parameter indicating whether debug messaging is turned on. Default is false",metavar="debug", default=False, action="store_true")
+        parser.add_option("--backfill",dest="backfill", help="scan old (rotated, .gz) pg log files matching this glob instead of following the current one. No emails are sent", default="",metavar="GLOB")
+        parser.add_option("--since",dest="since", help="backfill, query: only records on or after this date (YYYY-MM-DD)", default="",metavar="SINCE")
+        parser.add_option("--until",dest="until", help="backfill, query: only records on or before this date (YYYY-MM-DD)", default="",metavar="UNTIL")
+        parser.add_option("--jobs",dest="jobs", help="backfill, whatif: number of worker processes. Default is the number of cpus", default=0,metavar="JOBS")
+        parser.add_option("--prefix",dest="prefix", help="backfill: log_line_prefix the files were written with. Default is the current one from the database", default="",metavar="PREFIX")
+        parser.add_option("--by",dest="by", help="query: comma separated fields to count the stored records by. Default is decision,rule", default="decision,rule",metavar="FIELDS")
+        parser.add_option("--top",dest="top", help="query: number of rows to show, the largest counts first. Default is 50", default=50,metavar="TOP")
+        parser.add_option("--whatif",dest="whatif", help="replay the records in the event store through this candidate config and CONFIGFILE and compare. Nothing is sent", default="",metavar="CANDIDATE")
+        parser.add_option("--days",dest="days", help="whatif: replay the records of the last DAYS days. Default is 7", default=7,metavar="DAYS")
         return parser
 
     ##########################
@@ -410,12 +2484,26 @@ class pgmon:
         filename1 = filename1.replace("%Y", year)
         filename1 = filename1.replace("%m", month)
         filename1 = filename1.replace("%d", day)
+        # csvlog and jsonlog files are named like the stderr one with .log replaced by (or extended with) .csv/.json
+        suffix = ''
+        if self.logformat == 'csvlog':
+            suffix = '.csv'
+        elif self.logformat == 'jsonlog':
+            suffix = '.json'
+        if suffix != '':
+            if filename1.endswith('.log'):
+                filename1 = filename1[:-4]
+            filename1 = filename1 + suffix
                 
         # new way is based on SQL, which is more stable
         # 9.6  : SELECT file, (pg_stat_file(current_setting('log_directory')||'/'||file)).modification FROM  pg_ls_dir(current_setting('log_directory')||'/') as list(file) ORDER BY 2 DESC LIMIT 1;
         # 10.x+:  select pg_current_logfile(); --> log/postgresql-Sun.log, so it's the relative offset from the data_directory.
-        if self.pgversion == 9.6:
+        if self.pgversion == 9.6 and suffix != '':
+            sql = "SELECT file, (pg_stat_file(current_setting('log_directory')||'/'||file)).modification FROM  pg_ls_dir(current_setting('log_directory')||'/') as list(file) WHERE file LIKE '%%%s' ORDER BY 2 DESC LIMIT 1" % suffix
+        elif self.pgversion == 9.6:
             sql = "SELECT file, (pg_stat_file(current_setting('log_directory')||'/'||file)).modification FROM  pg_ls_dir(current_setting('log_directory')||'/') as list(file) ORDER BY 2 DESC LIMIT 1"
+        elif suffix != '':
+            sql = "select pg_current_logfile('%s')" % self.logformat
         else:
             # assume newer version
             sql = "select pg_current_logfile()"
@@ -436,6 +2524,10 @@ class pgmon:
         for avalue in results:
             filename2 = avalue[0]
             break
+        if filename2 is None:
+            cur.close()
+            self.printit("SQL Error: no current %s log file. Check that log_destination includes %s." % (self.logformat, self.logformat))
+            self.cleanup(1)
  
         if filename1 != filename2:
             self.printit("%s: NOTICE: filename1=%s filename2=%s.  Using filename2." % (now, filename1, filename2))
@@ -461,37 +2553,27 @@ class pgmon:
 
     ##########################
     def prunelogs(self):
+        # v3.2: old alert logs are compressed and pruned by retentionservice on a thread of its own, started here and
+        # woken up on later calls.  Only the first scan is reported as it starts.
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")        
-        if self.keeplogdays > -1:
-            # delete all old logs
-            if self.verbose:
-                self.printit("%s: Pruning old pg_alert log files...\n" % (now))
-            for filename in os.listdir(self.alert_directory):
-                curr_file = os.path.join(self.alert_directory, filename)
-                file_modified = datetime.datetime.fromtimestamp(os.path.getmtime(curr_file))
-                dayage = (time.time() - os.stat(curr_file)[stat.ST_MTIME]) / 60 / 60 /24
-                dayage = int(round(dayage))
-                if filename.startswith("alerts-") and (filename.endswith(".log") or filename.endswith(".gz")):
-                    if curr_file == self.logalert or curr_file == self.loghistory:
-                        # self.printit("bypassing current log file=%s" % filename)
-                        pass
-                    else:
-                        # found candidates to purge
-                        if dayage > self.keeplogdays:
-                            self.printit("deleting file older than %d days: %s" % (dayage, curr_file))
-                            os.remove(curr_file)
-                        else:
-                            pass
-                            # self.printit("%d days old. Bypassing purge candidate=%s" % (dayage, curr_file))
-                else:
-                    # self.printit("bypassing non purge candidate=%s" % curr_file)
-                    pass
-        else:
-            # do nothing for now, add logic later for specifying exactness of logs to prune
+        if self.keeplogdays == -1 and self.keeplogmb == 0:
             self.printit("%s: No log file pruning specified.\n" % (now))
-    
+        elif self.verbose:
+            self.printit("%s: Pruning old pg_alert log files...\n" % (now))
+        if self.retention is None:
+            # clusters may share ALERTLOG_DIRECTORY in fleet mode, each one only looks after its own files
+            pattern = RETENTIONFLEETFILES % re.escape(self.fileid()) if self.fleet else RETENTIONFILES
+            self.retention = retentionservice(self.alert_directory, self.keeplogdays, self.compresslogdays, self.keeplogmb * 1024 * 1024, self.retained, pattern)
+        else:
+            self.retention.wake()
         return OK
 
+    ##########################
+    def retained(self, message):
+        # retentionservice report, called on its thread
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.printit("%s: %s" % (now, message))
+
     ##########################
     def checksystem(self):
 
@@ -511,17 +2593,6 @@ class pgmon:
             self.printit("psycopg2 package is required.")
             return ERR
         
-        try:
-            imp.find_module('psutil')
-            found = True
-            global psutil
-            import psutil            
-        except ImportError:
-            found = False        
-        if not found:
-            self.printit("python-psutil package is required.")
-            return ERR
-        
         # we only support python 2.7 flavors      
         # fix for v3: replace <> with != and require python 3.6
         #if self.python_version[0:3] <> '2.7':
@@ -601,7 +2672,211 @@ class pgmon:
         return OK
 
     ##########################
-    def initandvalidate(self):
+    def getlogprefix(self):
+        # only log_line_prefix, for refreshes.  Keep the one we have if we cannot get it.
+        cur = self.conn.cursor()
+        try:
+            cur.execute("select setting from pg_settings where name = 'log_line_prefix'")
+            row = cur.fetchone()
+        except psycopg2.Error as e:
+            cur.close()
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: SQL Error: unable to retrieve log_line_prefix: %s" % (now, e))
+            return self.log_line_prefix
+        cur.close()
+        if row is None:
+            return self.log_line_prefix
+        return row[0]
+
+    ##########################
+    def setprefix(self, log_line_prefix):
+        # compile log_line_prefix once into the parser used for every log line; rebuild it only when the prefix changes
+        if log_line_prefix == self.prefixsource:
+            return
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if self.logformat != 'stderr':
+            # csvlog and jsonlog records carry their fields explicitly, log_line_prefix does not apply to them
+            self.prefixsource    = log_line_prefix
+            self.log_line_prefix = log_line_prefix
+            return
+        if self.prefixsource is not None:
+            self.printit("%s: log_line_prefix changed from (%s) to (%s). Recompiling log line parser." % (now, self.prefixsource, log_line_prefix))
+        self.prefixsource    = log_line_prefix
+        self.log_line_prefix = log_line_prefix
+        self.assembler.parser = compileprefix(log_line_prefix)
+        if self.assembler.parser is None:
+            self.printit("%s: log_line_prefix (%s) could not be parsed. Log lines will be evaluated without prefix fields." % (now, log_line_prefix))
+        elif not self.prefixhas('pid'):
+            self.printit("%s: log_line_prefix (%s) has no %%p. Multi-line log messages will be evaluated line by line." % (now, log_line_prefix))
+        elif self.verbose:
+            self.printit("%s: VERBOSE: log_line_prefix fields parsed: %s" % (now, ', '.join(sorted(self.assembler.parser.groupindex.keys()))))
+
+    ##########################
+    def buildmatcher(self):
+        # v3.2: every phrase list is compiled once per config load into one matcher, shared by the follower (per line)
+        # and the alert checks (per record).  GREPFILTER is case-insensitive (V3.1 change), everything else is
+        # case-sensitive like grep -v and str.find were, both at startup and after a refresh.
+        matcher = patternmatcher()
+        matcher.addgrep('filter', self.grepfilter, True)
+        matcher.addgrep('exclude', self.grepexclude)
+        matcher.add('lockfilter', self.lockfilter)
+        for app in self.ignoreappset:
+            matcher.add('ignoreapp', app)
+        for patternid, phrase in MSGPHRASES:
+            matcher.add(patternid, phrase)
+        for rule in self.configrules:
+            matcher.add('rule:%s' % rule.name, rule.phrase, rule.ignorecase)
+        self.matcher = matcher.compile()
+        self.follower.setmatcher(self.matcher)
+
+        # lock wait messages are only evaluated if GREPFILTER asks for them
+        self.lockchecks = set()
+        if self.grepfilter.find('acquired ShareLock on transaction\|') > 0:
+            self.lockchecks.add('sharelock')
+        if self.grepfilter.find('acquired ExclusiveLock on\|') > 0:
+            self.lockchecks.add('exclusivelock')
+        if self.grepfilter.find('still waiting for \|') > 0:
+            self.lockchecks.add('stillwaiting')
+        self.buildrules()
+
+    ##########################
+    def buildrules(self):
+        # configured [rule:NAME] sections first, then the built-in lock wait and statement timeout rules.
+        # Whatever no rule decides falls through to lastcheck() in evaluatelog().
+        rules = list(self.configrules)
+        for kind in ('sharelock', 'exclusivelock', 'stillwaiting'):
+            if kind not in self.lockchecks:
+                continue
+            rules.append(alertrule('%s-lockfilter' % kind, hits=(kind, 'lockfilter'), action='bypass', label='found lock filter'))
+            rules.append(lockwaitrule('%s-lockwait' % kind, (kind,), self.lockwait, self.lockwaits, self.lockwait_percentile))
+        # sqlstate 57014: always report user requested cancels, bypass statement timeouts unless ALERT_STMT_TIMEOUT
+        if not self.alert_stmt_timeout:
+            rules.append(alertrule('stmt-timeout-user', hits=('canceluser',), sqlstates=('57014',)))
+            rules.append(alertrule('stmt-timeout-system', hits=('canceltimeout',), sqlstates=('57014',), action='bypass', label='application or system initiated statement timeout'))
+        rules.append(alertrule('stmt-timeout', sqlstates=('57014',)))
+        self.rules = ruleset(rules)
+
+    ##########################
+    def readrules(self, config):
+        # [rule:NAME] sections of pg_alert.conf.  A bad rule is reported and skipped, so a refresh never stops pg_alert.
+        rules = []
+        fieldnames = set([name for name, regex in PREFIXESCAPES.values() if name is not None]) | set(CSVCOLUMNS) | set(['severity', 'message'])
+        for section in config.sections():
+            if not section.startswith('rule:'):
+                continue
+            name = section[5:].strip()
+            now  = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                phrase    = config.get(section, 'match', raw=True, fallback='')
+                sqlstates = [code.strip() for code in config.get(section, 'sqlstate', raw=True).split(',') if code.strip() != '']
+                fields    = {}
+                for predicate in config.get(section, 'fields', raw=True, fallback='').split(','):
+                    if predicate.strip() == '':
+                        continue
+                    field, sep, value = predicate.partition('=')
+                    field = field.strip().lower()
+                    if sep == '' or field not in fieldnames:
+                        raise ValueError("invalid FIELDS predicate (%s)" % predicate.strip())
+                    fields[field] = value.strip()
+                action    = config.get(section, 'action', raw=True, fallback='alert').strip().lower()
+                if action not in ('alert', 'bypass'):
+                    raise ValueError("ACTION must be alert or bypass")
+                threshold = config.get(section, 'threshold', raw=True, fallback='').strip()
+                threshold = float(threshold) if threshold != '' else None
+                scale     = config.get(section, 'scale', raw=True, fallback='').strip()
+                scale     = float(scale) if scale != '' else 1.0
+                extract   = config.get(section, 'extract', raw=True, fallback='')
+                if threshold is not None and extract == '':
+                    raise ValueError("THRESHOLD needs EXTRACT")
+                rule = alertrule(name, hits=(('rule:%s' % name,) if phrase != '' else ()), sqlstates=sqlstates, fields=fields,
+                                 extract=extract, scale=scale, threshold=threshold, action=action)
+                if rule.extract is not None and rule.extract.groups < 1:
+                    raise ValueError("EXTRACT needs one (group) for the number")
+                rule.phrase     = phrase
+                rule.ignorecase = config.get(section, 'ignorecase', raw=True, fallback='no').strip().lower() in ('yes', 'true', 'on', '1')
+            except (ValueError, re.error, configparser.Error) as e:
+                self.printit("%s: Invalid rule, %s, ignored: %s" % (now, section, e))
+                continue
+            rules.append(rule)
+        return rules
+
+    ##########################
+    def prefixhas(self, field):
+        return self.assembler.provides(field)
+
+    ##########################
+    def connectdb(self):
+        # assumes password in .pgpass
+        connstr = "dbname=%s user=%s host=%s port=%s" % (self.dbname, self.dbuser, self.dbhost, self.pgport)
+        try:
+            self.conn = psycopg2.connect(connstr)
+            self.connected = True
+            self.conn.autocommit = True
+        except psycopg2.Error as e:
+            self.printit("Database Connection Error: %s" % (e))
+            self.printit("using connection string: %s" % connstr)
+            self.connected = False
+            return ERR
+        return OK
+
+    ##########################
+    def setlogformat(self, config):
+        # stderr, csvlog or jsonlog: which PG log file we follow and how its records are read
+        self.logformat = config.get("optional", "log_format").strip().lower()
+        if self.logformat == '':
+            self.logformat = 'stderr'
+        if self.logformat not in ('stderr', 'csvlog', 'jsonlog'):
+            self.printit("Invalid log_format config input(%s). Expected stderr, csvlog or jsonlog." % self.logformat)
+            self.cleanup(1)
+        if self.rds and self.logformat != 'stderr':
+            self.printit("log_format=%s is not supported for RDS log downloads. Using stderr." % self.logformat)
+            self.logformat = 'stderr'
+        if self.logformat == 'csvlog':
+            self.assembler = csvassembler(self.follower)
+        elif self.logformat == 'jsonlog':
+            self.assembler = jsonassembler(self.follower)
+
+    ##########################
+    def openhistory(self, config, template, mode):
+        # template has %s for the date.  text is the classic alerts history, json one JSON object per line and event.
+        self.historyformat = config.get("optional", "history_format").strip().lower()
+        if self.historyformat not in ('text', 'json'):
+            self.printit("Invalid history_format config input(%s). Expected text or json. Using text." % self.historyformat)
+            self.historyformat = 'text'
+        if self.historyformat == 'json':
+            template = template + '.jsonl'
+        else:
+            template = template + '.log'
+        try:
+            self.history = historywriter(template, mode, self.historyflush, self.historyfsync, self.historyformat == 'json', self.historymaxsize * 1024 * 1024)
+        except (IOError, OSError) as e:
+            self.printit("Unable to open history file, %s. %s" % (template, e))
+            return ERR
+        self.loghistory = self.history.path
+        return OK
+
+    ##########################
+    def storefile(self):
+        # like the checkpoint and baseline: clusters may share ALERTLOG_DIRECTORY in fleet mode
+        if self.fleet:
+            return "%s/pg_alert-%s.events" % (self.alert_directory, self.fileid())
+        return "%s/pg_alert.events" % self.alert_directory
+
+    ##########################
+    def openstore(self, config):
+        if not config.getboolean("optional", "eventstore"):
+            return OK
+        try:
+            self.store = eventstore(self.storefile(), self.historyflush, self.storedays)
+        except sqlite3.Error as e:
+            self.printit("Unable to open event store, %s. %s" % (self.storefile(), e))
+            return ERR
+        self.storerows = []
+        self.storesent = time.time()
+        return OK
+
+    ##########################
+    def initandvalidate(self, configfile=None, options=None):
 
         rc = self.checksystem()
         # fix for v3: replace <> with !=
@@ -609,15 +2884,23 @@ class pgmon:
             sys.exit(rc)
 
         # register signal handler to catch interrupts so we can end gracefully.
-        # signal.signal(signal.SIGUSR1, self.catch)
-        # signal.siginterrupt(signal.SIGUSR1, False)
-        signal.signal(signal.SIGINT, self.catch)
-        signal.siginterrupt(signal.SIGINT, False)        
-
-        optionParser    = self.setupOptionParser()
-        (self.options,self.args)  = optionParser.parse_args() 
+        # signals can only be handled in the main thread; in fleet mode pgfleet does it for every cluster.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self.usr1)
+            signal.siginterrupt(signal.SIGUSR1, False)
+            signal.signal(signal.SIGINT, self.catch)
+            signal.siginterrupt(signal.SIGINT, False)        
+            signal.signal(signal.SIGHUP, self.hangup)
+            signal.siginterrupt(signal.SIGHUP, False)
+
+        if options is None:
+            optionParser    = self.setupOptionParser()
+            (options,self.args)  = optionParser.parse_args() 
+        self.options = options
 
         self.configfile = self.options.configfile
+        if configfile is not None:
+            self.configfile = configfile
         if self.configfile == "":
             self.printit("config file not specified.")
             sys.exit(ERR)
@@ -634,13 +2917,9 @@ class pgmon:
         if self.options.dbhost != "":
             self.dbhost     = self.options.dbhost
                 
-        config = configparser.SafeConfigParser({'sqlstate':'', 'sqlclass':'', 'lockwait':'', 'checkinterval':'', \
-                 'loadthreshold':'', 'dirthreshold':'', 'idletransthreshold':'', 'querytransthreshold':'', 'pgsql_tmp_threshold':'', 'lockfilter':'', \
-                 'pglog_directory':'', 'alert_directory':'', 'ignore_autovacdaemon':'True', 'ignore_uservac':'True', 'tempbytesthreshold':'', 'slaves':'', \
-                 'monitorlag':'False', 'alert_stmt_timeout':'False', 'ignoreapps':'', 'ignoreusers':'','ignorequeries':'', 'suspended':'False', \
-                 'mail_method':'', 'smtp_server':'', 'smtp_account':'', 'smtp_port':'', 'smtp_password':'', 'sms':'', 'grepfilter':'', 'grepexclude':''})
-        
-        config.read(self.configfile)
+        self.configs = configcache(self.configfile)
+        config = self.configs.snapshot()
+        self.runningconfig = config
 
         self.ignore_autovacdaemon = config.getboolean('optional', 'ignore_autovacdaemon')
         self.ignore_uservac       = config.getboolean('optional', 'ignore_uservac')
@@ -655,7 +2934,8 @@ class pgmon:
         self.ignoreusers = config.get('optional', 'ignoreusers')
         self.ignoreusers = self.ignoreusers.strip()
         self.ignoreapps = config.get('optional', 'ignoreapps')
-        self.ingoreapps = self.ignoreapps.strip()
+        self.ignoreapps = self.ignoreapps.strip()
+        self.ignoreappset = set([app.strip() for app in self.ignoreapps.split('*|*') if app.strip() != ''])
         self.ignorequeries = config.get('optional', 'ignorequeries')
         self.ignorequeries = self.ignorequeries.strip()
         
@@ -762,21 +3042,13 @@ class pgmon:
             self.pgport = "5432"
 
         # open db connection: assumes password in .pgpass
-        connstr = "dbname=%s user=%s host=%s port=%s" % (self.dbname, self.dbuser, self.dbhost, self.pgport)
-        try:
-            self.conn = psycopg2.connect(connstr)
-            self.connected = True
-            self.conn.autocommit = True
-        except psycopg2.Error as e:
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
-            self.printit("Database Connection Error: %s" % (e))
-            self.printit("using connection string: %s" % connstr)
-            
+        rc = self.connectdb()
+        if rc != OK:
             # v2.1 enhancement: do not abort if we cannot connect, just disable db checking stuff
             # v2.3 on second thought, abort if we cannot connect.
             #self.printit("%s: NOTICE. DB session checks are disabled for this instance of pg_alert." % now)
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
             self.printit("%s: NOTICE. Unable to connect to database. Exiting...." % now)
-            self.connected = False
             self.cleanup(1)          
 
         if  self.connected:
@@ -802,59 +3074,13 @@ class pgmon:
         else:
             self.printit("Invalid keeplogdays config input(%s). Expected a non-negative number indicating the number of days to keep pg_alert log files." % keeplogdays)
             self.cleanup(1)                    
+
+        self.setlogformat(config)
     
         self.lockfilter = config.get("optional", "lockfilter")
+        self.configrules = self.readrules(config)
     
-        value = config.get("optional", "max_alerts")
-        if len(value) > 0 and value.isdigit():
-            self.max_alerts = int(value)
-
-        value = config.get("optional", "lockwait")
-        # must be > 0 seconds
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 0:
-                self.lockwait = int(value)            
-
-        value = config.get("optional", "tempbytesthreshold")
-        # must be > 100K bytes
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 100000:
-                self.tempbytesthreshold = int(value)            
-
-        value = config.get("optional", "checkinterval")
-        # must be at least 30 seconds
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 29:
-                self.checkinterval = int(value)
-
-        value = config.get("optional", "loadthreshold")
-        # must be at least 10%
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 9:
-                self.loadthreshold = int(value)
-                
-        value = config.get("optional", "dirthreshold")
-        # must be < 100%
-        if len(value) > 0 and value.isdigit():
-            if int(value) < 100:
-                self.dirthreshold = int(value)                
-                
-        value = config.get("optional", "idletransthreshold")
-        # must be > 2 seconds
-        if len(value) > 0 and value.isdigit():
-            if int(value) >1:
-                self.idletransthreshold = int(value)                                
-                
-        value = config.get("optional", "querytransthreshold")
-        # must be > 1 seconds
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 1:
-                self.querytransthreshold = int(value)                                          
-    
-        value = config.get("optional", "pgsql_tmp_threshold")
-        if len(value) > 0 and value.isdigit():
-            if int(value) > 0:
-                self.pgsql_tmp_threshold = int(value)
+        self.readthresholds(config)
     
         self.from_      = config.get("required", "from")
         self.grepfilter = config.get("optional", "grepfilter")
@@ -951,35 +3177,40 @@ class pgmon:
 
         if self.debug:        
             print ("%s: DEBUG logfile=%s   log_filename=%s" % (now, self.logfile, self.log_filename))
-        self.logalert     = "%s/alerts-%s.log" % (self.alert_directory,self.filedatefmt)
-        self.loghistory   = "%s/alerts-history-%s.log" % (self.alert_directory,self.filedatefmt)
-
-        # remove alert file if exists and clear out history file as well
-        cmd = "echo '' > %s" % (self.logalert)
-        rc,out,errs = self.executecmd(cmd,False)
-        if rc != 0:
-            self.cleanup(1)                
-
+        # clear out history file.  The date in its name follows the clock, see historywriter.
+        if self.fleet:
+            # clusters may share ALERTLOG_DIRECTORY in fleet mode
+            rc = self.openhistory(config, "%s/alerts-history-%s-%%s" % (self.alert_directory,self.fileid()), 'w')
+        else:
+            rc = self.openhistory(config, "%s/alerts-history-%%s" % self.alert_directory, 'w')
+        if rc != OK:
+            self.cleanup(1)
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
         msg = "%s: %s" % (now,self.version)
         # fix for v3
         #print msg
         self.printit (msg)
-        cmd = "echo '%s' > %s" % (msg, self.loghistory)
-        rc,out,errs = self.executecmd(cmd,False)  
-        if rc != 0:
-            self.cleanup(1)                
 
-        try:
-            self.alert = open(self.logalert, 'r')
-        except IOError as e:
-           self.printit("Unable to open alert file(%s). I/O error({0}): {1}".format(e.errno, e.strerror) % self.logalert)
-           self.cleanup(1)                
-
-        except: 
-           self.printit("Unable to open alert file(%s). Unexpected error:", (self.logalert, sys.exc_info()[0]))
-           self.cleanup(1)                
-        
+        # compile the phrases used by the in-process log follower and alert checks, and load where we left off last time
+        self.buildmatcher()
+        self.follower.byname = self.rds
+        self.follower.log    = self.printit
+        self.follower.watchconfig(self.configfile)
+        if self.fleet:
+            rc = self.follower.loadcheckpoints("%s/pg_alert-%s.checkpoint" % (self.alert_directory, self.fileid()))
+        else:
+            rc = self.follower.loadcheckpoints("%s/pg_alert.checkpoint" % self.alert_directory)
+        if rc != OK:
+            self.printit("Unable to read checkpoint file, %s. Starting at the beginning of the pg log file." % self.follower.checkpointfile)
+        if self.fleet:
+            self.baselinefile = "%s/pg_alert-%s.baseline" % (self.alert_directory, self.fileid())
+        else:
+            self.baselinefile = "%s/pg_alert.baseline" % self.alert_directory
+        if self.baseline.load(self.baselinefile) == ERR:
+            self.printit("Unable to read rate baseline file, %s. Starting a new baseline." % self.baselinefile)
+        if self.openstore(config) != OK:
+            self.cleanup(1)
+
         # convert minutes to seconds        
         self.seconds = self.minutes * 60
         # reject minutes if it would overlap into next day
@@ -1026,19 +3257,23 @@ class pgmon:
                 self.printit("%s: DEBUG: prefix  ='%s'" % (now, self.sqlstateprefix))
                 self.printit("%s: DEBUG: postfix ='%s'" % (now, self.sqlstatepostfix))
 
-        if (len(self.sqlstates) != 0 or len(self.sqlclasses) != 0) and (self.sqlstateprefix != '' and self.sqlstatepostfix != ''  and self.sqlstate != ''):
+        # compile log_line_prefix into the parser that splits every log line into its fields
+        self.setprefix(self.log_line_prefix)
+
+        if (len(self.sqlstates) != 0 or len(self.sqlclasses) != 0) and self.sqlstate != '' and (self.prefixhas('sqlstate') or (self.sqlstateprefix != '' and self.sqlstatepostfix != '')):
             # must be valid sqlstate checking
             print ("Setting check sqlstate = TRUE")
             self.check_sqlstate  = True                
         else:
             self.check_sqlstate  = False            
 
-        # final check, make sure we do not have more than 1 find for the prefix
-        if self.check_sqlstate:
+        # final check, make sure we do not have more than 1 find for the prefix.  Not a problem if the parser extracts %e itself.
+        if self.check_sqlstate and not self.prefixhas('sqlstate'):
             matches = self.log_line_prefix.count(self.sqlstateprefix)
             if matches > 1:
                 self.printit("Multiple prefixes found for sqlstate. SQLstates/SQLClasses are disabled until a better log_line_prefix is used.")
                 self.check_sqlstate  = False            
+        self.buildsqlstatefilter()
 
         # finally purge old alert logs if specified
         self.prunelogs()
@@ -1048,19 +3283,134 @@ class pgmon:
 
     ##########################
     def initrefresh(self):
-        # The only thing we can override on the command line parm is verbose and debug.
+        # every REFRESH minutes: make sure we follow the current pg log file with the current log_line_prefix.
+        # v3.2: pg_alert.conf is no longer re-read here, reloadconfig() does that when it changes or on SIGHUP.
         # We never refresh db connection parameters.  Connections last for the duration of the program.
         
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.printit("%s: Refreshing log and configuration values..." % now)
-            
-        # re-initiate reading of config file
-        config = configparser.SafeConfigParser({'sqlstate':'', 'sqlclass':'', 'lockwait':'', 'checkinterval':'', \
-                 'loadthreshold':'', 'dirthreshold':'', 'idletransthreshold':'', 'querytransthreshold':'', 'pgsql_tmp_threshold':'', 'lockfilter':'', \
-                 'pglog_directory':'', 'alert_directory':'', 'ignore_autovacdaemon':'True', 'ignore_uservac':'True', 'tempbytesthreshold':'', 'slaves':'', \
-                 'monitorlag':'False', 'alert_stmt_timeout':'False', 'ignoreapps':'', 'ignoreusers':'','ignorequeries':'', 'suspended':'False', \
-                 'mail_method':'', 'smtp_server':'', 'smtp_account':'', 'smtp_port':'', 'smtp_password':'', 'sms':'', 'grepfilter':'', 'grepexclude':''})
-        config.read(self.configfile)
+        self.printit("%s: Refreshing log file and log_line_prefix..." % now)
+
+        rc = self.refreshlogfile()
+        if rc != OK:
+            return rc
+
+        # log_line_prefix may have been changed and reloaded since the last refresh
+        if self.connected:
+            log_line_prefix = self.getlogprefix()
+            if log_line_prefix != self.prefixsource:
+                self.setprefix(log_line_prefix)
+                self.readsqlstates(self.runningconfig)
+        return OK
+
+    ########################
+    def usr1(self, signum, frame):
+        # SIGUSR1: log the stage timers at the top of the next pass of the main loop
+        self.perfrequested = True
+
+    ########################
+    def perfsummary(self):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        elapsed = time.time() - self.timers.started
+        self.printit("%s: stage timers over %d secs, %d lines read, %d alerts sent%s:" % (now, elapsed, self.follower.linesread, self.alertcnt,
+                     '' if self.timing else ' (STAGE_TIMERS=no, only the checks are timed)'))
+        for line in self.timers.summary():
+            self.printit("%s:   %s" % (now, line))
+        if self.bypassreasons:
+            self.printit("%s:   SQLSTATE/SQLCLASS bypasses: %s" % (now, self.bypasssummary()))
+        self.perfsummarized = time.time()
+        return OK
+
+    ########################
+    def hangup(self, signum, frame):
+        # SIGHUP: reload pg_alert.conf at the top of the next pass of the main loop
+        self.reloadrequested = True
+
+    ########################
+    def reloadconfig(self, reason):
+        # v3.2: compare pg_alert.conf to the snapshot the running values came from and rebuild only what depends on
+        # the options that changed: matcher and rules, SQLSTATE sets, thresholds, mail settings.  The log follower,
+        # the db connection and everything read only at startup are left alone.
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if reason == 'SIGHUP':
+            self.configs.invalidate()
+        config = self.configs.snapshot()
+        if self.configs.error != '':
+            self.printit("%s: pg_alert.conf reload (%s) failed, running values are kept: %s" % (now, reason, self.configs.error))
+            return ERR
+        if config is self.runningconfig:
+            return OK
+        changed = self.runningconfig.diff(config)
+        if not changed:
+            if self.verbose:
+                self.printit("%s: VERBOSE: pg_alert.conf reload (%s): nothing changed." % (now, reason))
+            self.runningconfig = config
+            return OK
+        names = sorted([('[%s]' % name) if name.startswith('rule:') else name.upper() for name in changed])
+        self.printit("%s: pg_alert.conf reload (%s): %s changed." % (now, reason, ', '.join(names)))
+        restart = changed & RELOADRESTART
+        if restart:
+            self.printit("%s: restart pg_alert for %s to take effect." % (now, ', '.join(sorted(restart)).upper()))
+        try:
+            self.readdynamic(config, changed)
+            if not changed.isdisjoint(RELOADMAIL):
+                self.readmail(config)
+        except (ValueError, configparser.Error) as e:
+            # e.g. a boolean that is not yes/no.  Whatever was read before the error is in effect, the rest is unchanged.
+            self.printit("%s: Invalid pg_alert.conf value, reload incomplete: %s" % (now, e))
+            return ERR
+        self.showparms()
+        return OK
+
+    ########################
+    def readmail(self, config):
+        # mail settings on a reload.  Unlike at startup an invalid value does not stop pg_alert, the running ones are kept.
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        to           = config.get("required", "to")
+        sendemail    = config.getboolean('required', 'emailalerts')
+        mail_method  = config.get('optional', 'mail_method').lower()
+        mailx_format = config.get('optional', 'mailx_format').lower()
+        smtp_port    = config.get('optional', 'smtp_port')
+        mailbin      = self.mailbin
+        if mail_method == 'mail' and self.mail_method != 'mail':
+            mailbin = '/usr/bin/bsd-mailx' if os.path.isfile('/usr/bin/bsd-mailx') else which('mailx')
+        problem = ''
+        if to == '':
+            problem = 'TO is empty'
+        elif mail_method not in ('mail', 'smtp', 'ssmtp'):
+            problem = 'MAIL_METHOD must be MAIL, SMTP or SSMTP'
+        elif mailx_format not in ('default', 'custom1', 'custom2'):
+            problem = 'MAILX_FORMAT must be default, custom1 or custom2'
+        elif mail_method == 'smtp' and not smtp_port.isdigit():
+            problem = 'SMTP_PORT must be a number'
+        elif mailbin == '':
+            problem = 'mailx program not found'
+        if problem != '':
+            self.printit("%s: Invalid mail settings (%s). Keeping MAIL_METHOD=%s TO=%s." % (now, problem, self.mail_method, self.to))
+            return ERR
+        self.to            = to
+        self.sendemail     = sendemail
+        self.mail_method   = mail_method
+        self.mailx_format  = mailx_format
+        self.mailbin       = mailbin
+        self.smtp_server   = config.get('optional', 'smtp_server')
+        self.smtp_account  = config.get('optional', 'smtp_account')
+        self.smtp_port     = int(smtp_port) if smtp_port.isdigit() else smtp_port
+        self.smtp_password = config.get('optional', 'smtp_password')
+        self.sms           = config.get('optional', 'sms')
+        self.from_         = config.get("required", "from")
+        if self.from_ == "":
+            self.from_ = "PostgreSQL Administrator <%s@%s>" % (self.dbuser, self.dbhost)
+        return OK
+
+    ########################
+    def readdynamic(self, config=None, changed=None):
+        # the dynamic part of the configuration: filters, thresholds, sqlstates, ignore lists and the log_line_prefix parser.
+        # Used by reloadconfig() and by backfill, which needs the same rules without following a live log file.
+        # changed is the set of options that differ from the running config; None reads and rebuilds everything.
+
+        # the config file is only parsed again if it changed since the last snapshot
+        if config is None:
+            config = self.configs.snapshot()
 
         self.grepfilter  = config.get("optional", "grepfilter")
         self.grepexclude = config.get("optional", "grepexclude")
@@ -1079,16 +3429,46 @@ class pgmon:
         self.alert_stmt_timeout = config.getboolean('optional', 'alert_stmt_timeout')
         self.lockfilter = config.get("optional", "lockfilter")
     
-        self.suspended     = config.getboolean('optional', 'suspended')
+        value = config.get('optional', 'suspended').strip().lower()
+        # yes/no, true/false, on/off or 1/0.  Anything else keeps us suspended or not, as we are.
+        if value in configparser.ConfigParser.BOOLEAN_STATES:
+            self.suspended = configparser.ConfigParser.BOOLEAN_STATES[value]
+        else:
+            self.printit("Invalid SUSPENDED (%s). Expected yes or no. Still %s." % (value, 'suspended' if self.suspended else 'not suspended'))
         self.slaves        = config.get('optional', 'slaves')
         self.slaves        = self.slaves.strip()
         self.ignoreusers   = config.get('optional', 'ignoreusers')
         self.ignoreusers   = self.ignoreusers.strip()
         self.ignoreapps    = config.get('optional', 'ignoreapps')
         self.ignoreapps    = self.ignoreapps.strip()
+        self.ignoreappset  = set([app.strip() for app in self.ignoreapps.split('*|*') if app.strip() != ''])
         self.ignorequeries = config.get('optional', 'ignorequeries')
         self.ignorequeries = self.ignorequeries.strip()
     
+        self.readthresholds(config)
+
+        # filters, rules and thresholds are all in, recompile what depends on the options that changed
+        rulesections = changed is None or any([name.startswith('rule:') for name in changed])
+        if rulesections:
+            self.configrules = self.readrules(config)
+        if rulesections or not changed.isdisjoint(RELOADMATCHER):
+            self.buildmatcher()
+        elif not changed.isdisjoint(RELOADRULES):
+            self.buildrules()
+
+        # log_line_prefix may have been changed and reloaded since the last refresh
+        if changed is None and self.connected:
+            self.setprefix(self.getlogprefix())
+
+        if changed is None or not changed.isdisjoint(RELOADSQLSTATE):
+            self.readsqlstates(config)
+        self.runningconfig = config
+        return OK
+
+    ########################
+    def readthresholds(self, config):
+        # limits, windows and thresholds that take effect without a restart.  Read at startup and on every reload,
+        # running history, retention and event store threads pick up their new settings here.
         value = config.get("optional", "max_alerts")
         if len(value) > 0 and value.isdigit():
             self.max_alerts = int(value)
@@ -1099,6 +3479,84 @@ class pgmon:
             if int(value) > 0:
                 self.lockwait = int(value)            
 
+        value = config.get("optional", "lockwait_percentile")
+        # 1-100, otherwise every lock wait is compared to lockwait by itself
+        self.lockwait_percentile = None
+        if len(value) > 0 and value.replace('.', '', 1).isdigit():
+            if 0 < float(value) <= 100:
+                self.lockwait_percentile = float(value)
+
+        value = config.get("optional", "lockwait_window")
+        # minutes, default 15
+        if len(value) > 0 and value.isdigit():
+            if int(value) > 0:
+                self.lockwaits.window = int(value) * 60
+
+        value = config.get("optional", "fingerprint_window")
+        # seconds, 0 mails every alert line by itself. Default is 60.
+        if len(value) > 0 and value.isdigit():
+            self.fingerprints.window = int(value)
+
+        value = config.get("optional", "ratelimit_key").strip().lower()
+        # fingerprint, sqlstate, database or user. Default is fingerprint
+        if value in ('fingerprint', 'sqlstate', 'database', 'user'):
+            self.limiter.keyfield = value
+        elif value != '':
+            self.printit("Invalid RATELIMIT_KEY (%s). Expected fingerprint, sqlstate, database or user. Using %s." % (value, self.limiter.keyfield))
+        value = config.get("optional", "ratelimit_burst")
+        if len(value) > 0 and value.isdigit():
+            if int(value) > 0:
+                self.limiter.burst = float(value)
+        value = config.get("optional", "ratelimit_per_minute")
+        if len(value) > 0 and value.isdigit():
+            if int(value) > 0:
+                self.limiter.rate = int(value) / 60.0
+
+        value = config.get("optional", "anomaly_zscore")
+        # deviations above its baseline that make a per-minute rate an anomaly, 0 turns it off. Default is 4.
+        if len(value) > 0 and value.replace('.', '', 1).isdigit():
+            self.baseline.zscore = float(value)
+        value = config.get("optional", "anomaly_minimum")
+        # events per minute a rate needs before it can be an anomaly. Default is 50.
+        if len(value) > 0 and value.isdigit():
+            self.baseline.minimum = int(value)
+
+        value = config.get("optional", "history_flush")
+        # seconds history lines may wait before they are flushed, 0 flushes every batch. Default is 1.
+        if len(value) > 0 and value.replace('.', '', 1).isdigit():
+            self.historyflush = float(value)
+        self.historyfsync = config.getboolean('optional', 'history_fsync')
+        # the stages of the record path cost about 10% of the lines/sec when timed
+        self.timing = config.getboolean('optional', 'stage_timers')
+        value = config.get("optional", "history_maxsize")
+        # MB per history file segment, 0 only starts a new file every day. Default is 100.
+        if len(value) > 0 and value.isdigit():
+            self.historymaxsize = int(value)
+        if self.history is not None:
+            self.history.flushsecs = self.historyflush
+            self.history.fsync     = self.historyfsync
+            self.history.maxbytes  = self.historymaxsize * 1024 * 1024
+
+        value = config.get("optional", "keeplogmb")
+        # MB this cluster's alerts files in ALERTLOG_DIRECTORY may take, the oldest are removed first. 0 is no limit.
+        if len(value) > 0 and value.isdigit():
+            self.keeplogmb = int(value)
+        value = config.get("optional", "compresslogdays")
+        # this cluster's alerts files older than this many days are gzipped. Default is 1, -1 never compresses.
+        if len(value) > 0 and value.lstrip('-').isdigit():
+            self.compresslogdays = int(value)
+        if self.retention is not None:
+            self.retention.maxbytes     = self.keeplogmb * 1024 * 1024
+            self.retention.compressdays = self.compresslogdays
+            self.retention.wake()
+
+        value = config.get("optional", "eventstore_days")
+        # days of evaluated records kept in the event store. Default is 30, 0 keeps them forever.
+        if len(value) > 0 and value.isdigit():
+            self.storedays = int(value)
+        if self.store is not None:
+            self.store.keepdays = self.storedays
+
         value = config.get("optional", "tempbytesthreshold")
         # must be > 100K bytes
         if len(value) > 0 and value.isdigit():
@@ -1139,7 +3597,11 @@ class pgmon:
         if len(value) > 0 and value.isdigit():
             if int(value) > 0:
                 self.pgsql_tmp_threshold = int(value)
-    
+        return OK
+
+    ########################
+    def readsqlstates(self, config):
+        # SQLSTATE and SQLCLASS into the sets used per record.  Whether they can be checked at all depends on log_line_prefix.
         self.sqlstate      = ""
         self.sqlclass      = ""
         self.sqlstates     = []
@@ -1166,73 +3628,132 @@ class pgmon:
                     #self.printit("sqlclass values must be 2 digit numbers separated by commas.  Current value: %s" % item)
                     #self.cleanup(1)                
                     pass
-           
-        if (len(self.sqlstates) != 0 or len(self.sqlclasses) != 0) and (self.sqlstateprefix != '' and self.sqlstatepostfix != ''  and self.sqlstate != ''):
+
+        if (len(self.sqlstates) != 0 or len(self.sqlclasses) != 0) and self.sqlstate != '' and (self.prefixhas('sqlstate') or (self.sqlstateprefix != '' and self.sqlstatepostfix != '')):
             # must be valid sqlstate checking
             print ("Setting check sqlstate = TRUE")
             self.check_sqlstate  = True                        
         else:
             self.check_sqlstate  = False                    
-        
+        self.buildsqlstatefilter()
+        return OK
+
+    ##########################
+    def refreshlogfile(self):
+        # make sure we are pointing to the current pg log file.  Called every REFRESH minutes and whenever
+        # the follower sees a new file show up in the log directory.
         if self.rds:
             self.oldlogfile = self.logfile
             logfilename  = self.get_rdslog()
             if logfilename == '':
                 return ERR
-        else:
-            # get logfile based on whether we are 9.6 or 10.x+
-            # 9.6  : SELECT file, (pg_stat_file(current_setting('log_directory')||'/'||file)).modification FROM  pg_ls_dir(current_setting('log_directory')||'/') as list(file) ORDER BY 2 DESC LIMIT 1;
-            # 10.x+:  select pg_current_logfile(); --> log/postgresql-Sun.log, so it's the relative offset from the data_directory.
-            self.oldlogfile = self.logfile
-            rc, log_filename = self.getlogfilename()
-            if rc != OK:
-                self.cleanup(1)
-            self.logfile = "%s/%s" % (self.pglog_directory, log_filename)
-            if not os.path.exists(self.logfile):
-                self.printit("PG log file does not exist: %s" % self.logfile)            
-                self.cleanup(1)    
+            # For RDS the log file is downloaded again, so we reopen it and resume at the byte offset we already evaluated.
+            # A different RDS log file is switched to once the old download is drained.
+            try:
+                if self.oldlogfile == self.logfile:
+                    self.follower.open(self.logfile)
+                else:
+                    self.follower.switchto(self.logfile)
+            except (IOError, OSError) as e:
+                self.printit("Unable to open PG log file(%s). %s" % (self.logfile, e))
                 return ERR
+            return OK
+
+        # get logfile based on whether we are 9.6 or 10.x+
+        # 9.6  : SELECT file, (pg_stat_file(current_setting('log_directory')||'/'||file)).modification FROM  pg_ls_dir(current_setting('log_directory')||'/') as list(file) ORDER BY 2 DESC LIMIT 1;
+        # 10.x+:  select pg_current_logfile(); --> log/postgresql-Sun.log, so it's the relative offset from the data_directory.
+        self.oldlogfile = self.logfile
+        rc, log_filename = self.getlogfilename()
+        if rc != OK:
+            self.cleanup(1)
+        self.logfile = "%s/%s" % (self.pglog_directory, log_filename)
+        if not os.path.exists(self.logfile):
+            self.printit("PG log file does not exist: %s" % self.logfile)            
+            self.cleanup(1)    
+            return ERR
         
-        # now kill the existing grep since a refresh of the log file even if same log file, will invalidate the tail.
-        rc = self.terminatetail()        
-        if rc != 0:
-            self.printit('Unable to terminate tail for refreshing. rc=%d' % (rc))
-            return ERR        
-        if self.debug:
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                                
-            print ("%s: DEBUG: Killed existing tail." % now)            
-        
-        self.showparms();
-        
+        # The follower keeps reading the same log file untouched, so nothing is lost or read twice.
+        # A new log file is only switched to after the old one has been drained.
+        if self.oldlogfile != self.logfile:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: New pg log file, %s. Switching to it once %s is drained." % (now, self.logfile, self.oldlogfile))
+            self.follower.switchto(self.logfile)
         return OK
 
     ########################
     def printit(self,message):
-        if self.loghistory == '':
-            print (message)
+        if not self.timing:
+            return self.printline(message)
+        started = time.perf_counter_ns()
+        try:
+            return self.printline(message)
+        finally:
+            self.timers.add('printit', started)
+
+    ########################
+    def printline(self,message):
+        if self.backfilllog is not None:
+            # backfill worker: the parent process writes these to the history file, in file order
+            self.backfillline(message)
             return OK
-        print (message)
-        #cmd = 'echo "%s" >> %s' % (message, self.loghistory)
-        
-        # V3.1 fix: escape single ticks and backslashes
-        #print ("msg0=%s"  % message)
-        msg = message.replace("\\","\\\\")
-        #print ("msg1=%s"  % msg)
-        msg = message.replace("'","\'")
-        #print ("msg2=%s"  % msg)
-        
-        cmd = 'echo \'%s\' >> %s' % (message, self.loghistory)
-        #print ('AAAAAAAAA  cmd -->%s' % cmd)
-        #rc = subprocess.call(cmd, shell=True)  
-        rc = subprocess.call(cmd, shell=True, executable='/bin/bash')  
-        if rc != 0:
-            msg = "Unable to print previous message. subprocess.call error return code = %d command=%s" % (rc, cmd)
-            print (msg)
-            # sysmsg = "cat %s > %s\n" % (msg,self.loghistory)
-            # os.system(sysmgs)
-            self.cleanup(1)                
+        if self.fleet:
+            # all clusters share the console in fleet mode
+            print ("[%s] %s" % (self.clusterid, message))
         else:
+            print (message)
+        if self.history is None:
             return OK
+        # v3.2: queued for the history writer thread instead of a bash echo per line, so any message text is safe
+        if self.history.error != '':
+            history = self.history
+            self.history = None
+            print ("Unable to write to history file, %s: %s" % (history.path, history.error))
+            self.cleanup(1)
+        self.history.message(message)
+        return OK
+
+    ########################
+    def backfillline(self, item):
+        # a history message or event of a backfill worker, written to its segment BACKFILLFLUSH at a time.  What-if
+        # workers have no segment and drop them.
+        self.backfilllog.append(item)
+        if self.backfillsegment is not None and len(self.backfilllog) >= BACKFILLFLUSH:
+            self.flushbackfill()
+        return OK
+
+    ########################
+    def flushbackfill(self):
+        # one JSON value per line, so the parent gets the strings and event dicts back as they were
+        self.backfillsegment.write(''.join([json.dumps(item, default=str) + "\n" for item in self.backfilllog]))
+        del self.backfilllog[:]
+        return OK
+
+    ########################
+    def historyevent(self, kind, rec=None, **fields):
+        # one structured history event (HISTORY_FORMAT=json): what happened, to which record, decided by which rule
+        if self.historyformat != 'json':
+            return OK
+        event = {'timestamp': datetime.datetime.now().isoformat(timespec='milliseconds'), 'event': kind, 'cluster': self.clusterid}
+        if rec is not None:
+            event['logtime']  = rec.timestamp()
+            event['rule']     = rec.rule
+            event['reason']   = rec.reason
+            event['sqlstate'] = rec.sqlstate or rec.fields.get('sqlstate')
+            for field in ('database', 'user', 'application'):
+                event[field] = rec.fields.get(field)
+            event['message']  = rec.msg.strip()
+        event.update(fields)
+        if self.backfilllog is not None:
+            # backfill worker: the parent writes it, see printline()
+            self.backfillline(event)
+        elif self.history is not None:
+            self.history.event(event)
+        return OK
+
+    ########################
+    def bypassed(self, rec, reason):
+        rec.reason = reason
+        self.timers.bypassed(reason)
                 
     
     ########################
@@ -1395,6 +3916,17 @@ class pgmon:
 
     ########################
     def sendalert(self,msg):
+        started = time.perf_counter_ns()
+        rc = ERR
+        try:
+            rc = self.mailalert(msg)
+            return rc
+        finally:
+            self.timers.add('sendalert', started)
+            self.historyevent('sent', rc=rc, emailed=self.sendemail, latency_us=(time.perf_counter_ns() - started) // 1000, message=msg.strip())
+
+    ########################
+    def mailalert(self,msg):
 
         if self.debug:
             now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -1549,13 +4081,17 @@ class pgmon:
         return OK
 
     ########################
-    def isvalidlog(self, msg):
+    def isvalidlog(self, msg, timestamp=None):
+        # timestamp is the parsed %m/%t/%n of the record if we have one, otherwise the line must start with the date
+        if timestamp is None:
+            timestamp = msg
         if len(msg) > 4:
-            value = (msg[0:4])
+            value = (timestamp[0:4])
             if value.isdigit():
                 year = datetime.datetime.today().year
                 logyear = int(value)
-                if logyear == year:
+                # backfilled log files may well be from last year
+                if logyear == year or self.backfill:
                     return True
         if self.verbose:
             now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")        
@@ -1565,48 +4101,6 @@ class pgmon:
             self.printit("%s: Bypassing invalid log line: ***%s***\n" % (now,msg))
         return False
 
-    ########################
-    def getlockwaitseconds(self, searchstring, msg):
-        # acquired ShareLock on transaction\| acquired ExclusiveLock 
-        # 2016-12-18 20:37:03.079 CST blackjack_prod@blackjack_prod[29561:SELECT waiting] [2912-1] 10.80.129.28(44672) 
-        # B::Backend::Job::AppraiserStaitisticsCollector tx=0,ss=00000: LOG:  process 29561 acquired ShareLock on transaction 3219951272 after 1569.367 ms
-        pos = msg.find(searchstring)
-        if pos > 0:
-            s1  = msg[pos+len(searchstring):]            
-            pos = s1.find('after ')
-            if pos < 0:
-                self.printit("could not find time waited(1). Alert will not be triggered. %s % searchstring")                    
-                return NOTFOUND
-            s1  = s1[pos+len('after '):]
-            s1 = s1.strip()
-            pos = s1.find(' ms')
-            if pos < 0:
-                self.printit("could not find time waited(2). Alert will not be triggered. %s % searchstring")                    
-                return NOTFOUND
-            s1 = s1[0:pos]
-            s1 = s1.strip()
-            pos = s1.find('.')
-            if pos < 0:
-                self.printit("could not find time waited(3). Alert will not be triggered. %s % searchstring")                    
-                return NOTFOUND            
-            s1 = s1[0:pos]
-            s1 = s1.strip()                      
-            if s1.isdigit():
-                milliseconds = int(s1)            
-            else:
-                self.printit("could not find time waited(4). Alert will not be triggered. %s % searchstring")                    
-                return NOTFOUND
-            if milliseconds < 1000:
-                return OK
-            seconds = milliseconds / 1000
-            return seconds
-        else:
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
-            self.printit("%s: could not find time waited(5). Alert will not be triggered. %s" % (now, searchstring))
-            return NOTFOUND
-    
-        return NOTFOUND
-
     ########################
     def getSqlstate(self, msg):
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
@@ -1651,9 +4145,14 @@ class pgmon:
         return s1
 
     ########################
-    def sqlstatebypass(self,msg):
+    def sqlstatebypass(self,rec):
 
-        sqlstate = self.getSqlstate(msg)
+        msg = rec.msg.strip()
+        if 'sqlstate' in rec.fields:
+            # %e already split out by the log_line_prefix parser
+            sqlstate = rec.fields['sqlstate'] or ''
+        else:
+            sqlstate = self.getSqlstate(msg)
         
         # if sqlstate checking not enabled, cannot bypass
         if not self.check_sqlstate:
@@ -1666,24 +4165,20 @@ class pgmon:
             # nothing more to do here
             return self.bypass, sqlstate
 
-        # sqlstate = 00000, requires further analysis for other reasons to alert on.
-        if sqlstate == '00000':
-            return self.bypass, sqlstate
-
-        # check if class is found
-        for item in self.sqlclasses:
-            index = sqlstate.find(item)
-            if index == 0:
+        # one dict lookup: SQLCLASS and SQLSTATE were decided for this sqlstate the first time we saw it
+        decision = self.sqlstatedecisions.get(sqlstate)
+        if decision is None:
+            decision = self.sqlstatedecide(sqlstate)
+        if decision is not SQLSTATEEVALUATE:
+            self.bypassreasons[decision] = self.bypassreasons.get(decision, 0) + 1
+            if decision[0] == 'sqlclass':
                 # we found a state class match so bypass
-                self.printit("%s: Bypassing found filtered sqlclass, %s. msg= %s\n" % (now,item,msg))
-                return True, sqlstate
-                     
-        # match sqlstate with the ones we are filtering out
-        for item in self.sqlstates:
-            if item == sqlstate:
+                self.printit("%s: Bypassing found filtered sqlclass, %s. msg= %s\n" % (now,decision[1],msg))
+            else:
                 self.printit("%s: Bypassing sqlstate, %s. msg= %s\n" % (now,sqlstate,msg))
-                return True, sqlstate
+            return True, sqlstate
 
+        # sqlstate = 00000, requires further analysis for other reasons to alert on.
         # Handle statement timeouts in evaluatelog
         # sqlstate == '57014'
 
@@ -1691,107 +4186,107 @@ class pgmon:
         return self.bypass, sqlstate
 
     ########################
-    def lastcheck(self, msg, sqlstate):
+    def buildsqlstatefilter(self):
+        # SQLSTATE as a set, SQLCLASS as a set of prefixes by length; decisions are cached per sqlstate from here on
+        self.sqlstateset       = frozenset([item for item in self.sqlstates if item != ''])
+        self.sqlclassset       = frozenset([item for item in self.sqlclasses if item != ''])
+        self.sqlclasslengths   = tuple(sorted(set([len(item) for item in self.sqlclassset])))
+        self.sqlstatedecisions = {}
+
+    ########################
+    def sqlstatedecide(self, sqlstate):
+        # bypass reason for this sqlstate, ('sqlclass', class) or ('sqlstate', state), or SQLSTATEEVALUATE
+        decision = SQLSTATEEVALUATE
+        if sqlstate != '00000':
+            for length in self.sqlclasslengths:
+                if sqlstate[0:length] in self.sqlclassset:
+                    decision = ('sqlclass', sqlstate[0:length])
+                    break
+            if decision is SQLSTATEEVALUATE and sqlstate in self.sqlstateset:
+                decision = ('sqlstate', sqlstate)
+        if len(self.sqlstatedecisions) >= MAXSQLSTATEDECISIONS:
+            # garbage from a misparsed log_line_prefix should not grow this forever
+            self.sqlstatedecisions = {}
+        self.sqlstatedecisions[sys.intern(sqlstate)] = decision
+        return decision
+
+    ########################
+    def bypasssummary(self):
+        if len(self.bypassreasons) == 0:
+            return "none"
+        return ', '.join(["%s %s=%d" % (kind, code, count) for (kind, code), count in sorted(self.bypassreasons.items())])
+
+    ########################
+    def lastcheck(self, rec, sqlstate):
         
         # check if application name in the error message.
         if len(self.ignoreapps) == 0:
             return self.bypass
-        apps= self.ignoreapps.split('*|*')
-        appcnt = len(apps)
-        if appcnt == 0:
+        if 'application' in rec.fields:
+            # %a already split out by the log_line_prefix parser: still a substring match like before, so partial
+            # names keep working, but only against the application name instead of the whole line
+            application = rec.fields['application'] or ''
+            for app in self.ignoreappset:
+                if app in application:
+                    return True
             return self.bypass
-        for app in apps:
-            index = msg.find(app)
-            if index > -1:
-                # must have already bypassed this application, so bypass it again
-                return True
+        if 'ignoreapp' in rec.hits:
+            # must have already bypassed this application, so bypass it again
+            return True
 
         # bypass could have already been set so send back what it was before this function started
         return self.bypass
 
 
     ########################
-    def evaluatelog(self, msg, sqlstate):
+    def evaluatelog(self, rec, sqlstate):
         # return true if alert valid, otherwise false
+        # The rules that can apply to this record (by its phrase hits and sqlstate) are tried in order; the first one
+        # that applies decides.  Lock waits, lock filters and statement timeouts are built-in rules, see buildrules().
+        msg = rec.msg.strip()
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
-        # parse log looking for time waited before sharelock or exclusive lock was obtained
-        # send alert if wait time greater than input lock wait time
-        if self.grepfilter.find('acquired ShareLock on transaction\|') > 0 and msg.find('acquired ShareLock on transaction') > 0:
-            # see if a lockfilter applies to it
-            if msg.find(self.lockfilter) > 0:
-                # found lock filter so bypass it
-                self.bypass = True
-                self.printit("%s: Bypassing found lock filter\n" % (now))
-                return False
+        for rule in self.rules.candidates(rec, sqlstate):
+            # per rule, so the summary shows which rule costs the most
+            started = time.perf_counter_ns() if self.timing else 0
+            applies = rule.applies(rec, sqlstate)
+            value   = rule.measure(rec) if applies and rule.measured else None
+            if self.timing:
+                self.timers.add('rule:%s' % rule.name, started)
+            if not applies:
+                continue
+            rec.rule = rule.name
+            if not rule.measured:
+                if rule.action == 'bypass':
+                    self.bypass = True
+                    self.bypassed(rec, 'rule:%s' % rule.name)
+                    self.printit("%s: Bypassing %s\n" % (now, rule.label))
+                    return False
+                if self.verbose:
+                    self.printit("%s: VERBOSE: %s. Sending alert for msg: %s\n" % (now, rule.label, msg))
+                return True
 
-            seconds = self.getlockwaitseconds('acquired ShareLock on transaction',msg)
-            if seconds == NOTFOUND:
+            if value is None:
                 # assume textual context so do not alert. Message is logged to alerts-history file.
-                return False
-            elif seconds >= self.lockwait:
-                return True
-            else:
-                self.bypass = True
-                self.printit("%s: Bypassing lock wait seconds (%d) below threshold (%d).\n" % (now, seconds, self.lockwait))
-                return False
-                
-        if self.grepfilter.find('acquired ExclusiveLock on\|') > 0 and msg.find('acquired ExclusiveLock on ') > 0:
-            # see if a lockfilter applies to it
-            if msg.find(self.lockfilter) > 0:
-                # found lock filter so bypass it
-                self.bypass = True
-                self.printit("%s: Bypassing found lock filter\n")
-                return False
-        
-            seconds = self.getlockwaitseconds('acquired ExclusiveLock on ',msg)
-            if seconds >= self.lockwait:
-                return True
-            else:
                 self.bypass = True
-                self.printit("%s: Bypassing lock wait seconds (%d) below threshold (%d).\n" % (now, seconds, self.lockwait))
+                self.bypassed(rec, 'rule:%s' % rule.name)
+                self.printit("%s: could not find %s in msg. Alert will not be triggered. %s" % (now, rule.label, msg))
                 return False
-
-        if self.grepfilter.find('still waiting for \|') > 0 and msg.find('still waiting for ') > 0:
-            # see if a lockfilter applies to it
-            if msg.find(self.lockfilter) > 0:
-                # found lock filter so bypass it
+            if rule.threshold is not None and value < rule.threshold:
                 self.bypass = True
-                self.printit("%s: Bypassing found lock filter\n" % now)
+                self.bypassed(rec, 'rule:%s' % rule.name)
+                self.printit("%s: Bypassing %s (%d) below threshold (%d).\n" % (now, rule.label, value, rule.threshold))
                 return False
-        
-            seconds = self.getlockwaitseconds('still waiting for ',msg)
-            if seconds >= self.lockwait:
-                return True
-            else:
+            if rule.action == 'bypass':
                 self.bypass = True
-                self.printit("%s: Bypassing lock wait seconds (%d) below threshold (%d).\n" % (now, seconds, self.lockwait))
+                self.bypassed(rec, 'rule:%s' % rule.name)
+                self.printit("%s: Bypassing %s (%d)\n" % (now, rule.label, value))
                 return False
-
-        # handle sqlstate = 57014, for statement timeouts. Consider bypassing statement timeouts, but always report user requested ones
-        if sqlstate == '57014':
-            if self.alert_stmt_timeout:
-                if self.verbose:
-                    self.printit("%s: VERBOSE: alert on statement timeout is turned on. Sending alert for msg: %s\n" % (now,msg))
-                return True
-            else:
-                if msg.find('ERROR:  canceling statement due to user request') > 0:
-                    # report user initiated timeouts
-                    return True
-                elif msg.find('ERROR:  canceling statement due to statement timeout') > 0:
-                    # bypass these since it is system or application context controlled
-                    self.bypass = True
-                    if self.verbose:
-                        self.printit("%s: VERBOSE: bypassing application or system initiated statement timout." % now)
-                    return False
-                else:
-                    # for anything else unforeseen, report it
-                    if self.verbose:
-                        self.printit("%s: VERBOSE: defaulting action for sqlstate, 57014.  Sending alert for msg: %s\n" % (now,msg))
-                    return True
+            return True
 
         # before defaulting to alert valid, check if we already bypasses stuff like application names in checkconnections.
-        self.bypass = self.lastcheck(msg, sqlstate)
+        self.bypass = self.lastcheck(rec, sqlstate)
         if self.bypass:
+            self.bypassed(rec, 'ignoreapps')
             if self.verbose:
                 self.printit("%s: VERBOSE: bypass(1) for msg: %s\n" % (now,msg))            
             return False
@@ -1803,72 +4298,217 @@ class pgmon:
 
     ########################
     def stillsuspended(self):
-    
-        # re-initiate reading of config file
-        config = configparser.SafeConfigParser({'sqlstate':'', 'sqlclass':'', 'lockwait':'', 'checkinterval':'', \
-                 'loadthreshold':'', 'dirthreshold':'', 'idletransthreshold':'', 'querytransthreshold':'', 'pgsql_tmp_threshold':'', 'lockfilter':'',  \
-                 'log_directory':'', 'alert_directory':'', 'ignore_autovacdaemon':'True', 'ignore_uservac':'True', 'tempbytesthreshold':'', 'slaves':'', \
-                 'monitorlag':'False', 'alert_stmt_timeout':'False', 'ignoreapps':'', 'ignoreusers':'','ignorequeries':'', 'suspended':'False'})        
-        config.read(self.configfile)
-    
-        self.suspended = config.getboolean('optional', 'suspended')
+        # the running value, set by readdynamic().  While validatebatch() waits for it the main loop does not reload
+        # pg_alert.conf, so one stat() tells us whether to do it from here.
+        if self.suspended and self.configs.stat() not in (self.runningconfig.key, self.configs.failedkey):
+            self.reloadconfig('file changed')
         return self.suspended
 
     ########################
-    def alertvalidated(self,msg):
-    
-        #check if we are in suspended state and if so wait
-        while True:
+    def readrecords(self):
+        # read what is available in the pg log and return the log records that are complete
+        bytesread = self.follower.bytesread
+        counting = self.ratecounting
+        started = time.perf_counter_ns() if self.timing else 0
+        lines = self.follower.readlines()
+        if self.timing:
+            self.timers.add('readlines', started)
+        if counting:
+            self.baseline.add(('log', 'lines'), len(lines))
+            self.baseline.add(('log', 'bytes'), self.follower.bytesread - bytesread)
+        elif self.follower.atEOF():
+            # the backlog from the checkpoint (or the start of the log) ends here, what comes next is live
+            self.ratecounting = True
+        started = time.perf_counter_ns() if self.timing else 0
+        records = self.assembler.feed(lines) + self.assembler.flush()
+        if self.timing:
+            self.timers.add('assemble', started)
+        if counting:
+            for rec in records:
+                self.baseline.addrecord(rec)
+        return records
+
+    ########################
+    def releasereplays(self):
+        # after a batch was evaluated: nothing of the current log file below the first unread byte or the oldest
+        # record the assembler still holds can legitimately come again
+        source = (self.follower.ident, self.follower.generation)
+        offset = self.follower.offset
+        for position in self.assembler.openpositions():
+            if position is not None and position[0] == source:
+                offset = min(offset, position[1])
+        self.replays.release(source, offset)
+
+    ########################
+    def validatebatch(self, records):
+        # evaluate a batch of log records and return the ones that should be alerted on.
+        #check if we are in suspended state and if so wait. Done once per batch, not once per line.  Backfill never waits.
+        while not self.backfill and not self.stopping:
             if self.stillsuspended():
                 now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
                 self.printit("%s: pg_alert in user-initiated suspended state.\n" % (now))
                 time.sleep(60)
             else:
                 break
+
+        alerts = []
+        for rec in records:
+            msg = rec.msg.strip()
+            if msg == '':
+                continue
+            self.bypass = False
+            if self.debug:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.printit("%s: DEBUG: evaluating msg: %s" % (now, msg))
+            started = time.perf_counter_ns()
+            valid = self.alertvalidated(rec)
+            latency = (time.perf_counter_ns() - started) // 1000
+            if self.historyformat == 'json':
+                self.historyevent('alert' if valid else 'bypass', rec, latency_us=latency)
+            if self.storerows is not None:
+                self.storerows.append(self.eventrow(rec, valid, latency))
+            if valid:
+                alerts.append(rec)
+            elif self.debug:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.printit("%s: DEBUG: bypass(2) bypass=%r  for %s\n" % (now, self.bypass, msg))
+        # one queue entry per batch for the event store; backfill waits for room instead of dropping rows
+        if self.store is not None and len(self.storerows) > 0:
+            self.store.add(self.storerows, self.backfill)
+            self.storerows = []
+        return alerts
+
+    ########################
+    def senddue(self, label):
+        # v3.2: once per fingerprint window, one line per distinct error.  label tells the callers apart in VERBOSE.
+        if not self.fingerprints.due():
+            return OK
+        if self.verbose:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: VERBOSE: sending %d buffered alerts(%s)." % (now, self.fingerprints.count(), label))
+        return self.sendbuffered()
+
+    ########################
+    def sendbuffered(self):
+        # the alerts aggregated by fingerprint plus the rate limiter summary, as one alert
+        msg = self.fingerprints.drain(self.limiter.drain())
+        rc = self.sendalert(msg)
+        if rc == OK and self.store is not None:
+            # the stored alert rows this alert was about
+            self.store.alerted(self.clusterid, self.alertcnt, msg, self.storesent)
+            self.storesent = time.time()
+        return rc
+
+    ########################
+    def eventrow(self, rec, valid, latency):
+        # one event store row, in eventstore.COLUMNS order.  Only alerts get a fingerprint, queuealert() reuses it.
+        fields = rec.fields
+        if valid:
+            rec.fingerprint = self.fingerprints.fingerprint(rec.msg.strip())
+        return (time.time(), rec.timestamp(), self.clusterid, 'backfill' if self.backfill else 'live', fields.get('pid'),
+                fields.get('user'), fields.get('database'), fields.get('application'), fields.get('remote'),
+                rec.sqlstate or fields.get('sqlstate'), rec.severity, rec.fingerprint,
+                'alert' if valid else 'bypass', rec.rule, rec.reason, latency, rec.msg, json.dumps(fields))
+
+    ########################
+    def recordlockwait(self, rec):
+        # parse a lock wait message once and add it to the lock wait histogram, by log time so backfill works the same
+        rec.lockwait = parselockwait(rec.msg)
+        if rec.lockwait is None:
+            return
+        try:
+            rec.when = time.mktime(time.strptime(rec.timestamp(), "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            rec.when = time.time()
+        self.lockwaits.add(rec.lockwait.locktype, rec.lockwait.ms, rec.when)
+        if self.verbose:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: VERBOSE: lock wait: %s %s by pid %d for %.3f ms, holders=%s" % (now, rec.lockwait.event, rec.lockwait.locktype,
+                         rec.lockwait.pid, rec.lockwait.ms, ','.join([str(pid) for pid in rec.lockwait.holders]) or '-'))
+
+    ########################
+    def alertvalidated(self,rec):
+        # the whole record (primary line plus DETAIL, STATEMENT, etc.) is evaluated once
+        msg = rec.msg.strip()
     
         # make sure we have a valid log line, must start with date
-        if not self.isvalidlog(msg):
+        started = time.perf_counter_ns() if self.timing else 0
+        valid = self.isvalidlog(msg, rec.timestamp())
+        if self.timing:
+            self.timers.add('isvalidlog', started)
+        if not valid:
+            self.bypassed(rec, 'invalid log line')
             return False
 
-        self.bypass, sqlstate = self.sqlstatebypass(msg)
+        # one pass over the record for every phrase the checks below need
+        started = time.perf_counter_ns() if self.timing else 0
+        rec.hits = self.matcher.scan(msg)
+        if self.timing:
+            self.timers.add('scan', started)
+        if rec.hits & LOCKHITS:
+            started = time.perf_counter_ns() if self.timing else 0
+            self.recordlockwait(rec)
+            if self.timing:
+                self.timers.add('recordlockwait', started)
+
+        started = time.perf_counter_ns() if self.timing else 0
+        self.bypass, sqlstate = self.sqlstatebypass(rec)
+        rec.sqlstate = sqlstate
+        if self.timing:
+            self.timers.add('sqlstatebypass', started)
         if self.bypass:
+            self.bypassed(rec, 'sqlstate')
             return False
 
-        # v3.0 feature: check if alert is older than previous one if previous one exists based on timestamp format: 2021-05-24 13:20:34 <ignore rest>
-        # self.lastalert
-        value = (msg[0:19])
-        #validate timestamp to some degree
-        x = value.replace("-", "")
-        x = x.replace(":", "")
-        x = x.replace(" ", "")
-        if not x.isdigit():
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.printit ("%s: WARNING: Unexpected log timestamp, %s. Unable to determine whether to bypass this log alert." % (now,msg))        
-        
-        if self.lastalert == '':
-            self.lastalert = value
-        else:
-            if value >= self.lastalert:
-                self.lastalert = value
-            else:
-                if self.debug:
-                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.printit ("%s: DEBUG: bypassing old alert. old=%s new=%s.  %s" % (now,self.lastalert, value, msg))
-                return False
+        # v3.0 feature: check if alert is older than previous one if previous one exists
+        # v3.2: by source position (log file plus byte offset), so interleaved lines are kept and only replays dropped.
+        # Backfill files are scanned in parallel and in any order, and never replayed.
+        if not self.backfill and not self.replays.accept(rec.position):
+            self.bypassed(rec, 'replayed')
+            if self.debug:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.printit ("%s: DEBUG: bypassing replayed alert at %s.  %s" % (now, rec.position, msg))
+            return False
 
         # check for obvious things like deadlocks
         # 2016-12-29 08:02:06.542 CST blackjack_prod@blackjack_prod[10513:UPDATE waiting] [3692-1] 10.80.129.86(46448) B::Backend::Job::AppraiserStatisticsCollector tx=3245985290,ss=00000: LOG:  process 10513 detected deadlock while waiting for ShareLock on transaction 3245985292 after 1000.098 ms
-        if msg.find('detected deadlock while waiting for') > 0:
+        if 'deadlock' in rec.hits:
+            rec.rule = 'deadlock'
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             self.printit("%s: Detected deadlock: %s\n" % (now,msg))
             return True
 
-        alertvalid = self.evaluatelog(msg, sqlstate)
+        started = time.perf_counter_ns() if self.timing else 0
+        alertvalid = self.evaluatelog(rec, sqlstate)
+        if self.timing:
+            self.timers.add('evaluatelog', started)
         if alertvalid and not self.bypass:
             return True
         else:
             return False        
             
 
+    ########################
+    def queuealert(self, rec):
+        # rate limit by the configured key, then aggregate by fingerprint until the window is up
+        alert = rec.msg.strip()
+        if rec.fingerprint is None:
+            rec.fingerprint = self.fingerprints.fingerprint(alert)
+        fingerprint = rec.fingerprint
+        if self.limiter.keyfield == 'fingerprint':
+            key = fingerprint
+        else:
+            key = rec.fields.get(self.limiter.keyfield) or '-'
+        if not self.limiter.allow(key, time.time()):
+            if self.limiter.suppressed[key] == 1:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.printit("%s: Rate limit reached for %s %s, suppressing its alerts: %s" % (now, self.limiter.keyfield, key, alert))
+            return
+        self.fingerprints.add(alert, fingerprint)
+        if self.debug:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: %d buffered alert=%s" % (now, self.fingerprints.count(), alert))
+
     ########################
     def linuxload(self):
 
@@ -2275,22 +4915,30 @@ class pgmon:
     def checkotherstuff(self):
 
         if self.connected:
+            started = time.perf_counter_ns()
             rc = self.checkdbstats()
+            self.timers.add('check:dbstats', started)
             if rc != 0:
                 return rc;        
             
         if not self.rds:
+            started = time.perf_counter_ns()
             rc = self.checklinux()
+            self.timers.add('check:linux', started)
             if rc != 0:
                 return rc;
 
         if self.connected:
+            started = time.perf_counter_ns()
             rc = self.checkconnections()
+            self.timers.add('check:connections', started)
             if rc != 0:
                 return rc;        
 
         if self.connected:
+            started = time.perf_counter_ns()
             rc = self.checkslaves()
+            self.timers.add('check:slaves', started)
             if rc != 0:
                 return rc;                    
 
@@ -2315,57 +4963,18 @@ class pgmon:
 
         return OK
 
-    ########################
-    def terminatetail(self):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                                
-        for proc in psutil.process_iter():
-            try:
-                pinfo = proc.as_dict(attrs=['pid', 'name'])
-                apid  = pinfo['pid']
-                name = pinfo['name']
-                afile = '/proc/' + str(apid) + '/cmdline'
-                if name == 'timeout':
-                    try:
-                        # /proc/<pid>/cmdline contains complete command without spaces like this:
-                        # timeout120tail-f/pglog/lenderx/postgresql-2016-1223.logpostgres@msp0llexp022:/proc/1275
-                        if not os.path.exists(afile):
-                            # do nothing. Might be another instance trying to start and this tail never started.
-                            return OK
-                        pidfile = open(afile, 'r')
-                        info = str(pidfile.readline())
-                        if self.debug:
-                            print ("%s: DEBUG: pid=%s  name=%s  pidinfo: %s" % (now, str(apid), name, info))
-                        try:
-                            self.printit("%s: Terminating tail pid(%s)." % (now,str(apid)))
-                            p = psutil.Process(apid)
-                            p.terminate()
-                            return OK
-                        except Exception as e:
-                            self.printit("%s: unable to terminate pid, %s. %s" % (now,str(apid),e))
-                            return ERR
-                        return OK
-                    except Exception as e:
-                        self.printit("%s: unable to open pidfile(%s). %s" % (now,afile,e))
-                        return ERR
-                    return OK    
-            except psutil.NoSuchProcess:
-                self.printit("%s: Unable to terminate tail pid: no such process." % now)
-                return ERR
-        self.printit("%s: Tail pid not found. Nothing to terminate." % now)            
-        return NOTFOUND
-
     ########################
     def showparms(self):
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
         msg = '%s: verbose=%s debug=%s rds=%s sendmail=%s check_sqlstate=%s max_alerts=%d clusterid=%s  pgport=%s  from_=%s  to=%s  minutes=%d  refreshrate=%d  keeplogdays=%d log_dir=%s alert_dir=%s data_directory=%s  ' \
               'dbname=%s  dbuser=%s  dbhost=%s sqlstates=%s sqlclasses=%s prefix=***%s*** postfix=***%s*** log_line_prefix=%s lockwait=%d checkinterval=%d  loadthreshold=%d  ' \
               'dirthreshold=%d  idletransthreshold=%d querytransthreshold=%d  pgsql_tmp_threshold=%d ignore_autovacdaemon=%s ignore_uservac=%s slaves=%s ignoreapps=%s ' \
-              'ignoreusers=%s monitorlag=%s alert_stmt_timeout=%s ignorequeries=%s server_version=%d suspended=%s mail_method=%s smtp_server=%s, smtp_account=%s, logfile=%s\n' \
+              'ignoreusers=%s monitorlag=%s alert_stmt_timeout=%s ignorequeries=%s server_version=%d suspended=%s mail_method=%s smtp_server=%s, smtp_account=%s, log_format=%s logfile=%s\n' \
               % (now,self.verbose, self.debug, self.rds, self.sendemail, self.check_sqlstate, self.max_alerts, self.clusterid, self.pgport, self.from_, self.to, self.minutes, self.refreshrate, self.keeplogdays, self.pglog_directory, self.alert_directory ,\
                  self.data_directory, self.dbname, self.dbuser, self.dbhost, self.sqlstates, self.sqlclasses, self.sqlstateprefix, self.sqlstatepostfix, self.log_line_prefix, \
                  self.lockwait, self.checkinterval, self.loadthreshold, self.dirthreshold, self.idletransthreshold, self.querytransthreshold, self.pgsql_tmp_threshold, \
                  self.ignore_autovacdaemon, self.ignore_uservac, self.slaves, self.ignoreapps, self.ignoreusers, self.monitorlag, self.alert_stmt_timeout, self.ignorequeries, \
-                 self.pgversion, self.suspended, self.mail_method, self.smtp_server, self.smtp_account, self.logfile)
+                 self.pgversion, self.suspended, self.mail_method, self.smtp_server, self.smtp_account, self.logformat, self.logfile)
         self.printit(msg)
         return
 
@@ -2374,13 +4983,11 @@ class pgmon:
     def cleanup(self, rc):
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
         self.printit("%s: Cleanup in progress..." % now)
-        if self.alert is not None:
-            self.alert.close()
+        self.follower.close()
         if self.conn is not None:
             self.conn.close()
     
         if rc != NOPROGLOCK:
-            rc2 = self.terminatetail()
             self.printit("%s: removing pidfile, %s" % (now,self.pidfile))
             try:
                 os.unlink(self.pidfile)
@@ -2390,6 +4997,18 @@ class pgmon:
                 self.printit("%s: Unknown exception trying to remove pid file, %s.  %s" % (now, self.pidfile, e))
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
         self.printit("%s: pg_alert ended." % now)
+        if self.retention is not None:
+            self.retention.close()
+        if self.store is not None:
+            store = self.store
+            self.store = None
+            store.close()
+            if store.dropped > 0 or store.error != '':
+                self.printit("%s: event store: %d rows stored, %d dropped. %s" % (now, store.rows, store.dropped, store.error))
+        if self.history is not None:
+            history = self.history
+            self.history = None
+            history.close()
         sys.exit(rc)
 
     ########################
@@ -2398,232 +5017,804 @@ class pgmon:
         self.printit('User-initiated interrupt detected.')
         self.cleanup(INTERRUPT)        
 
+    ########################
+    def run(self):
+        # v3.2: the main follow/evaluate/alert loop, a method so fleet mode can run one per cluster
+        # v3.2: follow the PG log file directly.  We read the current log file from the last checkpoint (or the beginning) and then follow it.
+        # GREPFILTER and GREPEXCLUDE are applied in-process, so there is no tail/grep pipeline or intermediate alerts file anymore.
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
+        try:
+            self.follower.open(self.logfile)
+        except (IOError, OSError) as e:
+            self.printit('FATAL: Unable to open initial pg log file. %s' % e)
+            self.cleanup(1)    
+        if self.follower.offset > 0:
+            msg = "%s: Resuming initial pg log file, %s, at byte offset %d (last timestamp %s)" % (now, self.logfile, self.follower.offset, self.follower.lasttime)
+        else:
+            msg = "%s: Following initial pg log file, %s" % (now, self.logfile)
+        self.printit('%s' % msg)
+        if not self.follower.notifier.available():
+            self.printit("%s: inotify not available, polling the pg log file for changes." % now)
 
-#####################################
-######### MAIN ENTRY POINT ##########
-#####################################
+        timeout = time.time() + self.seconds + 2
+        # outer loop is for duration of the tail of pg log
 
+        tailfinished = 0
+        bAbort = False
+        lastchecked = time.time()
+        while True:
+            if time.time() > timeout or self.stopping:
+                break
+            elif bAbort:
+                break
+            while True:
+                ##########################################################################################################################
+                # loop with a refresh every REFRESH RATE mins and make sure we are pointing to the current logfile.
+                # For RDS, we have to always download the latest log file.  If the log file is different, we point to the beginning of it.
+                # If the log file is the same we get the date of the last alert sent out. If none there we simply do the grep again
+                # against the same file.  Otherwise check the date of an ensuing alert and make sure the date of it is > than date
+                # of last alert sent out.
+                # For local log file, we already have it and don't need to get do anything, unless it's a new log file.
+                #
+                # v3.2: drain mode. Every pass reads all matching lines available in the pg log file and evaluates them as one batch.
+                #       We only block when the log file is at EOF, so throughput is no longer capped at one line per second.
+                ##########################################################################################################################
+                if tailfinished:
+                    break
+                if time.time() > timeout or self.stopping:
+                    break
+                now = time.time()            
 
-# get the class instantiation
-p = pgmon()
-
-rc = p.initandvalidate()
-if rc != 0:
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-    p.printit("%s: Initialization Error." % now)
-    p.cleanup(1)    
-
-p.showparms()
-
-# The timeout value for the grep dictates the duration of this program instance.  
-# we always grep the log file and then tail it.
-#cmd= "timeout %d tail -f %s | grep --line-buffered '%s' > %s 2>&1 &" % (p.seconds, p.logfile, p.grepfilter, p.logalert)
-
-# V3.1 change: do not use case-sensitive greps
-#cmd1= "cat %s | grep --line-buffered '%s' | " % (p.logfile, p.grepfilter)
-cmd1= "cat %s | grep --line-buffered -i '%s' | " % (p.logfile, p.grepfilter)
-
-cmd2= "grep --line-buffered -v '%s' >> %s 2>&1 &" % (p.grepexclude, p.logalert)
-grepcmd=cmd1 + cmd2
-now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-msg = "%s: Grepping initial pg log file, %s" % (now, p.logfile)
-p.printit('%s' % msg)
-msg = "%s: %s\n" % (p.start,grepcmd)
-p.printit('%s' % msg)
-rc,out,errs = p.executecmd(grepcmd,False)
-if rc != 0:
-    p.printit('FATAL: Unable to grep initial pg log file.' % msg)
-    p.cleanup(rc)    
-
-# Start the tail of the pg log file: file format expected: postgresql-YY-MMDD.log
-#cmd= "timeout %d tail -f %s | grep --line-buffered '%s' > %s 2>&1 &" % (p.seconds, p.logfile, p.grepfilter, p.logalert)
-
-# V3.1 change: do not use case-sensitive greps
-#cmd1= "timeout %d tail -f %s | grep --line-buffered '%s' | " % (p.seconds, p.logfile, p.grepfilter)
-cmd1= "timeout %d tail -f %s | grep --line-buffered -i '%s' | " % (p.seconds, p.logfile, p.grepfilter)
-
-cmd2= "grep --line-buffered -v '%s' >> %s 2>&1 &" % (p.grepexclude, p.logalert)
-grepcmd=cmd1 + cmd2
-now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-msg = "%s: Tailing initial pg log file, %s" % (now, p.logfile)
-p.printit('%s' % msg)
-msg = "%s: %s\n" % (p.start,grepcmd)
-p.printit('%s' % msg)
-rc,out,errs = p.executecmd(grepcmd,False)
-if rc != 0:
-    p.cleanup(rc)    
-
-# delay for a few secs before attempting to access the alerts log file
-time.sleep(2)
-now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-p.printit("%s: Background tail started successfully.  Tailing alerts file now...\n" % now)
-    
-timeout = time.time() + p.seconds + 2
-# outer loop is for duration of the tail of pg log
-
-tailfinished = 0
-bAbort = False
-buffered_alerts = ''
-buffered_alerts_cnt = 0
-while True:
-    if time.time() > timeout:
-        break
-    elif bAbort:
-        break
-    buffstart = time.time()
-    buffcnt  = 0
-    sleepsec = 0
-    while True:
-        ##########################################################################################################################
-        # loop with a refresh every REFRESH RATE mins and make sure we are pointing to the current logfile.
-        # For RDS, we have to always download the latest log file.  If the log file is different, we point to the beginning of it.
-        # If the log file is the same we get the date of the last alert sent out. If none there we simply do the grep again
-        # against the same file.  Otherwise check the date of an ensuing alert and make sure the date of it is > than date
-        # of last alert sent out.
-        # For local log file, we already have it and don't need to get do anything, unless it's a new log file.
-        ##########################################################################################################################
-        if tailfinished:
-            break
-        # sleep 1 sec between each iteration
-        if not tailfinished:
-            time.sleep(1)
-            sleepsec = sleepsec + 1
-        # p.printit("time.time=%s timeout=%s sleepsec=%s" % (time.time(),timeout,sleepsec))
-        if time.time() > (timeout + sleepsec):
-            break
-        now = time.time()            
-        delta = round(now - buffstart)
-        # p.printit("delta=%d  buffcnt=%d" % (delta,buffcnt))
-        p.bypass = False
-        
-        # only do a refresh every refreshrate minutes/900 seconds
-        #if int(now - p.refreshed) > 900:
-        if int(now - p.refreshed) > (p.refreshrate * 60):
-            rc = p.initrefresh()
-            p.refreshed = time.time()
-            if rc != 0:
-                p.printit("Errors encountered.  Program will abort.")
-                p.cleanup(1)    
-            
-            # At this point, we have killed the existing tail if we are working with a new pg log file.
-            # grep new file once and then start the tail again.  Otherwise do nothing, the tail on existing file is ok.
-            # It appears we have to always grep the log file for RDS and just trust the timestamp logic about not reissuing same alert again.
-            #if p.oldlogfile != p.logfile:
-            if p.rds:
-                # we need to grep the new log file
-                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-                cmd1= "cat %s | grep --line-buffered '%s' | " % (p.logfile, p.grepfilter)
-                cmd2= "grep --line-buffered -v '%s' >> %s 2>&1 &" % (p.grepexclude, p.logalert)                
-                grepcmd=cmd1 + cmd2
-                msg = "%s: grepping new log file... %s\n" % (now,grepcmd)
-                rc,out,errs = p.executecmd(grepcmd,False)
-                if rc != 0:
-                    p.printit("FATAL ERROR: Unable to grep new pg log file, %s" % p.logfile)
-                    p.cleanup(rc)    
-
-            # start the new tail
-            cmd1= "timeout %d tail -f %s | grep --line-buffered '%s' | " % (p.seconds, p.logfile, p.grepfilter)
-            cmd2= "grep --line-buffered -v '%s' >> %s 2>&1 &" % (p.grepexclude, p.logalert)
-            grepcmd=cmd1 + cmd2
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-            msg = "%s: Restarting grep tail... %s\n" % (now,grepcmd)
-            p.printit('%s' % msg)
-            rc,out,errs = p.executecmd(grepcmd,False)
-            if rc != 0:
-                p.printit("FATAL ERROR: Unable to restart the grep tail.")
-                p.cleanup(rc)    
-        
-        if delta < 60:
-            if buffcnt > 20:
-                # too much activity in short duration, back off for awhile, but notify admin
-                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-                msg = "%s: too many alerts (%d) in short interim. Sleeping for 10 minutes..." % (now, buffcnt)
-                p.sendalert(msg)
-                if not tailfinished:
-                    sleepsec = sleepsec + 600                
-                    time.sleep(600)
-                    rc = p.checkotherstuff();
+                # only do a refresh every refreshrate minutes/900 seconds
+                #if int(now - self.refreshed) > 900:
+                if int(now - self.refreshed) > (self.refreshrate * 60):
+                    rc = self.initrefresh()
+                    self.refreshed = time.time()
                     if rc != 0:
-                        p.printit("Errors encountered.  Program will abort.")
-                        p.cleanup(1)    
-        elif p.alertcnt > p.max_alerts:
-            # exceeded maximum alerts for this iteration of program
-            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-            msg = "%s: Max Alerts (%d) exceeded. Program terminating prematurely." % (now, p.max_alerts)
-            p.sendalert(msg)
-            bAbort = True
-            break;            
-        else:
-            # restart the buffer timer
-            buffstart = time.time()
-            buffcnt   = 0
-    
-        where = p.alert.tell()
-        line = p.alert.readline()
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-        if not line:
-            # v3.1: see if we have any buffered_alerts to send out
-            if buffered_alerts != '':
-                if p.verbose:
+                        self.printit("Errors encountered.  Program will abort.")
+                        self.cleanup(1)    
+
+                # v3.2: pg_alert.conf is reloaded when inotify sees it change or on SIGHUP, not every REFRESH minutes
+                if self.reloadrequested or self.follower.configchanged:
+                    reason = 'SIGHUP' if self.reloadrequested else 'file changed'
+                    self.reloadrequested = False
+                    self.follower.configchanged = False
+                    self.reloadconfig(reason)
+
+                # v3.2: noisy errors are rate limited per key as they come in (see queuealert), nothing here ever sleeps
+                if self.alertcnt > self.max_alerts:
+                    # exceeded maximum alerts for this iteration of program
                     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-                    p.printit("%s: VERBOSE: sending %d buffered alerts(A)." % (now, buffered_alerts_cnt))            
-                rc = p.sendalert(buffered_alerts)
-                if rc != 0:
-                    p.cleanup(1)    
-                buffered_alerts = ''
-                buffered_alerts_cnt = 0
-        
-            if tailfinished:
-                break;
-            else:    
-                time.sleep(15)
-                sleepsec = sleepsec + 15
-
-                # check for other things here
-                rc = p.checkotherstuff();
-                if rc != 0:
-                    p.printit("Errors encountered.  Program will abort.")
-                    p.cleanup(1)    
-            
-            time_now = time.time()
-            time_delta = round(time_now - p.time_start)
-            if time_delta > p.seconds:
-                if not tailfinished:
-                    p.printit("%s: Tail finished." % now)
-                tailfinished = 1
-            p.alert.seek(where)
-        else:
-            # for some reason with the change from ">" to ">>" to the alert log, we get an initial 1 byte of nothingness
-            if line.strip() == '':
-                pass
+                    msg = "%s: Max Alerts (%d) exceeded. Program terminating prematurely." % (now, self.max_alerts)
+                    self.sendalert(msg)
+                    bAbort = True
+                    break;            
+
+                # check for other things every 15 seconds, whether or not the log is busy
+                if time.time() - lastchecked >= 15:
+                    rc = self.checkotherstuff();
+                    lastchecked = time.time()
+                    # without inotify on the config directory, one stat() of pg_alert.conf tells us whether it changed
+                    if self.follower.configwd == NOTFOUND and self.configs.stat() not in (self.runningconfig.key, self.configs.failedkey):
+                        self.follower.configchanged = True
+                    if rc != 0:
+                        self.printit("Errors encountered.  Program will abort.")
+                        self.cleanup(1)    
+
+                # v3.2: where the time went, every PERFINTERVAL seconds and on SIGUSR1
+                if self.perfrequested or (self.timing and time.time() - self.perfsummarized >= PERFINTERVAL):
+                    self.perfrequested = False
+                    self.perfsummary()
+
+                # v3.2: once a minute, compare the rates of the minute that ended to their baselines.
+                # Not while catching up on a backlog, that would be its size per minute, not a rate.
+                if self.ratecounting:
+                    anomalies = self.baseline.tick(time.time())
+                else:
+                    self.baseline.pause()
+                    anomalies = []
+                for anomaly in anomalies:
+                    msg = self.baseline.describe(anomaly)
+                    self.historyevent('anomaly', key='%s %s' % anomaly[0], count=anomaly[1], baseline=round(anomaly[2], 1), zscore=round(anomaly[3], 1))
+                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    self.printit("%s: %s" % (now, msg))
+                    # one surge trips many keys at once: aggregated and rate limited like the alerts of log records
+                    rec = logrecord(msg)
+                    rec.fields = {anomaly[0][0]: anomaly[0][1]}
+                    self.queuealert(rec)
+                if self.baselinefile != '' and time.time() - self.baseline.saved >= 3600:
+                    self.baseline.save(self.baselinefile)
+
+                # a file showed up in the log directory, see if pg_current_logfile() moved on without waiting for the next refresh
+                if self.follower.newfileseen:
+                    self.follower.newfileseen = False
+                    rc = self.refreshlogfile()
+                    if rc != 0:
+                        self.printit("Errors encountered.  Program will abort.")
+                        self.cleanup(1)    
+
+                records = self.readrecords()
+                if not records and self.follower.atEOF():
+                    # v3.1: see if we have any buffered_alerts to send out
+                    rc = self.senddue('A')
+                    if rc != 0:
+                        self.cleanup(1)    
+                    # everything read so far has been evaluated and alerted on
+                    if not self.assembler.pending() and not self.fingerprints.pending():
+                        self.follower.savecheckpoint(True)
+
+                    time_now = time.time()
+                    time_delta = round(time_now - self.time_start)
+                    if time_delta > self.seconds:
+                        if self.assembler.pending():
+                            # evaluate the records still waiting for companion lines before we finish
+                            self.assembler.window = 0
+                            continue
+                        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
+                        self.printit("%s: Tail finished." % now)
+                        tailfinished = 1
+                        break
+
+                    # nothing left to read, so block until the log file grows, records are due, or it is time for the other checks
+                    waitsecs = max(1, 15 - (time.time() - lastchecked))
+                    if self.assembler.pending():
+                        waitsecs = min(waitsecs, self.assembler.window)
+                    if self.fingerprints.pending():
+                        waitsecs = max(min(waitsecs, self.fingerprints.started + self.fingerprints.window - time.time()), 0.1)
+                    self.follower.wait(waitsecs)
+                elif records:
+                    for rec in self.validatebatch(records):
+                        # v3.1: buffer the alerts
+                        # v3.2: aggregated by fingerprint until the window is up
+                        started = time.perf_counter_ns() if self.timing else 0
+                        self.queuealert(rec)
+                        if self.timing:
+                            self.timers.add('queuealert', started)
+                    self.releasereplays()
+                    # catching up or in an error storm we may never be at EOF, the window still ends on time
+                    rc = self.senddue('C')
+                    if rc != 0:
+                        self.cleanup(1)    
+                    # only move the checkpoint past lines whose alerts are not still waiting in the buffer or the assembler
+                    if not self.fingerprints.pending() and not self.assembler.pending():
+                        self.follower.savecheckpoint()
+
+        # stopped, timed out or aborted: the records the assembler still holds are evaluated now, the final checkpoint
+        # moves past their lines
+        records = self.assembler.flush(True)
+        if records:
+            for rec in self.validatebatch(records):
+                self.queuealert(rec)
+            self.releasereplays()
+        if self.fingerprints.pending() or self.limiter.pending():
+            if self.verbose:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
+                self.printit("%s: VERBOSE: sending %d buffered alerts(B)." % (now, self.fingerprints.count()))
+            rc = self.sendbuffered()
+        self.follower.savecheckpoint(True)
+        if self.baselinefile != '':
+            self.baseline.save(self.baselinefile)
+        if self.timing:
+            self.perfsummary()
+
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
+        self.printit("%s: Daily Monitoring ending. %d alert(s) detected." % (now, self.alertcnt))
+        self.printit("%s: SQLSTATE/SQLCLASS bypasses: %s" % (now, self.bypasssummary()))
+        self.printit("%s: lock waits: %s" % (now, self.lockwaits.summary()))
+        self.cleanup(0)
+
+    ########################
+    def initbackfill(self, options):
+        # backfill only needs the rules: the alert directory, the log format and log_line_prefix, and the dynamic
+        # part of the configuration.  No pidfile, no log follower, no mail setup.
+        self.options    = options
+        self.configfile = options.configfile
+        self.backfill   = True
+        if self.configfile == "" or not os.path.exists(self.configfile):
+            self.printit("pg_alert config file does not exist: %s" % self.configfile)
+            return ERR
+        for value in (options.since, options.until):
+            if value != '':
+                try:
+                    datetime.datetime.strptime(value, "%Y-%m-%d")
+                except ValueError:
+                    self.printit("Invalid backfill date (%s). Expected YYYY-MM-DD." % value)
+                    return ERR
+        self.since = options.since
+        self.until = options.until
+
+        self.configs = configcache(self.configfile)
+        config = self.configs.snapshot()
+
+        self.clusterid = config.get("required", "clusterid")
+        self.alert_directory = config.get("required", "alertlog_directory")
+        if not os.path.isdir(self.alert_directory):
+            self.printit("Alert log directory is invalid directory: %s" % self.alert_directory)
+            return ERR
+        self.rds = config.getboolean("required", "rds")
+        self.setlogformat(config)
+
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if options.prefix != '':
+            self.setprefix(options.prefix)
+        elif self.logformat == 'stderr':
+            # the files were most likely written with the current log_line_prefix
+            self.dbname = options.dbname if options.dbname != '' else config.get("required", "dbname")
+            self.dbuser = options.dbuser if options.dbuser != '' else config.get("required", "dbuser")
+            self.dbhost = options.dbhost if options.dbhost != '' else config.get("required", "dbhost")
+            self.pgport = config.get("required", "dbport")
+            if self.pgport == "":
+                self.pgport = "5432"
+            if self.checksystem() != OK or self.connectdb() != OK:
+                self.printit("%s: NOTICE. Unable to get log_line_prefix from the database, use --prefix. Log lines will be evaluated without prefix fields." % now)
+
+        # filters, thresholds, sqlstates and ignore lists, exactly like a refresh
+        self.readdynamic()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.connected = False
+        if self.sqlstate != '' and not self.check_sqlstate:
+            self.printit("%s: NOTICE. SQLSTATE filtering needs %%e in log_line_prefix (or csvlog/jsonlog) for backfill and is disabled." % now)
+
+        rc = self.openhistory(config, "%s/alerts-history-%%s" % self.alert_directory, 'a')
+        if rc != OK:
+            return rc
+        rc = self.openstore(config)
+        if rc != OK or self.store is None:
+            return rc
+        # opened to check the path and create the schema.  A connection must not cross fork(), every worker opens its own.
+        self.storepath = self.store.path
+        self.store.close()
+        self.store = None
+        return OK
+
+    ########################
+    def backfillscan(self, logfile):
+        # one backfill file, in a pool worker: stream it (decompressing .gz on the fly), assemble records and evaluate them.
+        # Everything printed goes to a segment file the parent copies into the history once it has the counts, and the
+        # rows go to the event store from here, so neither piles up in memory or in the result.
+        self.backfilllog = []
+        self.bypassreasons = {}
+        self.lockwaits.reset()
+        result = {'logfile': logfile, 'lines': 0, 'bytes': 0, 'records': 0, 'alerts': 0, 'rows': 0, 'seconds': 0.0, 'cpu': 0.0, 'error': '', 'segment': ''}
+        if self.storepath != '':
+            try:
+                self.store = eventstore(self.storepath, self.historyflush, self.storedays, BACKFILLQUEUE)
+            except sqlite3.Error as e:
+                result['error'] = "event store: %s" % e
+                self.storerows = None
+        started = time.time()
+        cpustarted = time.process_time()
+        assembler = self.assembler.__class__(self.follower)
+        assembler.parser = self.assembler.parser
+        try:
+            # named after the run, so runbackfill() removes it even if we never get to report it
+            fd, result['segment'] = tempfile.mkstemp(prefix=self.backfillprefix, suffix='.tmp', dir=self.alert_directory)
+            self.backfillsegment = os.fdopen(fd, 'w')
+            if logfile.endswith('.gz'):
+                afile = gzip.open(logfile, 'rb')
             else:
-                if p.debug:
+                afile = open(logfile, 'rb')
+            with afile:
+                partial = b''
+                while True:
+                    data = afile.read(logfollower.CHUNKSIZE)
+                    if not data:
+                        break
+                    result['bytes'] = result['bytes'] + len(data)
+                    lines = (partial + data).split(b'\n')
+                    partial = lines.pop()
+                    result['lines'] = result['lines'] + len(lines)
+                    self.backfillbatch(assembler.feed([aline.decode('utf-8', 'replace') for aline in lines]), result)
+                if partial:
+                    result['lines'] = result['lines'] + 1
+                    self.backfillbatch(assembler.feed([partial.decode('utf-8', 'replace')]), result)
+                self.backfillbatch(assembler.flush(True), result)
+        except (OSError, EOFError, zlib.error) as e:
+            result['error'] = str(e)
+        try:
+            if self.backfillsegment is not None:
+                self.flushbackfill()
+                self.backfillsegment.close()
+        except (IOError, OSError) as e:
+            result['error'] = result['error'] or "%s: %s" % (result['segment'], e)
+        self.backfillsegment = None
+        self.backfilllog = None
+        if self.store is not None:
+            store = self.store
+            self.store = None
+            store.close()
+            result['rows'] = store.rows
+            if store.error != '':
+                result['error'] = result['error'] or "event store: %s" % store.error
+        result['seconds'] = time.time() - started
+        result['cpu'] = time.process_time() - cpustarted
+        result['bypassreasons'] = self.bypassreasons
+        result['lockwaits'] = self.lockwaits.state()
+        return result
+
+    ########################
+    def backfillbatch(self, records, result):
+        if self.since != '' or self.until != '':
+            records = [rec for rec in records if (self.since == '' or rec.timestamp()[0:10] >= self.since) and (self.until == '' or rec.timestamp()[0:10] <= self.until)]
+        result['records'] = result['records'] + len(records)
+        for rec in self.validatebatch(records):
+            result['alerts'] = result['alerts'] + 1
+            self.backfillline("BACKFILL ALERT: %s" % rec.msg.strip())
+
+    ########################
+    def runbackfill(self, options):
+        # v3.2: apply the current rules to old pg log files, one file per pool worker.  Results go to the history file only.
+        global backfiller
+        rc = self.initbackfill(options)
+        if rc != OK:
+            return rc
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        logfiles = sorted(glob.glob(options.backfill))
+        if self.since != '':
+            # a file last written before SINCE cannot hold anything we want
+            since = time.mktime(time.strptime(self.since, "%Y-%m-%d"))
+            logfiles = [logfile for logfile in logfiles if os.path.getmtime(logfile) >= since]
+        if len(logfiles) == 0:
+            self.printit("%s: backfill: no log files found for %s" % (now, options.backfill))
+            return ERR
+
+        jobs = int(options.jobs) if str(options.jobs).isdigit() and int(options.jobs) > 0 else (os.cpu_count() or 1)
+        jobs = min(jobs, len(logfiles))
+        self.printit("%s: backfill: %d log files, %d worker processes, since=%s until=%s. No emails are sent." % (now, len(logfiles), jobs, self.since or '-', self.until or '-'))
+
+        # the workers are forked from here and inherit this pgmon with its compiled matcher and prefix parser
+        backfiller = self
+        totals = {'lines': 0, 'bytes': 0, 'alerts': 0, 'rows': 0, 'cpu': 0.0}
+        started = time.time()
+        rc = OK
+        history = self.history
+        self.backfillprefix = '.pg_alert-backfill-%d-' % os.getpid()
+        try:
+            with multiprocessing.get_context('fork').Pool(jobs) as pool:
+                for result in pool.imap(backfillfile, logfiles):
+                    # the history queue is bounded, so a big segment is copied no faster than it is written
+                    if result['segment'] != '':
+                        with open(result['segment'], 'r') as segment:
+                            for aline in segment:
+                                message = json.loads(aline)
+                                if isinstance(message, dict):
+                                    history.event(message)
+                                else:
+                                    history.message(message)
+                        os.remove(result['segment'])
+                    for key in totals:
+                        totals[key] = totals[key] + result[key]
+                    for reason, count in result['bypassreasons'].items():
+                        self.bypassreasons[reason] = self.bypassreasons.get(reason, 0) + count
+                    self.lockwaits.merge(result['lockwaits'])
                     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    p.printit("%s: DEBUG: evaluating msg: %s" % (now, line.strip()))
-                if p.alertvalidated(line.strip()):
-                    # no need to keep track of sending out too many alerts since we buffer them now
-                    #buffcnt = buffcnt + 1    
-                    
-                    # v3.1: buffer the alerts
-                    buffered_alerts = buffered_alerts + line.strip() + '\n'
-                    buffered_alerts_cnt = buffered_alerts_cnt + 1
-                    if p.debug:
-                        p.printit("%s: %d buffered alert=%s" % (now, buffered_alerts_cnt, line.strip()))
-                    #rc = p.sendalert(line.strip())
-                    #if rc != 0:
-                    #    p.cleanup(1)    
+                    if result['error'] != '':
+                        rc = ERR
+                        msg = "%s: backfill: %s: ERROR: %s" % (now, result['logfile'], result['error'])
+                        history.message(msg)
+                        print (msg)
+                    rate = result['lines'] / result['seconds'] if result['seconds'] > 0 else 0
+                    msg = "%s: backfill: %s: %d lines, %d records, %d alerts, %.1f secs, %d lines/sec" % (now, result['logfile'], result['lines'], result['records'], result['alerts'], result['seconds'], rate)
+                    history.message(msg)
+                    print (msg)
+        finally:
+            # the segments of files whose result never came back, e.g. a worker died
+            for path in glob.glob(os.path.join(glob.escape(self.alert_directory), glob.escape(self.backfillprefix) + '*.tmp')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        backfiller = None
+
+        elapsed = time.time() - started
+        rate    = totals['lines'] / elapsed if elapsed > 0 else 0
+        percore = totals['lines'] / totals['cpu'] if totals['cpu'] > 0 else 0
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.printit("%s: backfill done: %d files, %d lines, %d bytes, %d alerts in %.1f secs. %d lines/sec, %d lines/sec per core (%d workers). History: %s" % \
+                     (now, len(logfiles), totals['lines'], totals['bytes'], totals['alerts'], elapsed, rate, percore, jobs, self.loghistory))
+        self.printit("%s: SQLSTATE/SQLCLASS bypasses: %s" % (now, self.bypasssummary()))
+        self.printit("%s: lock waits: %s" % (now, self.lockwaits.summary()))
+        if self.storepath != '':
+            # errors were reported per file
+            self.printit("%s: event store: %d rows stored in %s." % (now, totals['rows'], self.storepath))
+        self.history = None
+        history.close()
+        return rc
+
+    ########################
+    def existingstore(self):
+        # the event store file of this cluster, standalone or written in fleet mode
+        path = self.storefile()
+        if not os.path.exists(path):
+            self.fleet = True
+            path = self.storefile()
+            self.fleet = False
+        if not os.path.exists(path):
+            self.printit("No event store found in %s. Set EVENTSTORE=yes." % self.alert_directory)
+            return ''
+        return path
+
+    ########################
+    def runquery(self, options, filters):
+        # v3.2: count the records in the event store, e.g. the 40P01 deadlocks per database since a date:
+        #   pg_alert.py -c pg_alert.conf query sqlstate=40P01 --by database --since 2021-06-01
+        # filters are FIELD=VALUE, a value with % is a LIKE pattern.  Only reads, runs next to a live pg_alert.
+        if options.configfile == "" or not os.path.exists(options.configfile):
+            self.printit("pg_alert config file does not exist: %s" % options.configfile)
+            return ERR
+        config = configcache(options.configfile).snapshot()
+        self.clusterid = config.get("required", "clusterid")
+        self.alert_directory = config.get("required", "alertlog_directory")
+        path = self.existingstore()
+        if path == '':
+            return ERR
+
+        by = [field.strip() for field in options.by.split(',') if field.strip() != '']
+        where = []
+        params = []
+        for afilter in filters:
+            field, sep, value = afilter.partition('=')
+            if sep == '' or field not in QUERYFIELDS:
+                self.printit("Invalid query filter, %s. Expected FIELD=VALUE with FIELD one of %s." % (afilter, ', '.join(sorted(QUERYFIELDS))))
+                return ERR
+            where.append("%s %s ?" % (QUERYFIELDS[field], 'LIKE' if '%' in value else '='))
+            params.append(value)
+        for field in by:
+            if field not in QUERYFIELDS:
+                self.printit("Invalid --by field, %s. Expected one of %s." % (field, ', '.join(sorted(QUERYFIELDS))))
+                return ERR
+        if options.since != '':
+            where.append("logtime >= ?")
+            params.append(options.since)
+        if options.until != '':
+            where.append("logtime <= ?")
+            params.append(options.until + " 23:59:59")
+        top = int(options.top) if str(options.top).isdigit() else 50
+
+        columns = [QUERYFIELDS[field] for field in by]
+        sql = "SELECT %s count(*), sum(decision = 'alert'), count(DISTINCT alertid), min(logtime), max(logtime) FROM events" % \
+              ''.join([column + ', ' for column in columns])
+        if where:
+            sql = sql + " WHERE " + " AND ".join(where)
+        if columns:
+            sql = sql + " GROUP BY " + ", ".join(columns)
+        sql = sql + " ORDER BY count(*) DESC LIMIT %d" % top
+
+        started = time.time()
+        try:
+            conn = sqlite3.connect(path, timeout=30)
+            rows = conn.execute(sql, params).fetchall()
+            conn.close()
+        except sqlite3.Error as e:
+            self.printit("Unable to query event store, %s. %s" % (path, e))
+            return ERR
+        header = by + ['records', 'alerted', 'alerts', 'first', 'last']
+        lines  = [[str(value) if value is not None else '-' for value in row] for row in rows]
+        widths = [max([len(header[i])] + [len(line[i]) for line in lines]) for i in range(len(header))]
+        print('  '.join([header[i].ljust(widths[i]) for i in range(len(header))]))
+        for line in lines:
+            print('  '.join([line[i].ljust(widths[i]) for i in range(len(header))]))
+        print("%d rows from %s in %.3f secs" % (len(rows), path, time.time() - started))
+        return OK
+
+    ########################
+    def initwhatif(self, configfile, options):
+        # like initbackfill, for one of the configs what-if compares: only the rules.  No history file, no event store
+        # and no db, the stored records carry their prefix fields.
+        self.options    = options
+        self.configfile = configfile
+        self.backfill   = True
+        if self.configfile == "" or not os.path.exists(self.configfile):
+            self.printit("pg_alert config file does not exist: %s" % self.configfile)
+            return ERR
+        self.configs = configcache(self.configfile)
+        config = self.configs.snapshot()
+        self.clusterid = config.get("required", "clusterid")
+        self.alert_directory = config.get("required", "alertlog_directory")
+        self.setlogformat(config)
+        self.readdynamic()
+        # the stored sqlstate was found with whatever log_line_prefix was current, see replayrecord()
+        self.check_sqlstate = (len(self.sqlstates) != 0 or len(self.sqlclasses) != 0) and self.sqlstate != ''
+        return OK
+
+    ########################
+    def replayrecord(self, row):
+        # a stored event store row (message, fields, sqlstate, severity, fingerprint) as the log record it was, grepped
+        # again with this config's GREPFILTER and GREPEXCLUDE.  None if they drop it.
+        message, fields, sqlstate, severity, fingerprint = row
+        lines = greplines(self.matcher, message.split('\n'))
+        if lines is None:
+            return None
+        rec = logrecord(lines[0])
+        rec.lines    = lines
+        rec.fields   = json.loads(fields) if fields else {}
+        if sqlstate:
+            rec.fields['sqlstate'] = sqlstate
+        rec.pid      = rec.fields.get('pid')
+        rec.severity = severity or ''
+        # only depends on the primary line, so a stored one is still right
+        rec.fingerprint = fingerprint
+        return rec.finish()
+
+    ########################
+    def whatifscan(self, rows):
+        # evaluate rows and return (decision, label, logtime, rate limit key) for each; label is the rule that
+        # alerted or the reason it was bypassed.  Runs in a pool worker, everything printed while evaluating is dropped.
+        self.backfilllog = []
+        outcomes = []
+        for row in rows:
+            rec = self.replayrecord(row[1:])
+            if rec is None:
+                outcomes.append(('bypass', 'grep', row[0], None))
+                continue
+            if rec.msg.strip() == '':
+                outcomes.append(('bypass', 'empty', row[0], None))
+                continue
+            self.bypass = False
+            if self.alertvalidated(rec):
+                if self.limiter.keyfield == 'fingerprint':
+                    if rec.fingerprint is None:
+                        rec.fingerprint = self.fingerprints.fingerprint(rec.msg.strip())
+                    key = rec.fingerprint
                 else:
-                    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")                    
-                    if p.debug:
-                        p.printit("%s: DEBUG: bypass(2) bypass=%r  for %s\n" % (now, p.bypass, line.strip()))
+                    key = rec.fields.get(self.limiter.keyfield) or '-'
+                outcomes.append(('alert', rec.rule or 'default', row[0], key))
+            else:
+                outcomes.append(('bypass', rec.reason or rec.rule or '-', row[0], None))
+            del self.backfilllog[:]
+        self.backfilllog = None
+        return outcomes
+
+    ########################
+    def whatifsends(self, alerts):
+        # the alert emails and rate limited alerts for (logtime, key) of the alerted records, in log time order: the
+        # fingerprint window and the rate limiter of this config, run by log time instead of the clock
+        limiter = ratelimiter(self.limiter.keyfield, self.limiter.rate * 60, self.limiter.burst)
+        window  = self.fingerprints.window
+        sends   = 0
+        limited = 0
+        started = None
+        epochs  = {}
+        for logtime, key in alerts:
+            when = epochs.get(logtime)
+            if when is None:
+                try:
+                    when = time.mktime(time.strptime(logtime, "%Y-%m-%d %H:%M:%S"))
+                except ValueError:
+                    when = started or 0
+                epochs[logtime] = when
+            if started is not None and when - started >= window:
+                sends = sends + 1
+                started = None
+            if not limiter.allow(key, when):
+                limited = limited + 1
+                continue
+            if started is None:
+                started = when
+        if started is not None or limiter.pending():
+            sends = sends + 1
+        return sends, limited
+
+    ########################
+    def runwhatif(self, options):
+        # v3.2: replay the last DAYS days of the event store through CONFIGFILE and the CANDIDATE config, in pool
+        # workers that each read a range of rows, and report what each would have alerted on and sent.
+        global whatiffers
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        candidate = pgmon()
+        if self.initwhatif(options.configfile, options) != OK or candidate.initwhatif(options.whatif, options) != OK:
+            return ERR
+        path = self.existingstore()
+        if path == '':
+            return ERR
+        days  = int(options.days) if str(options.days).isdigit() else 7
+        since = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            conn = sqlite3.connect(path, timeout=30)
+            first, last, count = conn.execute("SELECT min(id), max(id), count(*) FROM events WHERE logtime >= ?", (since,)).fetchone()
+            conn.close()
+        except sqlite3.Error as e:
+            self.printit("Unable to read event store, %s. %s" % (path, e))
+            return ERR
+        if count == 0:
+            self.printit("%s: what-if: no records since %s in %s" % (now, since, path))
+            return ERR
+
+        jobs = int(options.jobs) if str(options.jobs).isdigit() and int(options.jobs) > 0 else (os.cpu_count() or 1)
+        chunk = max(WHATIFCHUNK, (last - first + 1) // (jobs * 4) + 1)
+        ranges = [(path, since, start, min(start + chunk - 1, last)) for start in range(first, last + 1, chunk)]
+        jobs = min(jobs, len(ranges))
+        self.printit("%s: what-if: %d records since %s from %s, %d worker processes. Nothing is sent." % (now, count, since, path, jobs))
+
+        # the workers are forked from here and inherit both configured pgmons
+        whatiffers = (self, candidate)
+        started  = time.time()
+        records  = 0
+        alerts   = ([], [])
+        labels   = (collections.Counter(), collections.Counter())
+        changed  = collections.Counter()
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for current, proposed in pool.imap(whatifrange, ranges):
+                records = records + len(current)
+                for outcomes, found, counted in ((current, alerts[0], labels[0]), (proposed, alerts[1], labels[1])):
+                    for decision, label, logtime, key in outcomes:
+                        counted[(decision, label)] += 1
+                        if decision == 'alert':
+                            found.append((logtime, key))
+                for before, after in zip(current, proposed):
+                    if before[0:2] != after[0:2]:
+                        changed[(before[0:2], after[0:2])] += 1
+        whatiffers = None
+        elapsed = time.time() - started
+
+        print("what-if: %d records from the last %d days in %.1f secs (%d records/sec, %d workers)" % (records, days, elapsed, records / elapsed if elapsed > 0 else 0, jobs))
+        results = []
+        for pgmonitor, found in ((self, alerts[0]), (candidate, alerts[1])):
+            found.sort(key=lambda alert: alert[0])
+            results.append((len(found),) + pgmonitor.whatifsends(found))
+        print("%-24s %20s %20s" % ('', 'current', 'candidate'))
+        print("%-24s %20s %20s" % ('config', os.path.basename(self.configfile), os.path.basename(candidate.configfile)))
+        for index, name in enumerate(('records alerted', 'alert emails', 'rate limited alerts')):
+            print("%-24s %20d %20d" % (name, results[0][index], results[1][index]))
+        print("")
+        print("records per outcome (alert: rule, bypass: reason)")
+        for decision, label in sorted(set(labels[0]) | set(labels[1])):
+            before = labels[0].get((decision, label), 0)
+            after  = labels[1].get((decision, label), 0)
+            print("  %-6s %-36s %10d %10d %s" % (decision, label, before, after, '' if before == after else '%+d' % (after - before)))
+        print("")
+        print("%d records changed outcome" % sum(changed.values()))
+        for (before, after), count in changed.most_common(WHATIFCHANGES):
+            print("  %10d  %s(%s) -> %s(%s)" % (count, before[0], before[1], after[0], after[1]))
+        return OK
+
+    ########################
+    def fleetmain(self, configfile, options):
+        # fleet mode thread: one cluster from start to end.  cleanup() ends with sys.exit(), which only ends this thread.
+        try:
+            rc = self.initandvalidate(configfile, options)
+            if rc != 0:
+                now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.printit("%s: Initialization Error." % now)
+                self.cleanup(1)
+            self.showparms()
+            self.run()
+        except SystemExit as e:
+            self.exitcode = e.code
+        except Exception as e:
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.printit("%s: Unexpected error for cluster %s: %s" % (now, self.clusterid, e))
+            self.exitcode = ERR
+            try:
+                self.cleanup(ERR)
+            except SystemExit:
+                pass
+
+
+# the pgmon backfill workers are forked from, see pgmon.runbackfill()
+backfiller = None
+# history lines a backfill worker keeps before writing them to its segment, and row batches it may have queued for the event store
+BACKFILLFLUSH = 1000
+BACKFILLQUEUE = 4
 
-if buffered_alerts != '':
-    if p.verbose:
+def backfillfile(logfile):
+    return backfiller.backfillscan(logfile)
+
+
+# the current and candidate pgmon what-if workers are forked from, see pgmon.runwhatif()
+whatiffers = None
+# rows per worker task at least, and outcome changes reported
+WHATIFCHUNK   = 20000
+WHATIFCHANGES = 20
+
+def whatifrange(task):
+    # one range of event store ids, read by the worker itself so the messages are not shipped from the parent
+    path, since, start, end = task
+    conn = sqlite3.connect(path, timeout=30)
+    rows = conn.execute("SELECT logtime, message, fields, sqlstate, severity, fingerprint FROM events WHERE id BETWEEN ? AND ? AND logtime >= ? ORDER BY id",
+                        (start, end, since)).fetchall()
+    conn.close()
+    return whatiffers[0].whatifscan(rows), whatiffers[1].whatifscan(rows)
+
+
+class pgfleet:
+    # v3.2 fleet mode: every *.conf in the fleet directory is one cluster, monitored by its own pgmon in its own thread
+    # of this one process.  Each cluster keeps its own config, db connection, log follower, pidfile, alerts-history and
+    # checkpoint files; signals are only handled here, in the main thread, and tell every cluster to finish up.
+    def __init__(self, fleetdir, options):
+        self.fleetdir = fleetdir
+        self.options  = options
+        self.monitors = []
+        self.threads  = []
+
+    def start(self):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if not os.path.isdir(self.fleetdir):
+            print("%s: fleet directory does not exist: %s" % (now, self.fleetdir))
+            return ERR
+        configfiles = sorted(glob.glob(os.path.join(self.fleetdir, '*.conf')))
+        if len(configfiles) == 0:
+            print("%s: no cluster config files (*.conf) found in %s" % (now, self.fleetdir))
+            return ERR
+
+        signal.signal(signal.SIGINT, self.catch)
+        signal.signal(signal.SIGTERM, self.catch)
+        signal.signal(signal.SIGHUP, self.hangup)
+        signal.signal(signal.SIGUSR1, self.usr1)
+        for configfile in configfiles:
+            monitor = pgmon()
+            monitor.fleet = True
+            thread  = threading.Thread(target=monitor.fleetmain, args=(configfile, self.options), name=os.path.basename(configfile))
+            thread.daemon = True
+            self.monitors.append(monitor)
+            self.threads.append(thread)
+            print("%s: fleet: starting %s" % (now, configfile))
+            thread.start()
+        return OK
+
+    def wait(self):
+        # join with a timeout so the main thread stays responsive to signals
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+        rc = OK
+        for monitor in self.monitors:
+            if monitor.exitcode not in (None, OK):
+                rc = ERR
+        return rc
+
+    def catch(self, signum, frame):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print("%s: fleet: signal %d received, stopping %d clusters..." % (now, signum, len(self.monitors)))
+        for monitor in self.monitors:
+            monitor.stopping = True
+
+    def hangup(self, signum, frame):
+        # every cluster reloads its own config file, the ones that did not change find nothing to do
+        for monitor in self.monitors:
+            monitor.reloadrequested = True
+
+    def usr1(self, signum, frame):
+        for monitor in self.monitors:
+            monitor.perfrequested = True
+
+
+#####################################
+######### MAIN ENTRY POINT ##########
+#####################################
+
+
+if __name__ == '__main__':
+    # v3.2: guarded so pg_alert can be imported, e.g. by pg_alert_bench.py
+    # get the class instantiation
+    p = pgmon()
+
+    optionParser = p.setupOptionParser()
+    (options, args) = optionParser.parse_args()
+    if options.fleetdir != '':
+        # v3.2: one process for every cluster config in the fleet directory
+        fleet = pgfleet(options.fleetdir, options)
+        rc = fleet.start()
+        if rc == OK:
+            rc = fleet.wait()
+        sys.exit(rc)
+    if options.backfill != '':
+        # v3.2: scan old log files with the current rules and exit, the live log is not followed
+        sys.exit(p.runbackfill(options))
+    if options.whatif != '':
+        # v3.2: replay the event store through the current and a candidate config and exit, nothing is sent
+        sys.exit(p.runwhatif(options))
+    if len(args) > 0 and args[0] == 'query':
+        # v3.2: count the records in the event store and exit
+        sys.exit(p.runquery(options, args[1:]))
+
+    rc = p.initandvalidate(options=options)
+    if rc != 0:
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-        p.printit("%s: VERBOSE: sending %d buffered alerts(B)." % (now, buffered_alerts_cnt))
-    rc = p.sendalert(buffered_alerts)
-                
-now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")    
-p.printit("%s: Daily Monitoring ending. %d alert(s) detected." % (now, p.alertcnt))
-p.cleanup(0)
+        p.printit("%s: Initialization Error." % now)
+        p.cleanup(1)    
 
+    p.showparms()
+    p.run()
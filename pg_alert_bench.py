@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+###############################################################################
+### COPYRIGHT NOTICE FOLLOWS.  DO NOT REMOVE
+###############################################################################
+### Copyright (c) 2012 - 2021, SQLEXEC LLC
+###
+### This program is bound by the following licenses:
+###    GNU GENERAL PUBLIC LICENSE Version 3, 29 June 2007
+###    MIT licensing privileges also conveyed on top of GNU V3.
+###
+### See pg_alert.py for the full copyright notice.
+###############################################################################
+### pg_alert_bench.py: compare the old grep pipeline with the in-process matcher
+###
+### Runs GREPFILTER/GREPEXCLUDE from a pg_alert.conf over a recorded PG log file twice:
+###   1. grep -i "<GREPFILTER>" logfile | grep -v "<GREPEXCLUDE>"   (what pg_alert v3.1 spawned)
+###   2. pg_alert's logfollower + patternmatcher, reading the file the way the main loop does
+### and reports matching lines and lines/second for both, plus the lines only one of them matched.
+###
+### pg_alert_bench.py -c pg_alert.conf -f /var/log/postgresql/postgresql-Mon.log [-n 3]
+###############################################################################
+import sys, os, time, configparser, subprocess
+from optparse import OptionParser
+
+import pg_alert
+
+########################
+def readconfig(configfile):
+    config = configparser.ConfigParser({'grepfilter':'', 'grepexclude':'', 'lockfilter':'', 'ignoreapps':''})
+    config.read(configfile)
+    return config.get("optional", "grepfilter"), config.get("optional", "grepexclude")
+
+########################
+def rungrep(logfile, grepfilter, grepexclude):
+    start = time.time()
+    grep = subprocess.Popen(['grep', '-i', '--', grepfilter, logfile], stdout=subprocess.PIPE)
+    if grepexclude != '':
+        grepv = subprocess.Popen(['grep', '-v', '--', grepexclude], stdin=grep.stdout, stdout=subprocess.PIPE)
+        grep.stdout.close()
+        out = grepv.communicate()[0]
+    else:
+        out = grep.communicate()[0]
+    grep.wait()
+    elapsed = time.time() - start
+    return elapsed, out.decode('utf-8', 'replace').splitlines()
+
+########################
+def runfollower(logfile, grepfilter, grepexclude):
+    matcher = pg_alert.patternmatcher()
+    matcher.addgrep('filter', grepfilter, True)
+    matcher.addgrep('exclude', grepexclude)
+    matcher.compile()
+
+    # the same path the main loop takes, without a log_line_prefix so every matching line is a record like grep output
+    follower  = pg_alert.logfollower()
+    follower.setmatcher(matcher)
+    assembler = pg_alert.recordassembler(follower)
+    start = time.time()
+    follower.open(logfile, 0)
+    matched = []
+    while True:
+        lines = follower.readlines()
+        if not lines:
+            break
+        for record in assembler.feed(lines):
+            matched.append(record.msg)
+    linesread = follower.linesread
+    follower.close()
+    elapsed = time.time() - start
+    return elapsed, matched, linesread
+
+########################
+def report(name, elapsed, matched, linesread):
+    rate = linesread / elapsed if elapsed > 0 else 0
+    print("%-10s %10d matched  %8.3f secs  %12d lines/sec" % (name, len(matched), elapsed, rate))
+
+
+parser = OptionParser("pg_alert_bench.py -c CONFIGFILE -f LOGFILE [-n RUNS]")
+parser.add_option("-c","--configfile",dest="configfile", help="pg_alert config file", default="",metavar="CONFIGFILE")
+parser.add_option("-f","--logfile",dest="logfile", help="recorded pg log file", default="",metavar="LOGFILE")
+parser.add_option("-n","--runs",dest="runs", help="number of runs, best one is reported. Default is 3", default=3,metavar="RUNS")
+(options,args) = parser.parse_args()
+if options.configfile == '' or options.logfile == '':
+    parser.print_help()
+    sys.exit(1)
+
+grepfilter, grepexclude = readconfig(options.configfile)
+if grepfilter == '':
+    print("GREPFILTER is empty, nothing to compare.")
+    sys.exit(1)
+
+runs = int(options.runs)
+best = {}
+for i in range(runs):
+    elapsed, grepped = rungrep(options.logfile, grepfilter, grepexclude)
+    if 'grep' not in best or elapsed < best['grep'][0]:
+        best['grep'] = (elapsed, grepped)
+    elapsed, matched, linesread = runfollower(options.logfile, grepfilter, grepexclude)
+    if 'follower' not in best or elapsed < best['follower'][0]:
+        best['follower'] = (elapsed, matched)
+
+print("%s: %d lines, %d bytes, best of %d runs" % (options.logfile, linesread, os.path.getsize(options.logfile), runs))
+report('grep', best['grep'][0], best['grep'][1], linesread)
+report('follower', best['follower'][0], best['follower'][1], linesread)
+
+# grep treats GREPFILTER as a basic regex, pg_alert as literal phrases, so differences point at phrases with regex characters
+onlygrep     = set(best['grep'][1]) - set(best['follower'][1])
+onlyfollower = set(best['follower'][1]) - set(best['grep'][1])
+print("only grep matched: %d  only follower matched: %d" % (len(onlygrep), len(onlyfollower)))
+for line in list(onlygrep)[0:5]:
+    print("  grep: %s" % line)
+for line in list(onlyfollower)[0:5]:
+    print("  follower: %s" % line)